@@ -0,0 +1,116 @@
+"""
+FakeSC2Env.py
+A deterministic stand-in for pysc2.env.sc2_env.SC2Env, for measuring the throughput of the training loop without a
+StarCraft II install. Observations have the shapes and dtypes of the real environment for the given screen and minimap
+sizes, filled with pseudo-random content from a seeded generator.
+
+Example:
+python PySC2_A3C_Agent.py --fake_env --fake_env_latency_ms=2 --num_workers=4
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import numpy as np
+
+from pysc2.env import environment
+from pysc2.lib import actions
+from pysc2.lib import features
+
+import SC2Definitions
+
+_UNIT_TYPE_IDS = np.array(sorted(set(unit for race in SC2Definitions.UNITS.values() for unit in race.values())))
+_NO_OP = 0
+
+# Largest number of rows generated for the observations whose first dimension depends on the game state
+_VARIABLE_ROWS = {'single_select': 1, 'multi_select': 500, 'cargo': 8, 'build_queue': 5}
+
+
+def synthetic_observation(observation_spec, rng, max_rows=None):
+    """Build an observation dict matching observation_spec, with pseudo-random content drawn from rng.
+
+    max_rows optionally overrides the largest number of rows of the variable-size observations, eg. {'multi_select': 50}."""
+    rows_limit = dict(_VARIABLE_ROWS)
+    rows_limit.update(max_rows or {})
+    observation = {}
+    for feature_label, shape in observation_spec.items():
+        if feature_label == 'screen' or feature_label == 'minimap':
+            layers = features.SCREEN_FEATURES if feature_label == 'screen' else features.MINIMAP_FEATURES
+            observation[feature_label] = np.stack([rng.randint(0, layer.scale, size=shape[1:]) for layer in layers]).astype(np.int32)
+        elif feature_label == 'available_actions':
+            available = rng.choice(len(actions.FUNCTIONS), size=rng.randint(1, min(30, len(actions.FUNCTIONS))), replace=False)
+            # no_op is always available in the real environment
+            observation[feature_label] = np.union1d(available, [_NO_OP]).astype(np.int32)
+        elif feature_label in rows_limit:
+            rows = rng.randint(0, rows_limit[feature_label] + 1)
+            if feature_label == 'single_select':
+                rows = 1
+            units = rng.randint(0, 100, size=(rows, shape[1])).astype(np.int32)
+            units[:, 0] = rng.choice(_UNIT_TYPE_IDS, size=rows)
+            observation[feature_label] = units
+        else:
+            observation[feature_label] = rng.randint(0, 100, size=shape).astype(np.int32)
+    # Place a few enemy units on the screen so the unit counters have something to count
+    screen = observation['screen']
+    enemy = rng.rand(*screen.shape[1:]) < 0.05
+    screen[features.SCREEN_FEATURES.player_relative.index][enemy] = 4
+    screen[features.SCREEN_FEATURES.unit_type.index][enemy] = rng.choice(_UNIT_TYPE_IDS, size=enemy.sum())
+    return observation
+
+
+class FakeSC2Env(object):
+    """Drop-in replacement for sc2_env.SC2Env with seeded observations and a configurable step latency.
+
+    Episodes last episode_length steps. Observations are drawn from a pool of pool_size pregenerated ones, so that
+    generating them does not dominate the measured throughput; with pool_size=0 every observation is generated fresh.
+    Pooled observation arrays are shared between steps and must not be modified by the caller."""
+
+    def __init__(self, map_name=None, screen_size_px=(64, 64), minimap_size_px=(64, 64), random_seed=None,
+                 step_latency=0., episode_length=300, pool_size=16, max_rows=None, **unused_kwargs):
+        self.map_name = map_name
+        self._features = features.Features(screen_size_px=screen_size_px, minimap_size_px=minimap_size_px)
+        self._rng = np.random.RandomState(random_seed)
+        self._max_rows = max_rows
+        self.step_latency = step_latency
+        self.episode_length = episode_length
+        self._pool = [synthetic_observation(self.observation_spec(), self._rng, max_rows) for _ in range(pool_size)]
+        self._episode_steps = 0
+        self._observation = None
+
+    def observation_spec(self):
+        return self._features.observation_spec()
+
+    def action_spec(self):
+        return self._features.action_spec()
+
+    def _next_observation(self):
+        if self._pool:
+            return self._pool[self._rng.randint(len(self._pool))]
+        return synthetic_observation(self.observation_spec(), self._rng, self._max_rows)
+
+    def reset(self):
+        self._episode_steps = 0
+        self._observation = self._next_observation()
+        return (environment.TimeStep(step_type=environment.StepType.FIRST, reward=0, discount=0., observation=self._observation),)
+
+    def step(self, actions):
+        if self._observation is None or self._episode_steps >= self.episode_length:
+            return self.reset()
+        function_id = actions[0].function
+        if function_id not in self._observation['available_actions']:
+            raise ValueError("Function {0} is currently not available".format(function_id))
+        if self.step_latency > 0:
+            time.sleep(self.step_latency)
+        self._episode_steps += 1
+        self._observation = self._next_observation()
+        if self._episode_steps >= self.episode_length:
+            step_type, discount = environment.StepType.LAST, 0.
+        else:
+            step_type, discount = environment.StepType.MID, 1.
+        return (environment.TimeStep(step_type=step_type, reward=self._rng.randint(0, 2), discount=discount, observation=self._observation),)
+
+    def close(self):
+        self._pool = []
+        self._observation = None
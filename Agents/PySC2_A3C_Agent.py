@@ -4,6 +4,8 @@ A script for training and running an A3C agent on the PySC2 environment, with re
 [1] Vinyals, Oriol, et al. "Starcraft II: A new challenge for reinforcement learning." arXiv preprint arXiv:1708.04782 (2017).
 Advantage estimation uses generalized advantage estimation from:
 [2] Schulman, John, et al. "High-dimensional continuous control using generalized advantage estimation." arXiv preprint arXiv:1506.02438 (2015).
+The optional off-policy correction for decoupled learners is V-trace from:
+[3] Espeholt, Lasse, et al. "IMPALA: Scalable distributed deep-RL with importance weighted actor-learner architectures." arXiv preprint arXiv:1802.01561 (2018).
 
 Credit goes to Arthur Juliani for providing for reference an implementation of A3C for the VizDoom environment
 https://medium.com/emergent-future/simple-reinforcement-learning-with-tensorflow-part-8-asynchronous-actor-critic-agents-a3c-c88f72a5e9f2
@@ -11,13 +13,22 @@ https://github.com/awjuliani/DeepRL-Agents
 """
 
 import threading
+import multiprocessing
+import collections
+import queue
+import functools
 import psutil
 import numpy as np
 import tensorflow as tf
 import scipy.signal
 from time import sleep
+import time
 import os
 import sys
+import json
+import shutil
+import socket
+import subprocess
 from absl import flags
 from absl.flags import FLAGS
 
@@ -27,11 +38,26 @@ from pysc2.lib import actions
 from pysc2.maps import mini_games
 from pysc2.lib import features
 import SC2Definitions
+import SC2Placement
+import FakeSC2Env
+import TrajectoryStore
 
 _UNIT_TYPE = features.SCREEN_FEATURES.unit_type.index
 _PLAYER_RELATIVE = features.SCREEN_FEATURES.player_relative.index
 _ENEMY = 4
 _SELECT_SIZE = 7
+_SELECT_STATS = [2, 3, 4] # health, shields and energy columns of a unit in single_select/multi_select/cargo
+_SELECT_ENCODINGS = ['padded', 'summary']
+_SUMMARIZED_FEATURES = ['cargo', 'multi_select']
+_SYNC_STRATEGIES = ['full', 'versioned', 'shared']
+_LOSS_MODES = ['dense', 'sparse']
+_ROLLOUT_MODES = ['overlap', 'nstep']
+_NO_OP = 0 # no_op function id
+# Functions that act once per call, eg. queue a unit or change the selection; with action repeat their follow-ups are no-ops
+_SINGLE_SHOT_PREFIXES = ('select_', 'Build_', 'Train_', 'Research_', 'Morph_', 'Cancel_', 'Effect_', 'Load_', 'Unload_', 'Land_', 'Lift_')
+
+# Location of a named field inside the nonspatial observation vector
+NonspatialField = collections.namedtuple('NonspatialField', ['offset', 'length', 'shape'])
 
 """
 Use the following command to launch Tensorboard:
@@ -52,10 +78,156 @@ def update_target_graph(from_scope,to_scope):
 	return op_holder
 
 
+# Checks that a checkpoint was written by a model with the same observation encoding.
+# Checkpoints written before the encoding was recorded are accepted as they are.
+def check_model_config(checkpoint_path, agent_model):
+	reader = tf.train.NewCheckpointReader(checkpoint_path)
+	if not reader.has_tensor('agent_model_config'):
+		return
+	saved_config = reader.get_tensor('agent_model_config')
+	if isinstance(saved_config, bytes):
+		saved_config = saved_config.decode()
+	if saved_config != agent_model.encoding_config():
+		raise ValueError("Checkpoint {0} was written with encoding '{1}' but the agent model uses '{2}'.".format(checkpoint_path, saved_config, agent_model.encoding_config()))
+
+
 # Discounting function used to calculate discounted returns.
 def discount(x, gamma):
 	return scipy.signal.lfilter([1], [1, -gamma], x[::-1], axis=0)[::-1]
 
+# V-trace value targets and policy gradient advantages for one trajectory segment, as described in [3] Section 4.
+# log_rhos are the log ratios of the target and behaviour policy probabilities of the actions taken.
+def vtrace(rewards, values, bootstrap_value, log_rhos, gamma, rho_bar = 1.0, c_bar = 1.0):
+	rhos = np.exp(log_rhos)
+	clipped_rhos = np.minimum(rho_bar, rhos)
+	cs = np.minimum(c_bar, rhos)
+	values_plus = np.append(values, bootstrap_value)
+	deltas = clipped_rhos * (rewards + gamma * values_plus[1:] - values)
+	vs_minus_values = np.zeros(len(rewards), dtype=np.float32)
+	accumulated = 0.
+	for t in reversed(range(len(rewards))):
+		accumulated = deltas[t] + gamma * cs[t] * accumulated
+		vs_minus_values[t] = accumulated
+	vs = values + vs_minus_values
+	vs_plus = np.append(vs, bootstrap_value)
+	advantages = clipped_rhos * (rewards + gamma * vs_plus[1:] - values)
+	return vs, advantages
+
+# n-step returns of one trajectory segment and their advantages, in a single backward pass.
+# Same as the discount-based computation of build_feed_dict: GAE with lambda = 1 telescopes to the return minus the value.
+def nstep_returns(rewards, values, bootstrap_value, gamma):
+	returns = np.empty(len(rewards), dtype=np.float32)
+	accumulated = bootstrap_value
+	for t in reversed(range(len(rewards))):
+		accumulated = rewards[t] + gamma * accumulated
+		returns[t] = accumulated
+	return returns, returns - values
+
+# Updates the training statistics shared by all workers after an episode and prints them.
+def record_episode(name, number, episode_count, total_steps, episode_reward):
+	global _max_score, _running_avg_score, _episodes, _steps
+	if _max_score < episode_reward:
+		_max_score = episode_reward
+	_running_avg_score += (episode_reward - _running_avg_score)/(episode_count if episode_count > 0 else 1)
+	_episodes[number] = episode_count
+	_steps[number] = total_steps
+	print("{} Step #{} Episode #{} Reward: {}".format(name, total_steps, episode_count, episode_reward))
+	print("Total Steps: {}\tTotal Episodes: {}\tMax Score: {}\tAvg Score: {}".format(np.sum(_steps), np.sum(_episodes), _max_score, _running_avg_score))
+
+# Samples a base action and its arguments with the network's in-graph sampling ops and estimates the state value, in a single run.
+# If log_probs is set, also returns the log probabilities of the sampled base action and of every sampled argument.
+def sample_action(sess, network, screen_stack, minimap_stack, nonspatial_stack, available_actions, log_probs = False):
+	results = sample_actions(sess, network, screen_stack, minimap_stack, nonspatial_stack, [available_actions], log_probs)
+	base_action, arg_sample, v = results[:3]
+	per_arg = [arg_sample] + results[4:]
+	for arg_values in per_arg:
+		for arg in arg_values:
+			for dim in arg_values[arg]:
+				arg_values[arg][dim] = arg_values[arg][dim][0]
+	if log_probs:
+		return base_action[0], arg_sample, v, results[3][0], results[4]
+	return base_action[0], arg_sample, v
+
+# Batched version of sample_action: one row of base action, arguments and value per row of the inputs.
+def sample_actions(sess, network, screen_stacks, minimap_stacks, nonspatial_stacks, available_actions, log_probs = False):
+	fetches = [network.sample_base_action, network.sample_arg, network.value]
+	if log_probs:
+		fetches += [network.sample_log_prob_base, network.sample_log_prob_arg]
+	return sess.run(fetches,
+	                feed_dict={network.inputs_spatial_screen: screen_stacks,
+	                           network.inputs_spatial_minimap: minimap_stacks,
+	                           network.inputs_nonspatial: nonspatial_stacks,
+	                           network.available_actions: available_actions})
+
+# Log probability of a sampled action: that of its base action plus those of the arguments it uses.
+# Arguments set to -1 by build_function_call are not part of the action.
+def action_log_prob(base_log_prob, arg_log_probs, arg_sample):
+	log_prob = base_log_prob
+	for arg_name, arg in arg_sample.items():
+		for dim, value in arg.items():
+			if value >= 0:
+				log_prob += arg_log_probs[arg_name][dim]
+	return log_prob
+
+# Builds the FunctionCall for a sampled base action and its arguments.
+# Arguments the chosen function does not take are set to -1 in arg_sample so that they won't be updated in the training
+# (see documentation for tf.one_hot).
+def build_function_call(agent_model, base_action, arg_sample):
+	arguments = []
+	chosen_action = agent_model.get_action(base_action)
+	for arg in chosen_action.args:
+		arg_value = []
+		for dim, size in enumerate(arg.sizes):
+			arg_value.append(arg_sample[arg.name][dim])
+		arguments.append(arg_value)
+	chosen_args = [arg.name for arg in chosen_action.args]
+	for arg_name, arg in arg_sample.items():
+		if arg_name not in chosen_args:
+			for dim in arg:
+				arg_sample[arg_name][dim] = -1
+	return actions.FunctionCall(chosen_action.id, arguments), arguments
+
+# Steps env with function_call then, unless the episode ends first, with its follow-up for action_repeat - 1 more steps.
+# The follow-up repeats function_call, or is a no-op for single-shot functions and functions that are no longer available.
+# Returns the last TimeStep with the rewards of all the steps summed, and the number of steps taken.
+def step_repeated(env, function_call, action_repeat):
+	obs = env.step(actions=[function_call])[0]
+	reward = obs.reward
+	steps = 1
+	follow_up = function_call
+	if actions.FUNCTIONS[function_call.function].name.startswith(_SINGLE_SHOT_PREFIXES):
+		follow_up = actions.FunctionCall(_NO_OP, [])
+	while steps < action_repeat and obs.step_type != environment.StepType.LAST:
+		if follow_up.function not in obs.observation['available_actions']:
+			follow_up = actions.FunctionCall(_NO_OP, [])
+		obs = env.step(actions=[follow_up])[0]
+		reward += obs.reward
+		steps += 1
+	return obs._replace(reward=reward), steps
+
+# Pins the calling thread to cpus, then creates the environment, whose game process and threads inherit the affinity.
+# The calling thread stays on cpus: an actor process moves itself to the actor cores afterwards.
+def make_env_on_cpus(env_fn, cpus):
+	SC2Placement.pin_current_thread(cpus)
+	return env_fn()
+
+# Returns a picklable callable that creates the environment of a worker or actor: an SC2Env, or a FakeSC2Env
+# (no StarCraft II needed) if fake_env is set. If env_cpus is set, the environment is created on those cpus wherever
+# the callable is called.
+def make_env_fn(map_name, agent_model, seed = None, fake_env = False, fake_env_latency = 0., fake_env_episode_length = 300, env_cpus = None):
+	env_kwargs = {'map_name': map_name,
+	              'screen_size_px': (agent_model.screen_size,agent_model.screen_size),
+	              'minimap_size_px': (agent_model.minimap_size,agent_model.minimap_size)}
+	if seed is not None:
+		env_kwargs['random_seed'] = seed
+	if fake_env:
+		env_fn = functools.partial(FakeSC2Env.FakeSC2Env, step_latency=fake_env_latency, episode_length=fake_env_episode_length, **env_kwargs)
+	else:
+		env_fn = functools.partial(sc2_env.SC2Env, **env_kwargs)
+	if env_cpus is not None:
+		return functools.partial(make_env_on_cpus, env_fn, env_cpus)
+	return env_fn
+
 # Used to initialize weights for policy and value output layers
 def normalized_columns_initializer(std=1.0):
 	def _initializer(shape, dtype=None, partition_info=None):
@@ -72,7 +244,7 @@ def sample_dist(dist):
 
 # Structure data of AC Netowirk based on race of player
 class AgentModel:
-    def __init__(self, race = 'T', is_training = False, screen_size = 128, minimap_size=128, max_episodes_kept = 50, save_increment = 100, agent_model = None):
+    def __init__(self, race = 'T', is_training = False, screen_size = 128, minimap_size=128, max_episodes_kept = 50, save_increment = 100, vectorized_encoder = True, select_encoding = 'padded', max_selected = 500, compact_spatial = False, normalize_spatial = False, loss_mode = 'dense', rollout_mode = 'overlap', action_repeat = 1, entropy_beta = 0.01, gradient_clip = 40.0, agent_model = None):
         if agent_model != None and isinstance(agent_model, AgentModel):
                 self.screen_size = agent_model.screen_size
                 self.save_increment = agent_model.save_increment
@@ -80,6 +252,16 @@ class AgentModel:
                 self.minimap_size = agent_model.minimap_size
                 self.is_training = agent_model.is_training
                 self.race = agent_model.race
+                self.vectorized_encoder = agent_model.vectorized_encoder
+                self.select_encoding = agent_model.select_encoding
+                self.max_selected = agent_model.max_selected
+                self.compact_spatial = agent_model.compact_spatial
+                self.normalize_spatial = agent_model.normalize_spatial
+                self.loss_mode = agent_model.loss_mode
+                self.rollout_mode = agent_model.rollout_mode
+                self.action_repeat = agent_model.action_repeat
+                self.entropy_beta = agent_model.entropy_beta
+                self.gradient_clip = agent_model.gradient_clip
         else:
                 if race not in sc2_env.races.keys():
                         raise ValueError("Invalid race selected: {0}.\n Race must be one of {1}.".format(race, sc2_env.races.keys()))
@@ -89,17 +271,79 @@ class AgentModel:
                 self.minimap_size = minimap_size
                 self.is_training = is_training
                 self.race = race
+                self.vectorized_encoder = vectorized_encoder
+                if select_encoding not in _SELECT_ENCODINGS:
+                        raise ValueError("Invalid select encoding: {0}.\n Encoding must be one of {1}.".format(select_encoding, _SELECT_ENCODINGS))
+                self.select_encoding = select_encoding
+                self.max_selected = max_selected
+                self.compact_spatial = compact_spatial
+                self.normalize_spatial = normalize_spatial
+                #How AC_Network's policy loss treats the argument heads; see AC_Network
+                if loss_mode not in _LOSS_MODES:
+                        raise ValueError("Invalid loss mode: {0}.\n Loss mode must be one of {1}.".format(loss_mode, _LOSS_MODES))
+                self.loss_mode = loss_mode
+                #Whether a full rollout keeps its last half for the next update ('overlap'), or every step is trained on once ('nstep')
+                if rollout_mode not in _ROLLOUT_MODES:
+                        raise ValueError("Invalid rollout mode: {0}.\n Rollout mode must be one of {1}.".format(rollout_mode, _ROLLOUT_MODES))
+                self.rollout_mode = rollout_mode
+                #Environment steps per decision; only the last observation of a decision is encoded and stored
+                if action_repeat < 1:
+                        raise ValueError("Invalid action repeat: {0}.\n Action repeat must be at least 1.".format(action_repeat))
+                self.action_repeat = action_repeat
+                #Weight of the entropy bonus in the loss and global norm the gradients are clipped to
+                self.entropy_beta = entropy_beta
+                self.gradient_clip = gradient_clip
         self.screen_channels = len(features.SCREEN_FEATURES)
         self.minimap_channels = len(features.MINIMAP_FEATURES)
-        self.variable_features = {'cargo': 500, 'multi_select': 500, 'build_queue': 10, 'single_select': 1}
+        self.setup_spatial_encoding()
+        self.variable_features = {'cargo': self.max_selected, 'multi_select': self.max_selected, 'build_queue': 10, 'single_select': 1}
+        self.setup_select_encoding()
         self.setup_actions()
         self.reset()
         self.nonspatial_size = self.calculate_nonspatial_size()
+        self.nonspatial_layout = self.compile_nonspatial_layout()
+        layout_size = sum(field.length for field in self.nonspatial_layout.values())
+        if layout_size != self.nonspatial_size:
+                raise ValueError("Nonspatial layout covers {0} values but nonspatial_size is {1}.".format(layout_size, self.nonspatial_size))
+        #Reused output buffer of process_observation
+        self.nonspatial_buffer = np.zeros((1, self.nonspatial_size))
+
+    def setup_select_encoding(self):
+        #In 'summary' mode, cargo and multi_select are encoded as unit counts per unit type plus health/shields/energy statistics
+        #instead of being padded to max_selected units
+        self.summarized_features = _SUMMARIZED_FEATURES if self.select_encoding == 'summary' else []
+        #Unit types of the race get their own counter, every other unit type shares the last one
+        select_unit_types = sorted(set(SC2Definitions.UNITS[self.race].values()))
+        self.select_type_count = len(select_unit_types) + 1
+        self.select_type_lookup = np.full(SC2Definitions.UNIT_TYPES + 1, len(select_unit_types), dtype=np.int64)
+        self.select_type_lookup[select_unit_types] = np.arange(len(select_unit_types))
+        #Unit count, per-type counts, then mean/min/max of each statistic
+        self.select_summary_size = 1 + self.select_type_count + 3 * len(_SELECT_STATS)
+
+    def setup_spatial_encoding(self):
+        #With compact_spatial, screen and minimap stacks keep the smallest unsigned integer dtype that holds every layer
+        #and AC_Network casts them to float32 inside the graph
+        if self.compact_spatial:
+            self.screen_dtype = np.min_scalar_type(max(layer.scale for layer in features.SCREEN_FEATURES) - 1)
+            self.minimap_dtype = np.min_scalar_type(max(layer.scale for layer in features.MINIMAP_FEATURES) - 1)
+        else:
+            self.screen_dtype = np.dtype(np.float32)
+            self.minimap_dtype = np.dtype(np.float32)
+        #Per-layer multipliers applied in the graph after the cast; with normalize_spatial every layer is divided by its scale
+        if self.normalize_spatial:
+            self.screen_scale = np.array([1. / layer.scale for layer in features.SCREEN_FEATURES], dtype=np.float32)
+            self.minimap_scale = np.array([1. / layer.scale for layer in features.MINIMAP_FEATURES], dtype=np.float32)
+        else:
+            self.screen_scale = np.ones(self.screen_channels, dtype=np.float32)
+            self.minimap_scale = np.ones(self.minimap_channels, dtype=np.float32)
+
+    def encoding_config(self):
+        #Description of the observation encoding, stored with checkpoints so they are only restored into a matching model
+        return 'select_encoding={0},max_selected={1},normalize_spatial={2},nonspatial_size={3}'.format(self.select_encoding, self.max_selected, self.normalize_spatial, self.nonspatial_size)
 
     def setup_actions(self):
-        if len(SC2Definitions.ACTIONS[self.race]) < 1 or len(SC2Definitions.ACTIONS['N']) < 1:
-            print('Classifying actions based on race...')
-            SC2Definitions.classify_actions()
+        #Classified once per process, or read from the on-disk definitions cache
+        SC2Definitions.load_actions()
         self.general_actions = list(SC2Definitions.ACTIONS['N'])
         #Limit actions based on race
         self.race_actions = list(SC2Definitions.ACTIONS[self.race])
@@ -112,6 +356,9 @@ class AgentModel:
         #Create arrays counting how many times actions were used
         self.used_actions = {'N':np.zeros(len(self.general_actions)), self.race:np.zeros(len(self.race_actions))}
         self.action_count = len(self.general_actions)+len(self.race_actions)
+        #Lookup tables for the vectorized encoder: function id of each action index, and a scratch table indexed by function id
+        self.action_ids = np.array(self.general_actions + self.race_actions, dtype=np.int64)
+        self.available_lookup = np.zeros(len(actions.FUNCTIONS), dtype=bool)
         
         
     def reset(self):
@@ -121,48 +368,132 @@ class AgentModel:
         self.max_units_seen = np.zeros(SC2Definitions.UNIT_TYPES)
         self.used_actions = {'N':np.zeros(len(self.general_actions)), self.race:np.zeros(len(self.race_actions))}
         
-    def process_observation(self, observation):
-        #Update units seen
+    def update_units_seen(self, screen):
+        #Count enemy units per unit type over the whole screen and decay the maximums seen so far
+        unit_type = screen[_UNIT_TYPE]
+        enemy = (screen[_PLAYER_RELATIVE] == _ENEMY) & (unit_type < SC2Definitions.UNIT_TYPES)
+        enemy_unit_types = np.bincount(unit_type[enemy], minlength=self.max_units_seen.size)
+        np.maximum(self.max_units_seen[1:]*3/4, enemy_unit_types[1:], out=self.max_units_seen[1:])
+
+    def update_units_seen_reference(self, screen):
+        #Reference implementation of update_units_seen, kept for parity checks
         enemy_unit_types = np.zeros(self.max_units_seen.size)
-        for i in range(observation.observation['screen'].shape[0]):
-            for j in range(observation.observation['screen'].shape[1]):
-                if observation.observation['screen'][_PLAYER_RELATIVE, i, j] == _ENEMY and observation.observation['screen'][_UNIT_TYPE, i, j] < SC2Definitions.UNIT_TYPES:
-                    enemy_unit_types[observation.observation['screen'][_UNIT_TYPE, i, j]] += 1
+        for i in range(screen.shape[1]):
+            for j in range(screen.shape[2]):
+                if screen[_PLAYER_RELATIVE, i, j] == _ENEMY and screen[_UNIT_TYPE, i, j] < SC2Definitions.UNIT_TYPES:
+                    enemy_unit_types[screen[_UNIT_TYPE, i, j]] += 1
         for i in range(1, SC2Definitions.UNIT_TYPES):
             self.max_units_seen[i] = max(self.max_units_seen[i]*3/4, enemy_unit_types[i])
-        #Process usable actions
+
+    def available_action_mask(self, available_ids):
+        #Mark the available function ids in the scratch table, read it back per action index, then clear it again
+        self.available_lookup[available_ids] = True
+        available_actions = self.available_lookup[self.action_ids].astype(np.float64)
+        self.available_lookup[available_ids] = False
+        return available_actions
+
+    def available_action_mask_reference(self, available_ids):
+        #Reference implementation of available_action_mask, kept for parity checks
         available_actions = np.zeros(self.action_count)
         for i in range(self.action_count):
-                if (self.get_action(i).id in observation.observation['available_actions']):
+                if (self.get_action(i).id in available_ids):
                         available_actions[i] = 1
+        return available_actions
+
+    def process_observation(self, observation):
+        #Update units seen and process usable actions
+        if self.vectorized_encoder:
+            self.update_units_seen(observation.observation['screen'])
+            available_actions = self.available_action_mask(observation.observation['available_actions'])
+        else:
+            self.update_units_seen_reference(observation.observation['screen'])
+            available_actions = self.available_action_mask_reference(observation.observation['available_actions'])
+        #Kept for masking the base action distribution
+        self.available_actions_mask = available_actions
         # is episode over?
         episode_end = (observation.step_type == environment.StepType.LAST)
 	# reward
         reward = observation.reward
 	# features
         features = observation.observation
-        spatial_features = ['minimap', 'screen']
-        variable_features = ['cargo', 'multi_select', 'build_queue']
-        # the shapes of some features depend on the state (eg. shape of multi_select depends on number of units)
-        # since tf requires fixed input shapes, we set a maximum size then pad the input if it falls short
-        max_no = {'cargo': 500, 'multi_select': 500, 'build_queue': 10}
-        nonspatial_stack = np.concatenate(((self.max_units_seen,self.used_actions['N'],self.used_actions[self.race], available_actions, [self.last_action_used])))
-        for feature_label, feature in observation.observation.items():
-       	        if feature_label not in spatial_features + variable_features + ['available_actions']:
-                        nonspatial_stack = np.concatenate((nonspatial_stack, feature.reshape(-1)))
-       	        elif feature_label in variable_features:
-                        padded_feature = np.concatenate((feature.reshape(-1), np.zeros(max_no[feature_label] * _SELECT_SIZE - len(feature.reshape(-1)))))
-                        nonspatial_stack = np.concatenate((nonspatial_stack, padded_feature))
-
-        nonspatial_stack = np.expand_dims(nonspatial_stack, axis=0)
+        if self.vectorized_encoder:
+            nonspatial_stack = self.encode_nonspatial(features, available_actions)
+        else:
+            nonspatial_stack = self.encode_nonspatial_reference(features, available_actions)
         # spatial_minimap features
-        minimap_stack = np.expand_dims(np.stack(features['minimap'], axis=2), axis=0)
+        minimap_stack = np.expand_dims(np.moveaxis(features['minimap'], 0, 2).astype(self.minimap_dtype), axis=0)
         # spatial_screen features
-        screen_stack = np.expand_dims(np.stack(features['screen'], axis=2), axis=0)
+        screen_stack = np.expand_dims(np.moveaxis(features['screen'], 0, 2).astype(self.screen_dtype), axis=0)
         # is episode over?
         episode_end = observation.step_type == environment.StepType.LAST
         return reward, nonspatial_stack, minimap_stack, screen_stack, episode_end
 
+    def encode_nonspatial(self, features, available_actions):
+        #Write every field into its slice of the reused buffer; the returned array is overwritten by the next call
+        buffer = self.nonspatial_buffer[0]
+        layout = self.nonspatial_layout
+        buffer[self.nonspatial_slices['max_units_seen']] = self.max_units_seen
+        buffer[self.nonspatial_slices['used_actions_N']] = self.used_actions['N']
+        buffer[self.nonspatial_slices['used_actions_' + self.race]] = self.used_actions[self.race]
+        buffer[self.nonspatial_slices['available_actions']] = available_actions
+        buffer[layout['last_action_used'].offset] = self.last_action_used
+        for feature_label in self.observation_labels:
+                field = layout[feature_label]
+                if feature_label not in features:
+                        buffer[self.nonspatial_slices[feature_label]] = 0
+                        continue
+                feature = features[feature_label].reshape(-1)
+                if feature_label in self.summarized_features:
+                        buffer[self.nonspatial_slices[feature_label]] = self.summarize_units(features[feature_label])
+                elif feature_label in self.variable_features:
+                        # the shapes of some features depend on the state (eg. shape of multi_select depends on number of units)
+                        # since tf requires fixed input shapes, we set a maximum size then pad the input if it falls short
+                        used = min(feature.size, field.length)
+                        buffer[field.offset:field.offset + used] = feature[:used]
+                        buffer[field.offset + used:field.offset + field.length] = 0
+                else:
+                        buffer[self.nonspatial_slices[feature_label]] = feature
+        return self.nonspatial_buffer
+
+    def encode_nonspatial_reference(self, features, available_actions):
+        #Reference implementation of encode_nonspatial, kept for parity checks
+        nonspatial_stack = np.concatenate(((self.max_units_seen,self.used_actions['N'],self.used_actions[self.race], available_actions, [self.last_action_used])))
+        for feature_label in self.observation_labels:
+                feature = features[feature_label]
+                if feature_label in self.summarized_features:
+                        nonspatial_stack = np.concatenate((nonspatial_stack, self.summarize_units(feature)))
+                elif feature_label in self.variable_features:
+                        padded_feature = np.concatenate((feature.reshape(-1), np.zeros(self.variable_features[feature_label] * _SELECT_SIZE - len(feature.reshape(-1)))))
+                        nonspatial_stack = np.concatenate((nonspatial_stack, padded_feature))
+                else:
+                        nonspatial_stack = np.concatenate((nonspatial_stack, feature.reshape(-1)))
+        return np.expand_dims(nonspatial_stack, axis=0)
+
+    def summarize_units(self, units):
+        #Compact encoding of a variable-length list of units, of which at most max_selected are counted
+        summary = np.zeros(self.select_summary_size)
+        units = units[:self.max_selected]
+        if len(units) == 0:
+                return summary
+        summary[0] = len(units)
+        type_index = self.select_type_lookup[np.minimum(units[:, 0], SC2Definitions.UNIT_TYPES)]
+        summary[1:1 + self.select_type_count] = np.bincount(type_index, minlength=self.select_type_count)
+        stats = units[:, _SELECT_STATS]
+        offset = 1 + self.select_type_count
+        summary[offset:offset + len(_SELECT_STATS)] = stats.mean(axis=0)
+        summary[offset + len(_SELECT_STATS):offset + 2 * len(_SELECT_STATS)] = stats.min(axis=0)
+        summary[offset + 2 * len(_SELECT_STATS):] = stats.max(axis=0)
+        return summary
+
+    def decode_nonspatial(self, nonspatial):
+        #Split a nonspatial vector, or a batch of them, back into its named fields
+        nonspatial = np.asarray(nonspatial)
+        batch_shape = nonspatial.shape[:-1]
+        decoded = collections.OrderedDict()
+        for label, field in self.nonspatial_layout.items():
+                decoded[label] = nonspatial[..., field.offset:field.offset + field.length].reshape(batch_shape + field.shape)
+        return decoded
+
     def get_action(self, action_index):
         if action_index < len(self.general_actions):
             return actions.FUNCTIONS[self.general_actions[action_index]]
@@ -188,35 +519,80 @@ class AgentModel:
         #Increase size by number of unit types for enemies seen
         size += self.max_units_seen.size + 1 # +1 for last action used
         #Increase size by nonspatial structured observation data:
-        nonspatial_features = features.Features(screen_size_px=(self.screen_size,self.screen_size), minimap_size_px=(self.minimap_size,self.minimap_size)).observation_spec()
-        del nonspatial_features['minimap']
-        del nonspatial_features['screen']
+        nonspatial_features = self.nonspatial_spec()
         for feature_label, feature in nonspatial_features.items():
-                if feature_label in self.variable_features:
+                if feature_label in self.summarized_features:
+                        size += self.select_summary_size
+                elif feature_label in self.variable_features:
                         size += self.variable_features[feature_label] * feature[1]
                 else:
                         size += np.prod(feature)
         return size
 
+    def nonspatial_spec(self):
+        #Shapes of the structured (non screen/minimap) observations, in observation spec order
+        nonspatial_features = SC2Definitions.observation_spec(self.screen_size, self.minimap_size)
+        del nonspatial_features['minimap']
+        del nonspatial_features['screen']
+        return nonspatial_features
+
+    def compile_nonspatial_layout(self):
+        #Offset, length and shape of every named field of the nonspatial vector, in the order it is written
+        fields = [('max_units_seen', self.max_units_seen.shape),
+                  ('used_actions_N', (len(self.general_actions),)),
+                  ('used_actions_' + self.race, (len(self.race_actions),)),
+                  ('available_actions', (self.action_count,)),
+                  ('last_action_used', (1,))]
+        self.observation_labels = []
+        for feature_label, feature in self.nonspatial_spec().items():
+                if feature_label == 'available_actions':
+                        continue
+                if feature_label in self.summarized_features:
+                        feature = (self.select_summary_size,)
+                elif feature_label in self.variable_features:
+                        feature = (self.variable_features[feature_label], feature[1])
+                fields.append((feature_label, tuple(feature)))
+                self.observation_labels.append(feature_label)
+        layout = collections.OrderedDict()
+        self.nonspatial_slices = dict()
+        offset = 0
+        for label, shape in fields:
+                length = int(np.prod(shape))
+                layout[label] = NonspatialField(offset, length, tuple(shape))
+                self.nonspatial_slices[label] = slice(offset, offset + length)
+                offset += length
+        return layout
+
 
 
 
 ## ACTOR-CRITIC NETWORK
 
 class AC_Network():
-	def __init__(self, scope, trainer, agent_model = None):#action_spec, observation_spec):
-		with tf.variable_scope(scope):
+	def __init__(self, scope, trainer, agent_model = None, share_global = False):#action_spec, observation_spec):
+		# With share_global, the network creates no variables of its own and uses those of the global network instead
+		variable_scope = 'global' if share_global else scope
+		def global_getter(getter, name, *args, **kwargs):
+			kwargs['reuse'] = True
+			return getter('global' + name[len(scope):], *args, **kwargs)
+		with tf.variable_scope(scope, custom_getter=global_getter if share_global else None):
                         self.model = agent_model
 			# Architecture here follows Atari-net Agent described in [1] Section 4.3
                         self.inputs_nonspatial = tf.placeholder(shape=[None,self.model.nonspatial_size], dtype=tf.float32)
-                        self.inputs_spatial_screen = tf.placeholder(shape=[None,self.model.screen_size,self.model.screen_size,self.model.screen_channels], dtype=tf.float32)
-                        self.inputs_spatial_minimap = tf.placeholder(shape=[None,self.model.minimap_size,self.model.minimap_size,self.model.minimap_channels], dtype=tf.float32)
+                        self.inputs_spatial_screen = tf.placeholder(shape=[None,self.model.screen_size,self.model.screen_size,self.model.screen_channels], dtype=tf.as_dtype(self.model.screen_dtype))
+                        self.inputs_spatial_minimap = tf.placeholder(shape=[None,self.model.minimap_size,self.model.minimap_size,self.model.minimap_channels], dtype=tf.as_dtype(self.model.minimap_dtype))
+			# Spatial observations may be fed in their compact integer dtypes; decode them to float32 here
+                        self.spatial_screen = tf.cast(self.inputs_spatial_screen, tf.float32)
+                        self.spatial_minimap = tf.cast(self.inputs_spatial_minimap, tf.float32)
+                        if self.model.normalize_spatial:
+                                self.spatial_screen = self.spatial_screen * self.model.screen_scale
+                                self.spatial_minimap = self.spatial_minimap * self.model.minimap_scale
                         self.nonspatial_dense = tf.layers.dense(
                                 inputs=self.inputs_nonspatial,
                                 units=32,
                                 activation=tf.tanh)
                         self.screen_conv1 = tf.layers.conv2d(
-                                inputs=self.inputs_spatial_screen,
+                                inputs=self.spatial_screen,
                                 filters=16,
                                 kernel_size=[8,8],
                                 strides=[4,4],
@@ -230,7 +606,7 @@ class AC_Network():
                                 padding='valid',
                                 activation=tf.nn.relu)
                         self.minimap_conv1 = tf.layers.conv2d(
-                                inputs=self.inputs_spatial_minimap,
+                                inputs=self.spatial_minimap,
                                 filters=16,
                                 kernel_size=[8,8],
                                 strides=[4,4],
@@ -289,131 +665,443 @@ class AC_Network():
                                 units=1,
                                 kernel_initializer=normalized_columns_initializer(1.0))
 
-			# Only the worker network need ops for loss functions and gradient updating.
-                        if scope != 'global':
+			# In-graph action selection, so that a single run returns the sampled base action, every sampled argument and the value
+			# Unavailable base actions are masked out of the logits, which is equivalent to zeroing and renormalizing their probabilities
+                        self.available_actions = tf.placeholder(shape=[None,self.model.action_count], dtype=tf.float32)
+                        masked_logits_base = tf.log(tf.clip_by_value(self.policy_base_actions, 1e-20, 1.0)) - 1e9 * (1. - self.available_actions)
+                        self.sample_base_action = tf.squeeze(tf.multinomial(masked_logits_base, 1), axis=[1])
+                        self.sample_arg = dict()
+                        for arg in actions.TYPES:
+                                self.sample_arg[arg.name] = dict()
+                                for dim, size in enumerate(arg.sizes):
+                                        self.sample_arg[arg.name][dim] = tf.squeeze(tf.multinomial(tf.log(tf.clip_by_value(self.policy_arg[arg.name][dim], 1e-20, 1.0)), 1), axis=[1])
+			# Log probabilities of the samples under the unmasked policy, as in the loss; recorded as behaviour policy for V-trace
+                        def sampled_log_prob(policy, sample):
+                                return tf.log(tf.clip_by_value(tf.reduce_sum(policy * tf.one_hot(sample, policy.get_shape().as_list()[1]), [1]), 1e-20, 1.0))
+                        self.sample_log_prob_base = sampled_log_prob(self.policy_base_actions, self.sample_base_action)
+                        self.sample_log_prob_arg = dict()
+                        for arg in actions.TYPES:
+                                self.sample_log_prob_arg[arg.name] = dict()
+                                for dim, size in enumerate(arg.sizes):
+                                        self.sample_log_prob_arg[arg.name][dim] = sampled_log_prob(self.policy_arg[arg.name][dim], self.sample_arg[arg.name][dim])
+
+			# Only the worker network need ops for loss functions and gradient updating, and only when training.
+                        if scope != 'global' and trainer is not None and self.model.is_training:
                                 self.actions_base = tf.placeholder(shape=[None],dtype=tf.int32)
-                                self.actions_onehot_base = tf.one_hot(self.actions_base,self.model.action_count,dtype=tf.float32)
                                 self.actions_arg = dict()
-                                self.actions_onehot_arg = dict()
                                 for arg in actions.TYPES:
                                         self.actions_arg[arg.name] = dict()
-                                        self.actions_onehot_arg[arg.name] = dict()
                                         for dim, size in enumerate(arg.sizes):
-                                                processed_size = size
-                                                if size == 0:
-                                                        processed_size = 1
-                                                        if arg.name == 'screen' or arg.name == 'screen2':
-                                                                processed_size = self.model.screen_size
-                                                        elif arg.name == 'minimap':
-                                                                processed_size = self.model.minimap_size
                                                 self.actions_arg[arg.name][dim] = tf.placeholder(shape=[None],dtype=tf.int32)
-                                                self.actions_onehot_arg[arg.name][dim] = tf.one_hot(self.actions_arg[arg.name][dim],processed_size,dtype=tf.float32)
 
                                 self.target_v = tf.placeholder(shape=[None],dtype=tf.float32)
                                 self.advantages = tf.placeholder(shape=[None],dtype=tf.float32)
-                                self.responsible_outputs_base = tf.reduce_sum(self.policy_base_actions * self.actions_onehot_base, [1])
-                                self.responsible_outputs_arg = dict()
-                                for arg in actions.TYPES:
-                                        self.responsible_outputs_arg[arg.name] = dict()
-                                        for dim, size in enumerate(arg.sizes):
-                                                self.responsible_outputs_arg[arg.name][dim] = tf.reduce_sum(self.policy_arg[arg.name][dim] * self.actions_onehot_arg[arg.name][dim], [1])
-
-				# Loss functions
                                 self.value_loss = 0.5 * tf.reduce_sum(tf.square(self.target_v - tf.reshape(self.value,[-1])))
                                 self.entropy_base = - tf.reduce_sum(self.policy_base_actions * tf.log(tf.clip_by_value(self.policy_base_actions, 1e-20, 1.0))) # avoid NaN with clipping when value in policy becomes zero
                                 self.entropy_arg = dict()
-                                for arg in actions.TYPES:
-                                        self.entropy_arg[arg.name] = dict()
-                                        for dim, size in enumerate(arg.sizes):
-                                                self.entropy_arg[arg.name][dim] = - tf.reduce_sum(self.policy_arg[arg.name][dim] * tf.log(tf.clip_by_value(self.policy_arg[arg.name][dim], 1e-20, 1.)))
+                                self.policy_loss_arg = dict()
+                                if self.model.loss_mode == 'sparse':
+				# Only the rows of an argument head whose action uses the argument are gathered, and its log-prob and entropy
+				# are computed on those rows alone. The policy gradients are the same as the dense loss, whose unused rows get
+				# a zero one-hot and so a constant (clipped) log-prob; the entropy of unused heads is left out.
+                                        batch_indices = tf.range(tf.shape(self.actions_base)[0])
+                                        self.responsible_outputs_base = tf.gather_nd(self.policy_base_actions, tf.stack([batch_indices, self.actions_base], axis=1))
+                                        self.log_prob_actions = tf.log(tf.clip_by_value(self.responsible_outputs_base, 1e-20, 1.0))
+                                        self.policy_loss_base = - tf.reduce_sum(self.log_prob_actions * self.advantages)
+                                        for arg in actions.TYPES:
+                                                self.entropy_arg[arg.name] = dict()
+                                                self.policy_loss_arg[arg.name] = dict()
+                                                for dim, size in enumerate(arg.sizes):
+                                                        used_rows = tf.where(self.actions_arg[arg.name][dim] >= 0)[:,0]
+                                                        used_policy = tf.gather(self.policy_arg[arg.name][dim], used_rows)
+                                                        used_actions = tf.gather(self.actions_arg[arg.name][dim], used_rows)
+                                                        used_log_prob = tf.log(tf.clip_by_value(tf.gather_nd(used_policy, tf.stack([tf.range(tf.shape(used_actions)[0]), used_actions], axis=1)), 1e-20, 1.0))
+                                                        self.log_prob_actions += tf.scatter_nd(tf.expand_dims(used_rows, 1), used_log_prob, tf.shape(self.actions_base, out_type=tf.int64))
+                                                        self.policy_loss_arg[arg.name][dim] = - tf.reduce_sum(used_log_prob * tf.gather(self.advantages, used_rows))
+                                                        self.entropy_arg[arg.name][dim] = - tf.reduce_sum(used_policy * tf.log(tf.clip_by_value(used_policy, 1e-20, 1.)))
+                                else:
+                                        self.actions_onehot_base = tf.one_hot(self.actions_base,self.model.action_count,dtype=tf.float32)
+                                        self.actions_onehot_arg = dict()
+                                        for arg in actions.TYPES:
+                                                self.actions_onehot_arg[arg.name] = dict()
+                                                for dim, size in enumerate(arg.sizes):
+                                                        processed_size = self.policy_arg[arg.name][dim].get_shape().as_list()[1]
+                                                        self.actions_onehot_arg[arg.name][dim] = tf.one_hot(self.actions_arg[arg.name][dim],processed_size,dtype=tf.float32)
+                                        self.responsible_outputs_base = tf.reduce_sum(self.policy_base_actions * self.actions_onehot_base, [1])
+                                        self.responsible_outputs_arg = dict()
+                                        for arg in actions.TYPES:
+                                                self.responsible_outputs_arg[arg.name] = dict()
+                                                for dim, size in enumerate(arg.sizes):
+                                                        self.responsible_outputs_arg[arg.name][dim] = tf.reduce_sum(self.policy_arg[arg.name][dim] * self.actions_onehot_arg[arg.name][dim], [1])
+				# Log probability of the actions taken under the current policy, leaving out unused (-1) arguments
+                                        self.log_prob_actions = tf.log(tf.clip_by_value(self.responsible_outputs_base, 1e-20, 1.0))
+                                        for arg in actions.TYPES:
+                                                for dim, size in enumerate(arg.sizes):
+                                                        used = tf.cast(self.actions_arg[arg.name][dim] >= 0, tf.float32)
+                                                        self.log_prob_actions += used * tf.log(tf.clip_by_value(self.responsible_outputs_arg[arg.name][dim], 1e-20, 1.0))
+
+				# Loss functions
+                                        for arg in actions.TYPES:
+                                                self.entropy_arg[arg.name] = dict()
+                                                for dim, size in enumerate(arg.sizes):
+                                                        self.entropy_arg[arg.name][dim] = - tf.reduce_sum(self.policy_arg[arg.name][dim] * tf.log(tf.clip_by_value(self.policy_arg[arg.name][dim], 1e-20, 1.)))
+                                        self.policy_loss_base = - tf.reduce_sum(tf.log(tf.clip_by_value(self.responsible_outputs_base, 1e-20, 1.0))*self.advantages)
+                                        for arg in actions.TYPES:
+                                                self.policy_loss_arg[arg.name] = dict()
+                                                for dim, size in enumerate(arg.sizes):
+                                                        self.policy_loss_arg[arg.name][dim] = - tf.reduce_sum(tf.log(tf.clip_by_value(self.responsible_outputs_arg[arg.name][dim], 1e-20, 1.0)) * self.advantages)
                                 self.entropy = self.entropy_base
                                 for arg in actions.TYPES:
                                         for dim, size in enumerate(arg.sizes):
                                                 self.entropy += self.entropy_arg[arg.name][dim]
                                 #
-                                self.policy_loss_base = - tf.reduce_sum(tf.log(tf.clip_by_value(self.responsible_outputs_base, 1e-20, 1.0))*self.advantages)
-                                self.policy_loss_arg = dict()
-                                for arg in actions.TYPES:
-                                        self.policy_loss_arg[arg.name] = dict()
-                                        for dim, size in enumerate(arg.sizes):
-                                                self.policy_loss_arg[arg.name][dim] = - tf.reduce_sum(tf.log(tf.clip_by_value(self.responsible_outputs_arg[arg.name][dim], 1e-20, 1.0)) * self.advantages)
-                                #
                                 self.policy_loss = self.policy_loss_base
                                 for arg in actions.TYPES:
                                         for dim, size in enumerate(arg.sizes):
                                                 self.policy_loss += self.policy_loss_arg[arg.name][dim]
-                                self.loss = 0.5 * self.value_loss + self.policy_loss - self.entropy * 0.01
+                                self.loss = 0.5 * self.value_loss + self.policy_loss - self.entropy * self.model.entropy_beta
 
 				# Get gradients from local network using local losses
-                                local_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope)
+                                local_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, variable_scope)
 				# self.gradients - gradients of loss wrt local_vars
                                 self.gradients = tf.gradients(self.loss,local_vars)
                                 self.var_norms = tf.global_norm(local_vars)
-                                grads,self.grad_norms = tf.clip_by_global_norm(self.gradients,40.0)
+                                grads,self.grad_norms = tf.clip_by_global_norm(self.gradients,self.model.gradient_clip)
 
 				# Apply local gradients to global network
                                 global_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global')
-                                self.apply_grads = trainer.apply_gradients(zip(grads,global_vars))
+                                #The global step, if there is one, counts the updates and versions the global parameters
+                                self.apply_grads = trainer.apply_gradients(zip(grads,global_vars), global_step=tf.train.get_global_step())
+
+## ROLLOUT BUFFER
+
+# Preallocated rollout storage with one contiguous typed array per field.
+# Entries [0, len) are valid; train feeds views of them directly.
+class RolloutBuffer():
+        def __init__(self, agent_model, capacity):
+                self.capacity = capacity
+                self.length = 0
+                self.screen = np.zeros((capacity,agent_model.screen_size,agent_model.screen_size,agent_model.screen_channels), dtype=agent_model.screen_dtype)
+                self.minimap = np.zeros((capacity,agent_model.minimap_size,agent_model.minimap_size,agent_model.minimap_channels), dtype=agent_model.minimap_dtype)
+                self.nonspatial = np.zeros((capacity,agent_model.nonspatial_size), dtype=np.float32)
+                self.actions_base = np.zeros(capacity, dtype=np.int32)
+                self.actions_arg = dict()
+                for arg in actions.TYPES:
+                        self.actions_arg[arg.name] = dict()
+                        for dim, size in enumerate(arg.sizes):
+                                self.actions_arg[arg.name][dim] = np.zeros(capacity, dtype=np.int32)
+                self.rewards = np.zeros(capacity, dtype=np.float32)
+                self.values = np.zeros(capacity, dtype=np.float32)
+                #Behaviour policy log probability of each action, for off-policy corrections
+                self.log_probs = np.zeros(capacity, dtype=np.float32)
+
+        def __len__(self):
+                return self.length
+
+        def clear(self):
+                self.length = 0
+
+        def append(self, screen, minimap, nonspatial, base_action, arg_sample, value, log_prob = 0.):
+                # Store the state and the decision taken in it; its reward is added once the environment has stepped
+                if self.length == self.capacity:
+                        raise IndexError("Rollout buffer is full ({0} entries).".format(self.capacity))
+                i = self.length
+                self.screen[i] = screen.reshape(self.screen.shape[1:])
+                self.minimap[i] = minimap.reshape(self.minimap.shape[1:])
+                self.nonspatial[i] = nonspatial.reshape(self.nonspatial.shape[1:])
+                self.actions_base[i] = base_action
+                for arg_name, arg in arg_sample.items():
+                        for dim, value in arg.items():
+                                self.actions_arg[arg_name][dim][i] = value
+                self.rewards[i] = 0
+                self.values[i] = value
+                self.log_probs[i] = log_prob
+                self.length += 1
+
+        def add_reward(self, reward):
+                self.rewards[self.length - 1] += reward
+
+        def keep_last(self, count):
+                # Move the last count entries to the front, in place
+                start = self.length - count
+                for field in [self.screen, self.minimap, self.nonspatial, self.actions_base, self.rewards, self.values, self.log_probs]:
+                        field[:count] = field[start:self.length]
+                for arg in self.actions_arg.values():
+                        for field in arg.values():
+                                field[:count] = field[start:self.length]
+                self.length = count
+
+        def export(self):
+                # Copy of the valid entries, eg. for sending to another process
+                data = {'screen': self.screen[:self.length].copy(), 'minimap': self.minimap[:self.length].copy(),
+                        'nonspatial': self.nonspatial[:self.length].copy(), 'actions_base': self.actions_base[:self.length].copy(),
+                        'rewards': self.rewards[:self.length].copy(), 'values': self.values[:self.length].copy(),
+                        'log_probs': self.log_probs[:self.length].copy(), 'actions_arg': dict()}
+                for arg_name, arg in self.actions_arg.items():
+                        data['actions_arg'][arg_name] = dict()
+                        for dim, field in arg.items():
+                                data['actions_arg'][arg_name][dim] = field[:self.length].copy()
+                return data
+
+        def load(self, data):
+                # Replace the contents with entries produced by export
+                self.length = len(data['values'])
+                for name in ['screen', 'minimap', 'nonspatial', 'actions_base', 'rewards', 'values', 'log_probs']:
+                        getattr(self, name)[:self.length] = data[name]
+                for arg_name, arg in data['actions_arg'].items():
+                        for dim, field in arg.items():
+                                self.actions_arg[arg_name][dim][:self.length] = field
+
+## PREDICTION SERVER
+
+# An inference request submitted by a worker; result is set by the prediction server
+class PredictionRequest():
+        def __init__(self, screen, minimap, nonspatial, available_actions):
+                self.screen = screen
+                self.minimap = minimap
+                self.nonspatial = nonspatial
+                self.available_actions = available_actions
+                self.submitted = time.time()
+                self.done = threading.Event()
+                self.result = None
+
+# Central inference for many workers (GA3C-style): requests from all workers are collected into dynamic batches
+# and evaluated with a single run of the global network's in-graph sampling ops.
+# A batch is run once it holds max_batch_size requests or its first request has waited max_wait seconds.
+class PredictionServer():
+        def __init__(self, network, max_batch_size = 16, max_wait = 0.005, num_threads = 1):
+                self.network = network
+                self.max_batch_size = max_batch_size
+                self.max_wait = max_wait
+                self.num_threads = num_threads
+                self.requests = queue.Queue()
+                self.threads = []
+                #Recent batch sizes and queue waits (seconds), for summaries
+                self.batch_sizes = collections.deque(maxlen=1000)
+                self.queue_waits = collections.deque(maxlen=1000)
+
+        def start(self, sess, coord):
+                for i in range(self.num_threads):
+                        t = threading.Thread(target=self.serve, args=(sess, coord))
+                        t.daemon = True
+                        t.start()
+                        self.threads.append(t)
+
+        def predict(self, coord, screen, minimap, nonspatial, available_actions):
+                # Blocks until the request has been evaluated; returns the same (base_action, arg_sample, value) as Worker.choose_action,
+                # or None if training stops first
+                request = PredictionRequest(screen, minimap, nonspatial, available_actions)
+                self.requests.put(request)
+                while not request.done.wait(0.1):
+                        #The serving threads may have drained the queue and stopped before this request was queued
+                        if coord.should_stop():
+                                return None
+                return request.result
+
+        def next_batch(self, coord):
+                try:
+                        batch = [self.requests.get(timeout=0.1)]
+                except queue.Empty:
+                        return []
+                deadline = batch[0].submitted + self.max_wait
+                while len(batch) < self.max_batch_size and not coord.should_stop():
+                        try:
+                                batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                        except queue.Empty:
+                                break
+                return batch
+
+        def serve(self, sess, coord):
+                while not coord.should_stop():
+                        batch = self.next_batch(coord)
+                        if len(batch) == 0:
+                                continue
+                        start = time.time()
+                        for request in batch:
+                                self.queue_waits.append(start - request.submitted)
+                        self.batch_sizes.append(len(batch))
+                        base_actions, arg_samples, values = sess.run([self.network.sample_base_action, self.network.sample_arg, self.network.value],
+                                                                     feed_dict={self.network.inputs_spatial_screen: np.concatenate([request.screen for request in batch]),
+                                                                                self.network.inputs_spatial_minimap: np.concatenate([request.minimap for request in batch]),
+                                                                                self.network.inputs_nonspatial: np.concatenate([request.nonspatial for request in batch]),
+                                                                                self.network.available_actions: np.stack([request.available_actions for request in batch])})
+                        for i, request in enumerate(batch):
+                                arg_sample = dict()
+                                for arg in arg_samples:
+                                        arg_sample[arg] = dict()
+                                        for dim in arg_samples[arg]:
+                                                arg_sample[arg][dim] = arg_samples[arg][dim][i]
+                                request.result = (base_actions[i], arg_sample, values[i:i+1])
+                                request.done.set()
+                # Release workers still waiting on requests
+                while not self.requests.empty():
+                        self.requests.get().done.set()
+
+        def mean_batch_size(self):
+                return np.mean(self.batch_sizes) if len(self.batch_sizes) > 0 else 0.
+
+        def mean_queue_wait(self):
+                return np.mean(self.queue_waits) if len(self.queue_waits) > 0 else 0.
+
+## TELEMETRY
+
+# Rolling window of durations for each stage of the training loop, reported as percentiles.
+# Recording is a clock read and a deque append, so it is left on.
+class StageTimer():
+        def __init__(self, window = 1000):
+                self.window = window
+                self.durations = collections.OrderedDict()
+
+        def record(self, stage, start):
+                # Records the time elapsed since start (from time.time()) for stage
+                if stage not in self.durations:
+                        self.durations[stage] = collections.deque(maxlen=self.window)
+                self.durations[stage].append(time.time() - start)
+
+        def percentiles(self, stage, q = (50, 95, 99)):
+                return np.percentile(self.durations[stage], q)
+
+        def add_summary(self, summary):
+                for stage, durations in self.durations.items():
+                        if len(durations) == 0:
+                                continue
+                        for q, value in zip((50, 95, 99), self.percentiles(stage)):
+                                summary.value.add(tag='Timing/{0} p{1} (ms)'.format(stage, q), simple_value=float(value * 1000.))
+
+# Memory and CPU usage of the process, and CPU usage of a single thread once attach has been called from it.
+class ResourceMonitor():
+        def __init__(self):
+                self.process = psutil.Process()
+                self.thread_id = None
+                self.last_sample = None
+
+        def attach(self):
+                # Measure the CPU time of the calling thread rather than of the whole process, where supported
+                if hasattr(threading, 'get_native_id'):
+                        self.thread_id = threading.get_native_id()
+
+        def cpu_time(self):
+                if self.thread_id is not None:
+                        for thread in self.process.threads():
+                                if thread.id == self.thread_id:
+                                        return thread.user_time + thread.system_time
+                cpu_times = self.process.cpu_times()
+                return cpu_times.user + cpu_times.system
+
+        def sample(self):
+                # Returns the resident memory in MB and the CPU utilization in percent since the previous sample
+                now = time.time()
+                cpu_time = self.cpu_time()
+                cpu_percent = 0.
+                if self.last_sample is not None:
+                        cpu_percent = 100. * (cpu_time - self.last_sample[1]) / max(now - self.last_sample[0], 1e-6)
+                self.last_sample = (now, cpu_time)
+                return self.process.memory_info().rss / 2.**20, cpu_percent
+
+        def add_summary(self, summary):
+                rss, cpu_percent = self.sample()
+                summary.value.add(tag='Resources/RSS (MB)', simple_value=float(rss))
+                summary.value.add(tag='Resources/CPU (%)', simple_value=float(cpu_percent))
 
 ## WORKER AGENT
 
-class Worker():
-        def __init__(self,name,trainer,model_path,global_episodes, map_name, agent_model):
-                self.name = "worker_" + str(name)
-                self.number = name
-                self.model_path = model_path
-                self.trainer = trainer
-                self.global_episodes = global_episodes
-                self.increment = self.global_episodes.assign_add(1)
+# A local copy of the network with the ops to download the global parameters and apply its gradients to the global network
+# How the local parameters follow the global ones is set by sync_strategy:
+#   'full' copies every parameter on each sync
+#   'versioned' copies them only if the global step has moved since the last copy
+#   'shared' makes the local network read the global variables directly, so nothing is ever copied
+class Learner():
+        def __init__(self,name,trainer,agent_model,sync_strategy = 'full'):
+                if sync_strategy not in _SYNC_STRATEGIES:
+                        raise ValueError("Invalid sync strategy: {0}.\n Strategy must be one of {1}.".format(sync_strategy, _SYNC_STRATEGIES))
+                if not agent_model.is_training:
+                        raise ValueError("Learner {0} needs an agent model with is_training set.".format(name))
+                self.name = name
+                self.sync_strategy = sync_strategy
+                #Create the local copy of the network and the tensorflow op to copy global paramters to local network
+                self.local_AC = AC_Network(self.name,trainer,agent_model,share_global=(sync_strategy == 'shared'))
+                self.update_local_ops = update_target_graph('global',self.name)
+                self.parameter_bytes = sum(variable.get_shape().num_elements() * variable.dtype.base_dtype.size
+                                           for variable in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global'))
+                self.timer = StageTimer()
+                self.resources = ResourceMonitor()
+                self.global_step = tf.train.get_global_step()
+                if sync_strategy == 'versioned' and self.global_step is None:
+                        raise ValueError("The versioned sync strategy needs a global step.")
+                self.parameter_version = 0
+                self.copied_version = None
+                self.sync_count = 0
+                self.sync_bytes = 0
                 self.episode_rewards = []
                 self.episode_lengths = []
                 self.episode_mean_values = []
-                self.summary_writer = tf.summary.FileWriter("train_"+str(self.number))
-                #Create the local copy of the network and the tensorflow op to copy global paramters to local network
-                self.local_AC = AC_Network(self.name,trainer,agent_model)
-                self.update_local_ops = update_target_graph('global',self.name)
-                print('Initializing environment #{}...'.format(self.number))
-                self.env = sc2_env.SC2Env(map_name=map_name,screen_size_px=(agent_model.screen_size,agent_model.screen_size), minimap_size_px=(agent_model.minimap_size,agent_model.minimap_size))
+
+        def episode_summary(self,v_l,p_l,e_l,g_n,v_n):
+                # Performance over the last max_episodes_kept episodes and the latest losses
+                mean_reward = np.mean(self.episode_rewards[-self.local_AC.model.max_episodes_kept:])
+                mean_length = np.mean(self.episode_lengths[-self.local_AC.model.max_episodes_kept:])
+                mean_value = np.mean(self.episode_mean_values[-self.local_AC.model.max_episodes_kept:])
+                summary = tf.Summary()
+                summary.value.add(tag='Perf/Reward', simple_value=float(mean_reward))
+                summary.value.add(tag='Perf/Length', simple_value=float(mean_length))
+                summary.value.add(tag='Perf/Value', simple_value=float(mean_value))
+                summary.value.add(tag='Losses/Value Loss', simple_value=float(v_l))
+                summary.value.add(tag='Losses/Policy Loss', simple_value=float(p_l))
+                summary.value.add(tag='Losses/Entropy', simple_value=float(e_l))
+                summary.value.add(tag='Losses/Grad Norm', simple_value=float(g_n))
+                summary.value.add(tag='Losses/Var Norm', simple_value=float(v_n))
+                self.timer.add_summary(summary)
+                self.resources.add_summary(summary)
+                self.sync_summary(summary)
+                return summary
+
+        def training_state(self):
+                # Episode statistics kept in checkpoints, enough to continue the Perf summaries after a resume
+                kept = self.local_AC.model.max_episodes_kept
+                return {'episode_rewards': [float(x) for x in self.episode_rewards[-kept:]],
+                        'episode_lengths': [int(x) for x in self.episode_lengths[-kept:]],
+                        'episode_mean_values': [float(x) for x in self.episode_mean_values[-kept:]]}
+
+        def restore_training_state(self, state):
+                self.episode_rewards = list(state['episode_rewards'])
+                self.episode_lengths = list(state['episode_lengths'])
+                self.episode_mean_values = list(state['episode_mean_values'])
+
         def train(self,rollout,sess,gamma,bootstrap_value):
-                rollout = np.array(rollout)
-                obs_screen = rollout[:,0]
-                obs_minimap = rollout[:,1]
-                obs_nonspatial = rollout[:,2]
-                actions_base = rollout[:,3]
-                actions_args = rollout[:,4]
-                rewards = rollout[:,5]
-                #next_obs_screen = rollout[:,6]
-                #next_obs_minimap = rollout[:,7]
-                #next_obs_nonspatial = rollout[:,8]
-                values = rollout[:,10]
-                actions_arg_stack = dict()
-                for actions_arg in actions_args:
-                        for arg_name,arg in actions_arg.items():
-                                if arg_name not in actions_arg_stack:
-                                        actions_arg_stack[arg_name] = dict()
-                                for dim, value in arg.items():
-                                        if dim not in actions_arg_stack[arg_name]:
-                                                actions_arg_stack[arg_name][dim] = []
-                                        actions_arg_stack[arg_name][dim].append(value)
-		# Here we take the rewards and values from the rollout, and use them to calculate the advantage and discounted returns
-		# The advantage function uses generalized advantage estimation from [2]
-                self.rewards_plus = np.asarray(rewards.tolist() + [bootstrap_value])
-                discounted_rewards = discount(self.rewards_plus,gamma)[:-1]
-                self.value_plus = np.asarray(values.tolist() + [bootstrap_value])
-                advantages = rewards + gamma * self.value_plus[1:] - self.value_plus[:-1]
-                advantages = discount(advantages,gamma)
-                # Update the global network using gradients from loss
-		# Generate network statistics to periodically save
-                feed_dict = {self.local_AC.target_v:discounted_rewards,
-                             self.local_AC.inputs_spatial_screen:np.stack(obs_screen).reshape(-1,self.local_AC.model.screen_size,self.local_AC.model.screen_size,self.local_AC.model.screen_channels),
-                             self.local_AC.inputs_spatial_minimap:np.stack(obs_minimap).reshape(-1,self.local_AC.model.minimap_size,self.local_AC.model.minimap_size,self.local_AC.model.minimap_channels),
-                             self.local_AC.inputs_nonspatial:np.stack(obs_nonspatial).reshape(-1,self.local_AC.model.nonspatial_size),
-                             self.local_AC.actions_base:actions_base,
-                             self.local_AC.advantages:advantages}
-                for arg_name, arg in actions_arg_stack.items():
-                        for dim, value in arg.items():
-                                feed_dict[self.local_AC.actions_arg[arg_name][dim]] = value
-		
+                return self.train_segments([(rollout, 0, len(rollout), bootstrap_value)],sess,gamma)
+
+        def train_segments(self,segments,sess,gamma):
+                # Makes a single update from several trajectory segments, each given as (rollout, start, end, bootstrap_value)
+                # where entries [start, end) of the rollout are consecutive steps of one episode
+                start_time = time.time()
+                feed_dict, size = self.build_feed_dict(segments,gamma)
+                self.timer.record('advantages', start_time)
+                return self.apply_update(feed_dict,size,sess)
+
+        def train_vtrace(self,segments,sess,gamma,rho_bar = 1.0,c_bar = 1.0):
+                # Like train_segments, but with V-trace targets and advantages ([3]) that correct for the lag between the
+                # behaviour policy that generated the segments and the current parameters of the local network
+                start_time = time.time()
+                feed_dict, size = self.build_feed_dict(segments,gamma)
+                log_probs, values = sess.run([self.local_AC.log_prob_actions, self.local_AC.value], feed_dict=feed_dict)
+                target_v = []
+                advantages = []
+                offset = 0
+                for rollout, start, end, bootstrap_value in segments:
+                        length = end - start
+                        log_rhos = log_probs[offset:offset + length] - rollout.log_probs[start:end]
+                        vs, segment_advantages = vtrace(rollout.rewards[start:end], values[offset:offset + length, 0], bootstrap_value, log_rhos, gamma, rho_bar, c_bar)
+                        target_v.append(vs)
+                        advantages.append(segment_advantages)
+                        offset += length
+                feed_dict[self.local_AC.target_v] = np.concatenate(target_v)
+                feed_dict[self.local_AC.advantages] = np.concatenate(advantages)
+                self.timer.record('advantages', start_time)
+                return self.apply_update(feed_dict,size,sess)
+
+        def apply_update(self,feed_dict,size,sess):
+                #Gradients are computed and applied in the same run
+                start_time = time.time()
                 v_l,p_l,e_l,g_n,v_n, _ = sess.run([self.local_AC.value_loss,
                                                    self.local_AC.policy_loss,
                                                    self.local_AC.entropy,
@@ -421,187 +1109,1143 @@ class Worker():
                                                    self.local_AC.var_norms,
                                                    self.local_AC.apply_grads],
                                                   feed_dict=feed_dict)
-                return v_l / len(rollout),p_l / len(rollout),e_l / len(rollout), g_n,v_n
-		
-        def work(self,max_episode_length,gamma,sess,coord,saver):
+                self.timer.record('gradients', start_time)
+                return v_l / size,p_l / size,e_l / size, g_n,v_n
+
+        def sync(self,sess):
+                #Download copy of parameters from global network, and their version if the global step is kept
+                start_time = time.time()
+                self.sync_count += 1
+                if self.sync_strategy == 'shared':
+                        #Nothing to copy, the local network already reads the global variables
+                        if self.global_step is not None:
+                                self.parameter_version = sess.run(self.global_step)
+                elif self.global_step is None:
+                        sess.run(self.update_local_ops)
+                        self.sync_bytes += self.parameter_bytes
+                elif self.sync_strategy == 'full':
+                        self.parameter_version = sess.run([self.update_local_ops, self.global_step])[1]
+                        self.sync_bytes += self.parameter_bytes
+                else:
+                        self.parameter_version = sess.run(self.global_step)
+                        if self.parameter_version != self.copied_version:
+                                #The copy may include updates made after reading the version, which only makes it newer
+                                sess.run(self.update_local_ops)
+                                self.copied_version = self.parameter_version
+                                self.sync_bytes += self.parameter_bytes
+                self.timer.record('sync', start_time)
+
+        def sync_summary(self, summary):
+                # Bytes copied per sync since the last summary
+                summary.value.add(tag='Sync/Bytes Copied', simple_value=float(self.sync_bytes) / max(self.sync_count, 1))
+                summary.value.add(tag='Sync/Syncs', simple_value=float(self.sync_count))
+                self.sync_count = 0
+                self.sync_bytes = 0
+
+        def build_feed_dict(self,segments,gamma):
+                # Returns the training feed_dict for segments (see train_segments) and the number of steps in it
+                discounted_rewards = []
+                advantages = []
+                for rollout, start, end, bootstrap_value in segments:
+                        rewards = rollout.rewards[start:end]
+                        values = rollout.values[start:end]
+                        if self.local_AC.model.rollout_mode == 'nstep':
+                                segment_returns, segment_advantages = nstep_returns(rewards, values, bootstrap_value, gamma)
+                                discounted_rewards.append(segment_returns)
+                                advantages.append(segment_advantages)
+                                continue
+			# Here we take the rewards and values from the rollout, and use them to calculate the advantage and discounted returns
+			# The advantage function uses generalized advantage estimation from [2]
+                        rewards_plus = np.append(rewards, bootstrap_value)
+                        discounted_rewards.append(discount(rewards_plus,gamma)[:-1])
+                        value_plus = np.append(values, bootstrap_value)
+                        advantages.append(discount(rewards + gamma * value_plus[1:] - value_plus[:-1],gamma))
+                size = sum(end - start for _, start, end, _ in segments)
+                def gather(field):
+                        # A single segment is fed as a view, several are concatenated into one batch
+                        if len(segments) == 1:
+                                rollout, start, end, _ = segments[0]
+                                return field(rollout)[start:end]
+                        return np.concatenate([field(rollout)[start:end] for rollout, start, end, _ in segments])
+                # Update the global network using gradients from loss
+		# Generate network statistics to periodically save
+                feed_dict = {self.local_AC.target_v:np.concatenate(discounted_rewards),
+                             self.local_AC.inputs_spatial_screen:gather(lambda rollout: rollout.screen),
+                             self.local_AC.inputs_spatial_minimap:gather(lambda rollout: rollout.minimap),
+                             self.local_AC.inputs_nonspatial:gather(lambda rollout: rollout.nonspatial),
+                             self.local_AC.actions_base:gather(lambda rollout: rollout.actions_base),
+                             self.local_AC.advantages:np.concatenate(advantages)}
+                for arg_name, arg in self.local_AC.actions_arg.items():
+                        for dim in arg:
+                                feed_dict[arg[dim]] = gather(lambda rollout: rollout.actions_arg[arg_name][dim])
+                return feed_dict, size
+
+class Worker(Learner):
+        def __init__(self,name,trainer,model_path,global_episodes, env_fn, agent_model, in_graph_sampling = True, predictor = None, trajectory_queue = None, record_log_probs = False, sync_strategy = 'full', recorder = None):
+                Learner.__init__(self,"worker_" + str(name),trainer,agent_model,sync_strategy)
+                self.number = name
+                self.in_graph_sampling = in_graph_sampling
+                #Optional shared PredictionServer that evaluates the global network for this worker's actions
+                self.predictor = predictor
+                #Optional TrajectoryQueue; if set, rollouts are sent to learner threads instead of being trained on by the worker
+                self.trajectory_queue = trajectory_queue
+                #Record the behaviour policy log probabilities of the actions, needed for V-trace (in-graph sampling only)
+                self.record_log_probs = record_log_probs
+                self.sampled_log_probs = None
+                #Optional TrajectoryStore.TrajectoryRecorder that streams every step to disk
+                self.recorder = recorder
+                self.losses = (0,0,0,0,0)
+                #Steps sent through the backward pass and environment steps since the last summary
+                self.gradient_samples = 0
+                self.env_steps = 0
+                self.decisions = 0
+                self.interval_start = time.time()
+                self.model_path = model_path
+                self.trainer = trainer
+                self.global_episodes = global_episodes
+                self.increment = self.global_episodes.assign_add(1)
+                self.summary_writer = tf.summary.FileWriter("train_"+str(self.number))
+                self.episode_buffer = RolloutBuffer(agent_model, agent_model.max_episodes_kept)
+                print('Initializing environment #{}...'.format(self.number))
+                self.env = env_fn()
+        def choose_action(self,sess,coord,screen_stack,minimap_stack,nonspatial_stack,observation):
+                # In the predictor and in-graph modes sampling happens in the same run as inference, and is timed with it.
+                # Returns None if the predictor stopped with coord before answering
+                start_time = time.time()
+                if self.predictor is not None:
+                        # nonspatial_stack is overwritten by the next observation, so the queued request gets a copy
+                        result = self.predictor.predict(coord, screen_stack, minimap_stack, nonspatial_stack.copy(), self.local_AC.model.available_actions_mask)
+                        self.timer.record('inference', start_time)
+                        return result
+                if self.in_graph_sampling:
+                        # Mask, sample and evaluate the state in a single run
+                        result = sample_action(sess, self.local_AC, screen_stack, minimap_stack, nonspatial_stack, self.local_AC.model.available_actions_mask, self.record_log_probs)
+                        self.timer.record('inference', start_time)
+                        if self.record_log_probs:
+                                self.sampled_log_probs = result[3:]
+                                return result[:3]
+                        return result
+                # Reference mode: sample from the distributions in Python
+                feed_dict = {self.local_AC.inputs_spatial_screen: screen_stack,
+                             self.local_AC.inputs_spatial_minimap: minimap_stack,
+                             self.local_AC.inputs_nonspatial: nonspatial_stack}
+                base_action_dist, arg_dist, v = sess.run([self.local_AC.policy_base_actions, self.local_AC.policy_arg, self.local_AC.value], feed_dict=feed_dict)
+                self.timer.record('inference', start_time)
+                start_time = time.time()
+                #Apply filter to remove unavailable actions and then renormalize
+                for action_id, action_prob in enumerate(base_action_dist[0]):
+                        if self.local_AC.model.get_action(action_id).id not in observation.observation['available_actions']:
+                                base_action_dist[0][action_id] = 0
+                if np.sum(base_action_dist[0]) != 1 and np.sum(base_action_dist[0]) != 0:
+                        current_sum = np.sum(base_action_dist[0])
+                        base_action_dist[0] /= current_sum
+                base_action = sample_dist(base_action_dist)
+                arg_sample = dict()
+                for arg in arg_dist:
+                        arg_sample[arg] = dict()
+                        for dim in arg_dist[arg]:
+                                arg_sample[arg][dim] = sample_dist(arg_dist[arg][dim])
+                self.timer.record('sampling', start_time)
+                return base_action, arg_sample, v
+
+        def update(self,sess,coord,gamma,bootstrap_value):
+                # Trains on the episode buffer, or hands a copy of it to the learner threads (whose summaries then hold the losses)
+                self.gradient_samples += len(self.episode_buffer)
+                if self.trajectory_queue is None:
+                        self.losses = self.train(self.episode_buffer,sess,gamma,bootstrap_value)
+                else:
+                        self.trajectory_queue.put((self.episode_buffer.export(), bootstrap_value, self.parameter_version), coord)
+
+        def work(self,gamma,sess,coord,checkpointer):
                 episode_count = sess.run(self.global_episodes)
-                total_steps = 0
+                total_steps = int(_steps[self.number])
                 print ("Starting worker " + str(self.number))
+                self.resources.attach()
                 with sess.as_default(), sess.graph.as_default():				 
                         while not coord.should_stop():
                                 #Download copy of parameters from global network
-                                sess.run(self.update_local_ops)
+                                self.sync(sess)
 
-                                episode_buffer = []
+                                episode_buffer = self.episode_buffer
+                                episode_buffer.clear()
                                 episode_values = []
-                                episode_frames = []
                                 episode_reward = 0
                                 episode_step_count = 0
                                 episode_end = False
                                 #Start new episode
                                 obs = self.env.reset()
                                 self.local_AC.model.reset()
-                                episode_frames.append(obs[0])
                                 reward, nonspatial_stack, minimap_stack, screen_stack, episode_end = self.local_AC.model.process_observation(obs[0])
-                                s_screen = screen_stack
-                                s_minimap = minimap_stack
-                                s_nonspatial = nonspatial_stack
                                 while not episode_end:
                                         # Take an action using distributions from policy networks' outputs
-                                        base_action_dist, arg_dist, v = sess.run([self.local_AC.policy_base_actions, self.local_AC.policy_arg, self.local_AC.value],
-                                                                                 feed_dict={self.local_AC.inputs_spatial_screen: screen_stack,
-                                                                                            self.local_AC.inputs_spatial_minimap: minimap_stack,
-                                                                                            self.local_AC.inputs_nonspatial: nonspatial_stack})
-                                        #Apply filter to remove unavailable actions and then renormalize
-                                        for action_id, action_prob in enumerate(base_action_dist[0]):
-                                                if self.local_AC.model.get_action(action_id).id not in obs[0].observation['available_actions']:
-                                                        base_action_dist[0][action_id] = 0
-                                        if np.sum(base_action_dist[0]) != 1 and np.sum(base_action_dist[0]) != 0:
-                                                current_sum = np.sum(base_action_dist[0])
-                                                base_action_dist[0] /= current_sum
-                                        base_action = sample_dist(base_action_dist)
-                                        arg_sample = dict()
-                                        for arg in arg_dist:
-                                                arg_sample[arg] = dict()
-                                                for dim in arg_dist[arg]:
-                                                        arg_sample[arg][dim] = sample_dist(arg_dist[arg][dim])
+                                        action = self.choose_action(sess, coord, screen_stack, minimap_stack, nonspatial_stack, obs[0])
+                                        if action is None:
+                                                break
+                                        base_action, arg_sample, v = action
+                                        if len(episode_buffer) == episode_buffer.capacity and self.local_AC.model.rollout_mode == 'nstep':
+                                                #The full buffer ends just before this state, so the value just computed bootstraps it
+                                                self.update(sess,coord,gamma,v[0,0])
+                                                episode_buffer.clear()
+                                                self.sync(sess)
 
-                                        arguments = []
-                                        chosen_action = self.local_AC.model.get_action(base_action)
-                                        for arg in chosen_action.args:
-                                                arg_value = []
-                                                for dim, size in enumerate(arg.sizes):
-                                                        arg_value.append(arg_sample[arg.name][dim])
-                                                arguments.append(arg_value)
-
-					# Set unused arguments to -1 so that they won't be updated in the training
-					# See documentation for tf.one_hot
-                                        for arg_name, arg in arg_sample.items():
-                                                if arg_name not in chosen_action.args:
-                                                        for dim in arg:
-                                                                arg_sample[arg_name][dim] = -1
-                                        a = actions.FunctionCall(chosen_action.id, arguments)
-                                        obs = self.env.step(actions=[a])
+                                        start_time = time.time()
+                                        a, arguments = build_function_call(self.local_AC.model, base_action, arg_sample)
+                                        #Store the state before the next observation overwrites process_observation's buffer
+                                        log_prob = action_log_prob(self.sampled_log_probs[0], self.sampled_log_probs[1], arg_sample) if self.record_log_probs else 0.
+                                        episode_buffer.append(screen_stack, minimap_stack, nonspatial_stack, base_action, arg_sample, v[0,0], log_prob)
+                                        if self.recorder is not None:
+                                                self.recorder.append(screen_stack, minimap_stack, nonspatial_stack, base_action, arg_sample, v[0,0])
+                                        self.timer.record('action', start_time)
+                                        start_time = time.time()
+                                        timestep, steps = step_repeated(self.env, a, self.local_AC.model.action_repeat)
+                                        obs = (timestep,)
+                                        self.timer.record('env_step', start_time)
+                                        start_time = time.time()
                                         self.local_AC.model.act(base_action,arguments)
                                         
                                         r, nonspatial_stack, minimap_stack, screen_stack, episode_end = self.local_AC.model.process_observation(obs[0])
-                                        if not episode_end:
-                                                episode_frames.append(obs[0])
-                                                s1_screen = screen_stack
-                                                s1_minimap = minimap_stack
-                                                s1_nonspatial = nonspatial_stack
-                                        else:
-                                                s1_screen = s_screen
-                                                s1_minimap = s_minimap
-                                                s1_nonspatial = s_nonspatial
-                                        #Append latest state to buffer
-                                        episode_buffer.append([s_screen, s_minimap, s_nonspatial,base_action,arg_sample,r,s1_screen, s1_minimap, s1_nonspatial,episode_end,v[0,0]])
+                                        self.timer.record('observation', start_time)
+                                        episode_buffer.add_reward(r)
+                                        if self.recorder is not None:
+                                                self.recorder.add_reward(r, episode_end)
                                         episode_values.append(v[0,0])
                                         episode_reward += r
-                                        s_screen = s1_screen
-                                        s_minimap = s1_minimap
-                                        s_nonspatial = s1_nonspatial
-                                        total_steps += 1
-                                        episode_step_count += 1
+                                        total_steps += steps
+                                        episode_step_count += steps
+                                        self.env_steps += steps
+                                        self.decisions += 1
                                         #If the episode hasn't ended, but the experience buffer is full, then we make an update step using that experience rollout
-                                        if len(episode_buffer) == self.local_AC.model.max_episodes_kept and not episode_end and episode_step_count != max_episode_length - 1:
+                                        if len(episode_buffer) == episode_buffer.capacity and not episode_end and self.local_AC.model.rollout_mode == 'overlap':
                                                 #Since we don't know what the true final return is, we "bootstrap" from our current value estimation
+                                                start_time = time.time()
                                                 v1 = sess.run(self.local_AC.value, 
                                                               feed_dict={self.local_AC.inputs_spatial_screen: screen_stack,self.local_AC.inputs_spatial_minimap: minimap_stack,self.local_AC.inputs_nonspatial: nonspatial_stack})[0,0]
-                                                v_l,p_l,e_l,g_n,v_n = self.train(episode_buffer,sess,gamma,v1)
-                                                episode_buffer = episode_buffer[len(episode_buffer)//2:]
-                                                sess.run(self.update_local_ops)
+                                                self.timer.record('inference', start_time)
+                                                self.update(sess,coord,gamma,v1)
+                                                episode_buffer.keep_last(len(episode_buffer) - len(episode_buffer)//2)
+                                                self.sync(sess)
                                         if episode_end:
                                                 break
+                                if not episode_end:
+                                        #Training stopped before the predictor answered; the unfinished episode is dropped
+                                        break
 
                                 self.episode_rewards.append(episode_reward)
                                 self.episode_lengths.append(episode_step_count)
                                 self.episode_mean_values.append(np.mean(episode_values))
                                 episode_count += 1
-                                global _max_score, _running_avg_score, _episodes, _steps
-                                if _max_score < episode_reward:
-                                        _max_score = episode_reward
-                                _running_avg_score += (episode_reward - _running_avg_score)/(episode_count if episode_count > 0 else 1)
-                                _episodes[self.number] = episode_count
-                                _steps[self.number] = total_steps
-
-                                print("{} Step #{} Episode #{} Reward: {}".format(self.name, total_steps, episode_count, episode_reward))
-                                print("Total Steps: {}\tTotal Episodes: {}\tMax Score: {}\tAvg Score: {}".format(np.sum(_steps), np.sum(_episodes), _max_score, _running_avg_score))
+                                record_episode(self.name, self.number, episode_count, total_steps, episode_reward)
                                 #Update the network using the episode buffer at the end of the episode
                                 if len(episode_buffer) != 0:
-                                        v_l,p_l,e_l,g_n,v_n = self.train(episode_buffer,sess,gamma,0.0)
+                                        self.update(sess,coord,gamma,0.0)
 
+                                checkpointer.maybe_save(episode_count, int(np.sum(_steps)))
                                 if episode_count % self.local_AC.model.max_episodes_kept == 0 and episode_count != 0:
-                                        if episode_count % self.local_AC.model.save_increment == 0 and self.name == 'worker_0':
-                                                saver.save(sess,self.model_path+'/model-'+str(episode_count)+'.cptk')
-                                                print ("Saved Model")
-                                        mean_reward = np.mean(self.episode_rewards[-self.local_AC.model.max_episodes_kept:])
-                                        mean_length = np.mean(self.episode_lengths[-self.local_AC.model.max_episodes_kept:])
-                                        mean_value = np.mean(self.episode_mean_values[-self.local_AC.model.max_episodes_kept:])
-                                        summary = tf.Summary()
-                                        summary.value.add(tag='Perf/Reward', simple_value=float(mean_reward))
-                                        summary.value.add(tag='Perf/Length', simple_value=float(mean_length))
-                                        summary.value.add(tag='Perf/Value', simple_value=float(mean_value))
-                                        summary.value.add(tag='Losses/Value Loss', simple_value=float(v_l))
-                                        summary.value.add(tag='Losses/Policy Loss', simple_value=float(p_l))
-                                        summary.value.add(tag='Losses/Entropy', simple_value=float(e_l))
-                                        summary.value.add(tag='Losses/Grad Norm', simple_value=float(g_n))
-                                        summary.value.add(tag='Losses/Var Norm', simple_value=float(v_n))
+                                        summary = self.episode_summary(*self.losses)
+                                        if self.predictor is not None:
+                                                summary.value.add(tag='Perf/Predictor Batch Size', simple_value=float(self.predictor.mean_batch_size()))
+                                                summary.value.add(tag='Perf/Predictor Queue Wait', simple_value=float(self.predictor.mean_queue_wait()))
+                                        summary.value.add(tag='Perf/Samples Per Step', simple_value=float(self.gradient_samples) / max(self.env_steps, 1))
+                                        elapsed = time.time() - self.interval_start
+                                        summary.value.add(tag='Perf/Decisions Per Second', simple_value=float(self.decisions) / elapsed)
+                                        summary.value.add(tag='Perf/Env Steps Per Second', simple_value=float(self.env_steps) / elapsed)
+                                        self.gradient_samples = 0
+                                        self.env_steps = 0
+                                        self.decisions = 0
+                                        self.interval_start = time.time()
                                         self.summary_writer.add_summary(summary, episode_count)
                                         self.summary_writer.flush()
                                 if self.name == 'worker_0':
                                         sess.run(self.increment)
+                        if self.recorder is not None:
+                                self.recorder.close()
+
+## DECOUPLED LEARNERS
+
+# Bounded queue of (rollout export, bootstrap value, parameter version) segments from workers to learner threads.
+# Workers block when it is full, which bounds the policy lag of the segments.
+class TrajectoryQueue():
+        def __init__(self, maxsize):
+                self.queue = queue.Queue(maxsize)
+
+        def put(self, segment, coord):
+                while not coord.should_stop():
+                        try:
+                                self.queue.put(segment, timeout=1.0)
+                                return
+                        except queue.Full:
+                                continue
+
+        def get_batch(self, batch_size, coord):
+                # Waits for a first segment, then adds those already queued up to batch_size
+                batch = []
+                while len(batch) == 0 and not coord.should_stop():
+                        try:
+                                batch.append(self.queue.get(timeout=1.0))
+                        except queue.Empty:
+                                continue
+                while len(batch) < batch_size:
+                        try:
+                                batch.append(self.queue.get_nowait())
+                        except queue.Empty:
+                                break
+                return batch
+
+        def depth(self):
+                return self.queue.qsize()
+
+# Learner thread that trains the global network on batches of segments from a TrajectoryQueue, so that workers keep
+# stepping their environments while gradients are computed. Optionally corrects for policy lag with V-trace.
+class QueueLearner(Learner):
+        def __init__(self,number,trainer,trajectory_queue, agent_model, batch_size = 4, vtrace = False, rho_bar = 1.0, c_bar = 1.0, sync_strategy = 'full'):
+                Learner.__init__(self,"learner_" + str(number),trainer,agent_model,sync_strategy)
+                self.trajectory_queue = trajectory_queue
+                self.vtrace = vtrace
+                self.rho_bar = rho_bar
+                self.c_bar = c_bar
+                self.rollouts = [RolloutBuffer(agent_model, agent_model.max_episodes_kept) for _ in range(batch_size)]
+                self.summary_writer = tf.summary.FileWriter("train_learner_"+str(number))
+                self.queue_depths = collections.deque(maxlen=1000)
+                self.staleness = collections.deque(maxlen=1000)
+
+        def work(self,gamma,sess,coord):
+                print ("Starting " + self.name)
+                self.resources.attach()
+                updates = 0
+                busy_time = 0.
+                interval_start = time.time()
+                with sess.as_default(), sess.graph.as_default():
+                        while not coord.should_stop():
+                                self.queue_depths.append(self.trajectory_queue.depth())
+                                batch = self.trajectory_queue.get_batch(len(self.rollouts), coord)
+                                if len(batch) == 0:
+                                        continue
+                                start_time = time.time()
+                                #The local network then holds the current global parameters, ie. the target policy
+                                self.sync(sess)
+                                segments = []
+                                for rollout, (data, bootstrap_value, segment_version) in zip(self.rollouts, batch):
+                                        rollout.load(data)
+                                        segments.append((rollout, 0, len(rollout), bootstrap_value))
+                                        self.staleness.append(self.parameter_version - segment_version)
+                                if self.vtrace:
+                                        losses = self.train_vtrace(segments,sess,gamma,self.rho_bar,self.c_bar)
+                                else:
+                                        losses = self.train_segments(segments,sess,gamma)
+                                busy_time += time.time() - start_time
+                                updates += 1
+                                if updates % self.local_AC.model.max_episodes_kept == 0:
+                                        self.summary_writer.add_summary(self.learner_summary(losses, busy_time / (time.time() - interval_start)), self.parameter_version)
+                                        self.summary_writer.flush()
+                                        busy_time = 0.
+                                        interval_start = time.time()
+
+        def learner_summary(self,losses,utilization):
+                v_l,p_l,e_l,g_n,v_n = losses
+                summary = tf.Summary()
+                summary.value.add(tag='Losses/Value Loss', simple_value=float(v_l))
+                summary.value.add(tag='Losses/Policy Loss', simple_value=float(p_l))
+                summary.value.add(tag='Losses/Entropy', simple_value=float(e_l))
+                summary.value.add(tag='Losses/Grad Norm', simple_value=float(g_n))
+                summary.value.add(tag='Losses/Var Norm', simple_value=float(v_n))
+                summary.value.add(tag='Learner/Queue Depth', simple_value=float(np.mean(self.queue_depths)))
+                summary.value.add(tag='Learner/Staleness', simple_value=float(np.mean(self.staleness)))
+                summary.value.add(tag='Learner/Max Staleness', simple_value=float(np.max(self.staleness)))
+                summary.value.add(tag='Learner/Utilization', simple_value=float(utilization))
+                self.timer.add_summary(summary)
+                self.resources.add_summary(summary)
+                self.sync_summary(summary)
+                return summary
+
+## PROCESS ACTORS
+
+# Flat float32 copy of the global network parameters in shared memory, with a version counter.
+# The learner publishes new values after every update; actor processes copy them in when the version has moved.
+class SharedParameters():
+        def __init__(self, shapes, context):
+                self.shapes = [tuple(shape) for shape in shapes]
+                self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+                self.values = context.RawArray('f', sum(self.sizes))
+                self.version = context.RawValue('l', 0)
+                self.lock = context.Lock()
+
+        def publish(self, values):
+                flat = np.frombuffer(self.values, dtype=np.float32)
+                with self.lock:
+                        offset = 0
+                        for value, size in zip(values, self.sizes):
+                                flat[offset:offset + size] = value.reshape(-1)
+                                offset += size
+                        self.version.value += 1
+
+        def read(self, known_version):
+                # Returns (version, list of arrays) if the parameters changed since known_version, otherwise None
+                with self.lock:
+                        if self.version.value == known_version:
+                                return None
+                        version = self.version.value
+                        flat = np.frombuffer(self.values, dtype=np.float32).copy()
+                values = []
+                offset = 0
+                for shape, size in zip(self.shapes, self.sizes):
+                        values.append(flat[offset:offset + size].reshape(shape))
+                        offset += size
+                return version, values
+
+# Entry point of an actor process. Each actor owns its environment, AgentModel and an inference-only copy of the global
+# network, refreshed from shared_parameters, and sends (number, rollout, bootstrap value, episode stats) tuples to rollouts.
+def run_actor_process(number, agent_model, env_fn, shared_parameters, rollouts, stop_event, actor_cpus = None):
+        #Spawned processes do not run the __main__ block, so parse the default values of the PySC2 flags here
+        if not FLAGS.is_parsed():
+                FLAGS(sys.argv[:1])
+        agent_model = AgentModel(agent_model=agent_model)
+        network = AC_Network('global', None, agent_model)
+        variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global')
+        placeholders = [tf.placeholder(variable.dtype.base_dtype, variable.get_shape()) for variable in variables]
+        load_parameters = tf.group(*[variable.assign(placeholder) for variable, placeholder in zip(variables, placeholders)])
+        rollout = RolloutBuffer(agent_model, agent_model.max_episodes_kept)
+        print('Initializing environment #{}...'.format(number))
+        env = env_fn()
+        if actor_cpus is not None:
+                #The game keeps the env cores it was started on; encoding, inference and the session's thread pools get the actor cores
+                SC2Placement.pin_current_thread(actor_cpus)
+        version = 0
+        total_steps = 0
+        with tf.Session() as sess:
+                while not stop_event.is_set():
+                        #Download the latest parameters, waiting for the first ones if needed
+                        snapshot = shared_parameters.read(version)
+                        if snapshot is None and version == 0:
+                                sleep(0.1)
+                                continue
+                        if snapshot is not None:
+                                version, values = snapshot
+                                sess.run(load_parameters, feed_dict=dict(zip(placeholders, values)))
+                        rollout.clear()
+                        episode_values = []
+                        episode_reward = 0
+                        episode_step_count = 0
+                        obs = env.reset()
+                        agent_model.reset()
+                        reward, nonspatial_stack, minimap_stack, screen_stack, episode_end = agent_model.process_observation(obs[0])
+                        while not episode_end and not stop_event.is_set():
+                                base_action, arg_sample, v = sample_action(sess, network, screen_stack, minimap_stack, nonspatial_stack, agent_model.available_actions_mask)
+                                a, arguments = build_function_call(agent_model, base_action, arg_sample)
+                                rollout.append(screen_stack, minimap_stack, nonspatial_stack, base_action, arg_sample, v[0,0])
+                                timestep, steps = step_repeated(env, a, agent_model.action_repeat)
+                                agent_model.act(base_action,arguments)
+                                r, nonspatial_stack, minimap_stack, screen_stack, episode_end = agent_model.process_observation(timestep)
+                                rollout.add_reward(r)
+                                episode_values.append(v[0,0])
+                                episode_reward += r
+                                total_steps += steps
+                                episode_step_count += steps
+                                if len(rollout) == rollout.capacity and not episode_end:
+                                        v1 = sess.run(network.value,
+                                                      feed_dict={network.inputs_spatial_screen: screen_stack,network.inputs_spatial_minimap: minimap_stack,network.inputs_nonspatial: nonspatial_stack})[0,0]
+                                        rollouts.put((number, rollout.export(), v1, None))
+                                        if agent_model.rollout_mode == 'nstep':
+                                                rollout.clear()
+                                        else:
+                                                rollout.keep_last(len(rollout) - len(rollout)//2)
+                                        snapshot = shared_parameters.read(version)
+                                        if snapshot is not None:
+                                                version, values = snapshot
+                                                sess.run(load_parameters, feed_dict=dict(zip(placeholders, values)))
+                        if episode_end:
+                                rollouts.put((number, rollout.export(), 0.0, (episode_reward, episode_step_count, np.mean(episode_values), total_steps)))
+        env.close()
+
+# Learner for process-based actors: trains on the rollouts they send and publishes the updated global parameters.
+# Actors run in separate processes so that observation processing and sampling are not serialized on the GIL.
+class ProcessLearner(Learner):
+        def __init__(self,trainer,model_path,global_episodes, env_fns, agent_model, sync_strategy = 'full', actor_cpus = None):
+                Learner.__init__(self,'learner',trainer,agent_model,sync_strategy)
+                self.model_path = model_path
+                self.global_episodes = global_episodes
+                self.increment = self.global_episodes.assign_add(1)
+                self.summary_writer = tf.summary.FileWriter("train_learner")
+                self.rollout = RolloutBuffer(agent_model, agent_model.max_episodes_kept)
+                self.global_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global')
+                # Spawned rather than forked, since the parent process already runs TensorFlow
+                context = multiprocessing.get_context('spawn')
+                self.shared_parameters = SharedParameters([variable.get_shape().as_list() for variable in self.global_vars], context)
+                self.rollouts = context.Queue(maxsize=2 * len(env_fns))
+                self.stop_event = context.Event()
+                self.actors = []
+                for i, env_fn in enumerate(env_fns):
+                        actor = context.Process(target=run_actor_process, args=(i, agent_model, env_fn, self.shared_parameters, self.rollouts, self.stop_event, actor_cpus))
+                        actor.daemon = True
+                        self.actors.append(actor)
+
+        def work(self,gamma,sess,coord,checkpointer):
+                episode_count = sess.run(self.global_episodes)
+                v_l,p_l,e_l,g_n,v_n = 0,0,0,0,0
+                #Actors count their steps from zero, so continue from the counts of a resumed run
+                step_offsets = _steps.copy()
+                self.shared_parameters.publish(sess.run(self.global_vars))
+                for actor in self.actors:
+                        actor.start()
+                print ("Starting learner for {} actor processes".format(len(self.actors)))
+                try:
+                        while not coord.should_stop():
+                                try:
+                                        number, data, bootstrap_value, episode = self.rollouts.get(timeout=1.0)
+                                except queue.Empty:
+                                        continue
+                                if len(data['values']) != 0:
+                                        self.sync(sess)
+                                        self.rollout.load(data)
+                                        v_l,p_l,e_l,g_n,v_n = self.train(self.rollout,sess,gamma,bootstrap_value)
+                                        self.shared_parameters.publish(sess.run(self.global_vars))
+                                if episode is None:
+                                        continue
+                                episode_reward, episode_step_count, mean_value, total_steps = episode
+                                self.episode_rewards.append(episode_reward)
+                                self.episode_lengths.append(episode_step_count)
+                                self.episode_mean_values.append(mean_value)
+                                episode_count += 1
+                                sess.run(self.increment)
+                                record_episode("actor_" + str(number), number, episode_count, step_offsets[number] + total_steps, episode_reward)
+                                checkpointer.maybe_save(episode_count, int(np.sum(_steps)))
+                                if episode_count % self.local_AC.model.max_episodes_kept == 0:
+                                        self.summary_writer.add_summary(self.episode_summary(v_l,p_l,e_l,g_n,v_n), episode_count)
+                                        self.summary_writer.flush()
+                finally:
+                        self.stop_event.set()
+                        for actor in self.actors:
+                                actor.join(10)
+
+## SYNCHRONOUS A2C
+
+# Entry point of a process hosting one environment for VecEnv.
+# Commands are (command, data) tuples: ('reset', None), ('step', FunctionCall) or ('close', None).
+def run_env_process(connection, env_fn, action_repeat = 1):
+        if not FLAGS.is_parsed():
+                FLAGS(sys.argv[:1])
+        env = env_fn()
+        try:
+                while True:
+                        command, data = connection.recv()
+                        if command == 'reset':
+                                connection.send(env.reset()[0])
+                        elif command == 'step':
+                                connection.send(step_repeated(env, data, action_repeat))
+                        elif command == 'close':
+                                break
+        finally:
+                env.close()
+                connection.close()
+
+# Steps several environments in lockstep, each in its own process.
+# env_fns are picklable callables returning an environment, eg. functools.partial(sc2_env.SC2Env, map_name=...).
+class VecEnv():
+        def __init__(self, env_fns, action_repeat = 1):
+                context = multiprocessing.get_context('spawn')
+                self.connections = []
+                self.processes = []
+                for env_fn in env_fns:
+                        connection, env_connection = context.Pipe()
+                        process = context.Process(target=run_env_process, args=(env_connection, env_fn, action_repeat))
+                        process.daemon = True
+                        process.start()
+                        env_connection.close()
+                        self.connections.append(connection)
+                        self.processes.append(process)
+                #Environment steps taken by each environment in the last step, which repeats each action action_repeat times
+                self.steps_taken = [0] * len(env_fns)
+
+        def __len__(self):
+                return len(self.connections)
+
+        def reset(self, indices = None):
+                # Resets the given environments (all by default) and returns their first TimeSteps
+                if indices is None:
+                        indices = range(len(self.connections))
+                for i in indices:
+                        self.connections[i].send(('reset', None))
+                return [self.connections[i].recv() for i in indices]
+
+        def step(self, function_calls):
+                # All environments step concurrently; returns one TimeStep per environment
+                for connection, function_call in zip(self.connections, function_calls):
+                        connection.send(('step', function_call))
+                timesteps = []
+                for k, connection in enumerate(self.connections):
+                        timestep, self.steps_taken[k] = connection.recv()
+                        timesteps.append(timestep)
+                return timesteps
+
+        def close(self):
+                for connection in self.connections:
+                        connection.send(('close', None))
+                for process in self.processes:
+                        process.join(10)
+
+# Synchronous advantage actor-critic: steps every environment of a VecEnv once per batched forward pass, and makes one
+# update from all of their rollouts every rollout_length steps. Episodes continue across updates, as in the Worker.
+class SyncLearner(Learner):
+        def __init__(self,trainer,model_path,global_episodes, env_fns, agent_model, rollout_length, sync_strategy = 'full'):
+                Learner.__init__(self,'a2c',trainer,agent_model,sync_strategy)
+                self.model_path = model_path
+                self.global_episodes = global_episodes
+                self.increment = self.global_episodes.assign_add(1)
+                self.summary_writer = tf.summary.FileWriter("train_a2c")
+                self.rollout_length = rollout_length
+                #One AgentModel and rollout per environment, since the observation encoding keeps per-episode state
+                self.models = [AgentModel(agent_model=agent_model) for _ in env_fns]
+                self.rollouts = [RolloutBuffer(agent_model, rollout_length) for _ in env_fns]
+                print('Initializing {} environments...'.format(len(env_fns)))
+                self.envs = VecEnv(env_fns, agent_model.action_repeat)
+
+        def stack_states(self, states):
+                # Batch the (reward, nonspatial, minimap, screen, episode_end) tuples of process_observation, in environment order
+                screen = np.concatenate([state[3] for state in states])
+                minimap = np.concatenate([state[2] for state in states])
+                nonspatial = np.concatenate([state[1] for state in states])
+                return screen, minimap, nonspatial
+
+        def work(self,gamma,sess,coord,checkpointer):
+                episode_count = sess.run(self.global_episodes)
+                num_envs = len(self.models)
+                v_l,p_l,e_l,g_n,v_n = 0,0,0,0,0
+                total_steps = _steps.astype(np.int64)
+                episode_rewards = np.zeros(num_envs)
+                episode_step_counts = np.zeros(num_envs, dtype=np.int64)
+                episode_values = [[] for _ in range(num_envs)]
+                print ("Starting synchronous A2C on {} environments".format(num_envs))
+                states = []
+                for model, observation in zip(self.models, self.envs.reset()):
+                        model.reset()
+                        states.append(model.process_observation(observation))
+                try:
+                        while not coord.should_stop():
+                                #Download copy of parameters from global network
+                                self.sync(sess)
+                                for rollout in self.rollouts:
+                                        rollout.clear()
+                                #Index in each rollout where the current episode started
+                                segment_starts = [0] * num_envs
+                                segments = []
+                                for step in range(self.rollout_length):
+                                        screen, minimap, nonspatial = self.stack_states(states)
+                                        base_actions, arg_samples, v = sample_actions(sess, self.local_AC, screen, minimap, nonspatial,
+                                                                                      [model.available_actions_mask for model in self.models])
+                                        function_calls = []
+                                        arguments = []
+                                        for k, model in enumerate(self.models):
+                                                arg_sample = dict((arg_name, dict((dim, values[k]) for dim, values in arg.items())) for arg_name, arg in arg_samples.items())
+                                                a, args = build_function_call(model, base_actions[k], arg_sample)
+                                                self.rollouts[k].append(screen[k], minimap[k], nonspatial[k], base_actions[k], arg_sample, v[k,0])
+                                                function_calls.append(a)
+                                                arguments.append(args)
+                                        ended = []
+                                        for k, (model, observation) in enumerate(zip(self.models, self.envs.step(function_calls))):
+                                                model.act(base_actions[k], arguments[k])
+                                                states[k] = model.process_observation(observation)
+                                                r, episode_end = states[k][0], states[k][4]
+                                                self.rollouts[k].add_reward(r)
+                                                episode_values[k].append(v[k,0])
+                                                episode_rewards[k] += r
+                                                episode_step_counts[k] += self.envs.steps_taken[k]
+                                                total_steps[k] += self.envs.steps_taken[k]
+                                                if episode_end:
+                                                        ended.append(k)
+                                        for k in ended:
+                                                #The finished episode's segment needs no bootstrapping
+                                                segments.append((self.rollouts[k], segment_starts[k], len(self.rollouts[k]), 0.0))
+                                                segment_starts[k] = len(self.rollouts[k])
+                                                self.episode_rewards.append(episode_rewards[k])
+                                                self.episode_lengths.append(episode_step_counts[k])
+                                                self.episode_mean_values.append(np.mean(episode_values[k]))
+                                                episode_count += 1
+                                                sess.run(self.increment)
+                                                record_episode(self.name + "_" + str(k), k, episode_count, total_steps[k], episode_rewards[k])
+                                                episode_rewards[k] = 0
+                                                episode_step_counts[k] = 0
+                                                episode_values[k] = []
+                                                checkpointer.maybe_save(episode_count, int(np.sum(_steps)))
+                                                if episode_count % self.local_AC.model.max_episodes_kept == 0:
+                                                        self.summary_writer.add_summary(self.episode_summary(v_l,p_l,e_l,g_n,v_n), episode_count)
+                                                        self.summary_writer.flush()
+                                        if len(ended) != 0:
+                                                for k, observation in zip(ended, self.envs.reset(ended)):
+                                                        self.models[k].reset()
+                                                        states[k] = self.models[k].process_observation(observation)
+                                #Bootstrap the unfinished episodes from the value of their current states, in one batched run
+                                screen, minimap, nonspatial = self.stack_states(states)
+                                v1 = sess.run(self.local_AC.value, feed_dict={self.local_AC.inputs_spatial_screen: screen,self.local_AC.inputs_spatial_minimap: minimap,self.local_AC.inputs_nonspatial: nonspatial})
+                                for k, rollout in enumerate(self.rollouts):
+                                        if segment_starts[k] < len(rollout):
+                                                segments.append((rollout, segment_starts[k], len(rollout), v1[k,0]))
+                                v_l,p_l,e_l,g_n,v_n = self.train_segments(segments,sess,gamma)
+                finally:
+                        self.envs.close()
+
+## DISTRIBUTED TRAINING
+
+# Cluster of the distributed mode from the --ps_hosts and --worker_hosts flags, or None when training in one process.
+# Parameter server tasks hold the global network's variables and the counters, sharded round-robin over the tasks; each
+# worker task runs --num_workers Worker threads against its own environments, with their local networks on the task.
+def cluster_spec():
+	if not FLAGS.job_name:
+		return None
+	if not FLAGS.ps_hosts or not FLAGS.worker_hosts:
+		raise ValueError("Distributed training needs --ps_hosts and --worker_hosts.")
+	return tf.train.ClusterSpec({'ps': FLAGS.ps_hosts.split(','), 'worker': FLAGS.worker_hosts.split(',')})
+
+# Runs the tasks of a cluster of num_ps parameter servers and num_workers worker tasks as processes on localhost, with
+# the remaining command line flags, eg. for testing the distributed mode on one machine. Returns once the workers exit.
+def launch_local_cluster(num_ps, num_workers):
+	sockets = []
+	for _ in range(num_ps + num_workers):
+		sock = socket.socket()
+		sock.bind(('localhost', 0))
+		sockets.append(sock)
+	hosts = ['localhost:{}'.format(sock.getsockname()[1]) for sock in sockets]
+	for sock in sockets:
+		sock.close()
+	args = [sys.executable, sys.argv[0]] + [arg for arg in sys.argv[1:] if not arg.startswith('--local_cluster')]
+	args += ['--ps_hosts=' + ','.join(hosts[:num_ps]), '--worker_hosts=' + ','.join(hosts[num_ps:])]
+	ps_processes = [subprocess.Popen(args + ['--job_name=ps', '--task_index={}'.format(i)]) for i in range(num_ps)]
+	worker_processes = [subprocess.Popen(args + ['--job_name=worker', '--task_index={}'.format(i)]) for i in range(num_workers)]
+	try:
+		return max(process.wait() for process in worker_processes)
+	finally:
+		for process in ps_processes + worker_processes:
+			if process.poll() is None:
+				process.terminate()
+
+# Reports the environment steps per second of the workers of a task and how long they take to fetch the global
+# parameters (the sync stage), every interval seconds, to stdout and to a summary of the task.
+class TaskMonitor():
+        def __init__(self, task_index, workers, interval = 30.):
+                self.task_index = task_index
+                self.workers = workers
+                self.interval = interval
+                self.summary_writer = tf.summary.FileWriter("train_task_"+str(task_index))
+                self.reports = 0
+                self.last_steps = 0
+                self.last_time = time.time()
+
+        def start(self, coord):
+                self.last_steps = sum(_steps[worker.number] for worker in self.workers)
+                self.last_time = time.time()
+                thread = threading.Thread(target=self.serve, args=(coord,))
+                thread.start()
+                return thread
+
+        def serve(self, coord):
+                while not coord.wait_for_stop(self.interval):
+                        self.report()
+
+        def report(self):
+                steps = sum(_steps[worker.number] for worker in self.workers)
+                steps_per_second = (steps - self.last_steps) / (time.time() - self.last_time)
+                self.last_steps = steps
+                self.last_time = time.time()
+                fetch_durations = [duration for worker in self.workers for duration in list(worker.timer.durations.get('sync', []))]
+                summary = tf.Summary()
+                summary.value.add(tag='Distributed/Env Steps Per Second', simple_value=float(steps_per_second))
+                message = "Task worker:{} {:.1f} env steps/sec".format(self.task_index, steps_per_second)
+                if len(fetch_durations) > 0:
+                        for q, value in zip((50, 95, 99), np.percentile(fetch_durations, (50, 95, 99))):
+                                summary.value.add(tag='Distributed/Parameter Fetch p{0} (ms)'.format(q), simple_value=float(value * 1000.))
+                                message += " fetch p{}: {:.2f}ms".format(q, value * 1000.)
+                print(message)
+                self.reports += 1
+                self.summary_writer.add_summary(summary, self.reports)
+                self.summary_writer.flush()
+
+## CHECKPOINTING
+
+# Statistics of a training run that are not TensorFlow variables, saved with each checkpoint
+def training_state(learners):
+	return {'max_score': float(_max_score), 'running_avg_score': float(_running_avg_score),
+	        'steps': _steps.tolist(), 'episodes': _episodes.tolist(),
+	        'learners': dict((learner.name, learner.training_state()) for learner in learners)}
+
+def restore_training_state(state, learners):
+	global _max_score, _running_avg_score
+	_max_score = state['max_score']
+	_running_avg_score = state['running_avg_score']
+	# The number of workers may differ from the saved run
+	count = min(len(_steps), len(state['steps']))
+	_steps[:count] = state['steps'][:count]
+	_episodes[:count] = state['episodes'][:count]
+	for learner in learners:
+		if learner.name in state['learners']:
+			learner.restore_training_state(state['learners'][learner.name])
+
+# Writes checkpoints from a background thread so that workers don't wait on the disk.
+# A checkpoint is a directory model_path/checkpoint-<episode> holding the TF variables (with the optimizer state) and
+# training_state.json. It is written under a temporary name then renamed, and the 'latest' file is replaced atomically
+# to point at it, so an interrupted write never leaves a partial checkpoint behind. Only the last keep checkpoints are kept.
+# A checkpoint is due after interval_episodes episodes, interval_seconds seconds or interval_steps environment steps
+# (each disabled by 0), checked whenever an episode ends; save_final writes one more when training stops.
+class CheckpointWriter():
+        def __init__(self, saver, model_path, state_fn, keep = 5, interval_episodes = 100, interval_seconds = 0, interval_steps = 0):
+                self.saver = saver
+                self.model_path = model_path
+                self.state_fn = state_fn
+                self.keep = keep
+                self.interval_episodes = interval_episodes
+                self.interval_seconds = interval_seconds
+                self.interval_steps = interval_steps
+                self.requests = queue.Queue(maxsize=1)
+                self.lock = threading.Lock()
+                self.last_episode = 0
+                self.last_step = 0
+                self.last_time = time.time()
+                #Latest episode count reported to maybe_save, which names the final checkpoint
+                self.latest_episode = 0
+                self.thread = None
+
+        def start(self, sess, coord, episode_count, step_count = 0):
+                self.last_episode = episode_count
+                self.latest_episode = episode_count
+                self.last_step = step_count
+                self.last_time = time.time()
+                self.thread = threading.Thread(target=self.serve, args=(sess, coord))
+                self.thread.start()
+                return self.thread
+
+        def maybe_save(self, episode_count, step_count = 0):
+                # Requests a checkpoint if one is due; never blocks. Returns whether one was requested.
+                with self.lock:
+                        self.latest_episode = max(self.latest_episode, episode_count)
+                        due = self.interval_episodes > 0 and episode_count - self.last_episode >= self.interval_episodes
+                        due = due or (self.interval_seconds > 0 and time.time() - self.last_time >= self.interval_seconds)
+                        due = due or (self.interval_steps > 0 and step_count - self.last_step >= self.interval_steps)
+                        if not due:
+                                return False
+                        try:
+                                #The non-TF state is captured now; the variables when the writer gets to the request
+                                self.requests.put_nowait((episode_count, self.state_fn()))
+                        except queue.Full:
+                                # The previous checkpoint is still being written, try again later
+                                return False
+                        self.last_episode = episode_count
+                        self.last_step = step_count
+                        self.last_time = time.time()
+                        return True
+
+        def save_final(self, sess, step_count):
+                # Writes the state training stopped in, once the workers and the writer thread have finished, unless nothing
+                # has been trained since the last checkpoint. A request the writer thread didn't get to is superseded by it.
+                with self.lock:
+                        while not self.requests.empty():
+                                self.requests.get_nowait()
+                        if self.latest_episode == self.last_episode and step_count == self.last_step:
+                                return
+                        self.write(sess, self.latest_episode, self.state_fn())
+                        self.last_episode = self.latest_episode
+                        self.last_step = step_count
+
+        def serve(self, sess, coord):
+                while not coord.should_stop():
+                        try:
+                                episode_count, state = self.requests.get(timeout=1.0)
+                        except queue.Empty:
+                                continue
+                        self.write(sess, episode_count, state)
+
+        def write(self, sess, episode_count, state):
+                name = 'checkpoint-' + str(episode_count)
+                final_path = os.path.join(self.model_path, name)
+                temp_path = os.path.join(self.model_path, '.' + name + '.tmp')
+                if os.path.exists(temp_path):
+                        shutil.rmtree(temp_path)
+                os.makedirs(temp_path)
+                self.saver.save(sess, os.path.join(temp_path, 'model.cptk'), write_meta_graph=False, write_state=False)
+                with open(os.path.join(temp_path, 'training_state.json'), 'w') as state_file:
+                        json.dump(state, state_file)
+                if os.path.exists(final_path):
+                        shutil.rmtree(final_path)
+                os.rename(temp_path, final_path)
+                with open(os.path.join(self.model_path, 'latest.tmp'), 'w') as latest_file:
+                        latest_file.write(name)
+                os.replace(os.path.join(self.model_path, 'latest.tmp'), os.path.join(self.model_path, 'latest'))
+                print ("Saved Model " + name)
+                # Retention
+                checkpoints = sorted([entry for entry in os.listdir(self.model_path) if entry.startswith('checkpoint-')], key=lambda entry: int(entry.split('-')[1]))
+                for entry in checkpoints[:-self.keep]:
+                        shutil.rmtree(os.path.join(self.model_path, entry))
+
+        @staticmethod
+        def latest(model_path):
+                # Returns the directory of the latest complete checkpoint in model_path, or None
+                latest_path = os.path.join(model_path, 'latest')
+                if not os.path.exists(latest_path):
+                        return None
+                with open(latest_path) as latest_file:
+                        return os.path.join(model_path, latest_file.read().strip())
+
+# Summary of a training run for --results_file: its episode and step counts, throughput and rewards, where the mean
+# reward is over the last max_episodes_kept episodes of every learner.
+def training_results(learners, seconds):
+	recent_rewards = [reward for learner in learners for reward in learner.episode_rewards[-learner.local_AC.model.max_episodes_kept:]]
+	return {'seconds': seconds, 'episodes': int(np.sum(_episodes)), 'steps': int(np.sum(_steps)),
+	        'steps_per_second': float(np.sum(_steps) / seconds) if seconds > 0 else 0.,
+	        'mean_reward': float(np.mean(recent_rewards)) if len(recent_rewards) > 0 else None,
+	        'max_score': float(_max_score), 'running_avg_score': float(_running_avg_score)}
+
 def main():
-        max_episode_length = 300
-        gamma = .99 # Discount rate for advantage estimation and reward discounting
-        load_model = False
+        gamma = FLAGS.gamma # Discount rate for advantage estimation and reward discounting
         race = 'T'
         model_path = './model'+race
         map_name = FLAGS.map_name
-        max_episodes_kept = 5
-        agent_model = AgentModel(race=race, max_episodes_kept = max_episodes_kept)
+        max_episodes_kept = FLAGS.max_episodes_kept
+        agent_model = AgentModel(race=race, is_training = True, max_episodes_kept = max_episodes_kept, select_encoding = FLAGS.select_encoding, max_selected = FLAGS.max_selected,
+                                 compact_spatial = FLAGS.compact_spatial, normalize_spatial = FLAGS.normalize_spatial, loss_mode = FLAGS.loss_mode,
+                                 rollout_mode = FLAGS.rollout_mode, action_repeat = FLAGS.action_repeat, entropy_beta = FLAGS.entropy_beta,
+                                 gradient_clip = FLAGS.gradient_clip)
         #assert map_name in mini_games.mini_games
+        placement = None
+        if FLAGS.placement != 'none':
+                placement_name = FLAGS.placement
+                if placement_name == 'probe':
+                        placement_name = SC2Placement.probe(SC2Placement.agent_arguments(sys.argv[1:]), FLAGS.probe_seconds)[0]
+                placement = SC2Placement.placement_plan(placement_name)
+                print('Placement ' + SC2Placement.describe(placement))
+                #Thread pools created from here on, eg. by a server, run on the compute cores
+                SC2Placement.pin_current_thread(placement.compute_cpus)
+        #Explicit thread pools, so the session doesn't size them to every core while workers and games also need them
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads or (placement.intra_op_threads if placement is not None else 0),
+                                        inter_op_parallelism_threads=FLAGS.inter_op_threads or (placement.inter_op_threads if placement is not None else 0))
+        cluster = cluster_spec()
+        server = None
+        is_chief = True
+        global_device = "/cpu:0"
+        worker_offset = 0
+        if cluster is not None:
+                if FLAGS.actor_processes > 0 or FLAGS.a2c_envs > 0:
+                        raise ValueError("Distributed training runs worker threads, not actor processes or synchronous A2C.")
+                server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index, config=session_config)
+                if FLAGS.job_name == 'ps':
+                        print('Parameter server {} started'.format(FLAGS.task_index))
+                        server.join()
+                        return
+                #The first worker task initializes the shared variables and writes the checkpoints
+                is_chief = FLAGS.task_index == 0
+                global_device = tf.train.replica_device_setter(worker_device='/job:worker/task:{}/cpu:0'.format(FLAGS.task_index), cluster=cluster)
+                #Worker numbers are unique over the cluster, which keeps their scopes, summaries and seeds apart
+                worker_offset = FLAGS.task_index * FLAGS.num_workers
         tf.reset_default_graph()
+        if FLAGS.seed is not None:
+                # Makes the weight initialization and the in-graph sampling reproducible
+                np.random.seed(FLAGS.seed)
+                tf.set_random_seed(FLAGS.seed)
         if not os.path.exists(model_path):
                 os.makedirs(model_path)
         with tf.device("/cpu:0"): 
-                global_episodes = tf.Variable(0,dtype=tf.int32,name='global_episodes',trainable=False)
-                trainer = tf.train.AdamOptimizer(learning_rate=1e-4)
-                master_network = AC_Network('global',None, AgentModel(agent_model = agent_model)) # Generate global network
+                with tf.device(global_device):
+                        global_episodes = tf.Variable(0,dtype=tf.int32,name='global_episodes',trainable=False)
+                        tf.train.create_global_step() # Counts the updates of the global network, ie. versions its parameters
+                        tf.Variable(agent_model.encoding_config(),name='agent_model_config',trainable=False) # Recorded in checkpoints
+                        trainer = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate)
+                        master_network = AC_Network('global',None, AgentModel(agent_model = agent_model)) # Generate global network
                 #num_workers = multiprocessing.cpu_count() # Set workers to number of available CPU threads
-                num_workers =1# psutil.cpu_count() # Set workers to number of available CPU threads
+                num_workers = FLAGS.num_workers # psutil.cpu_count() # Set workers to number of available CPU threads
+                if FLAGS.actor_processes > 0:
+                        num_workers = FLAGS.actor_processes
+                if FLAGS.a2c_envs > 0:
+                        num_workers = FLAGS.a2c_envs
+                predictor = None
+                if FLAGS.predictor:
+                        predictor = PredictionServer(master_network, FLAGS.predictor_batch_size, FLAGS.predictor_max_wait_ms / 1000., FLAGS.predictor_threads)
                 global _max_score, _running_avg_score, _steps, _episodes
                 _max_score = 0
                 _running_avg_score = 0
-                _steps = np.zeros(num_workers)
-                _episodes = np.zeros(num_workers)
+                _steps = np.zeros(worker_offset + num_workers)
+                _episodes = np.zeros(worker_offset + num_workers)
                 workers = []
-		# Create worker classes
-                for i in range(num_workers):
-                        workers.append(Worker(i,trainer,model_path,global_episodes, map_name, AgentModel(agent_model=agent_model)))
-                saver = tf.train.Saver(max_to_keep=max_episodes_kept)
+                learner = None
+                # One environment per worker, actor or synchronous environment, each seeded with seed + its index
+                env_fns = [make_env_fn(map_name, agent_model, None if FLAGS.seed is None else FLAGS.seed + worker_offset + i,
+                                       FLAGS.fake_env, FLAGS.fake_env_latency_ms / 1000., FLAGS.fake_env_episode_length,
+                                       None if placement is None else placement.env_cpus) for i in range(num_workers)]
+		# Create worker classes, or a learner for actor processes or synchronous environments
+                if FLAGS.actor_processes > 0:
+                        learner = ProcessLearner(trainer,model_path,global_episodes, env_fns, AgentModel(agent_model=agent_model), FLAGS.sync_strategy,
+                                                 None if placement is None else placement.actor_cpus)
+                elif FLAGS.a2c_envs > 0:
+                        learner = SyncLearner(trainer,model_path,global_episodes, env_fns, AgentModel(agent_model=agent_model), FLAGS.rollout_length, FLAGS.sync_strategy)
+                # Optionally, workers only act and learner threads train on their rollouts
+                trajectory_queue = None
+                learners = []
+                if FLAGS.learner_threads > 0 and learner is None:
+                        if FLAGS.vtrace and (predictor is not None or not FLAGS.in_graph_sampling):
+                                raise ValueError("V-trace needs the behaviour log probabilities recorded by in-graph sampling without the predictor.")
+                        trajectory_queue = TrajectoryQueue(FLAGS.trajectory_queue_size)
+                        for i in range(FLAGS.learner_threads):
+                                learners.append(QueueLearner(i,trainer,trajectory_queue, AgentModel(agent_model=agent_model), FLAGS.learner_batch_size,
+                                                             FLAGS.vtrace, FLAGS.vtrace_rho_bar, FLAGS.vtrace_c_bar, FLAGS.sync_strategy))
+                if FLAGS.record_trajectories and learner is not None:
+                        raise ValueError("Trajectories can only be recorded by worker threads, not with actor processes or synchronous A2C.")
+                for i in range(num_workers if learner is None else 0):
+                        recorder = None
+                        if FLAGS.record_trajectories:
+                                recorder = TrajectoryStore.TrajectoryRecorder(FLAGS.record_trajectories, 'worker_' + str(worker_offset + i), agent_model, FLAGS.trajectory_chunk_steps,
+                                                                              FLAGS.trajectory_shard_steps, FLAGS.trajectory_compression)
+                        workers.append(Worker(worker_offset + i,trainer,model_path,global_episodes, env_fns[i], AgentModel(agent_model=agent_model), in_graph_sampling=FLAGS.in_graph_sampling, predictor=predictor,
+                                              trajectory_queue=trajectory_queue, record_log_probs=FLAGS.vtrace and trajectory_queue is not None, sync_strategy=FLAGS.sync_strategy,
+                                              recorder=recorder))
+                saver = tf.train.Saver(sharded=cluster is not None)
+                if FLAGS.warm_start:
+                        #Pretrained checkpoints, eg. from SC2Pretrain.py, only hold the global network
+                        warm_start_saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global'))
+                all_learners = workers + learners + ([learner] if learner is not None else [])
+                checkpoint_interval_episodes = agent_model.save_increment if FLAGS.checkpoint_interval_episodes is None else FLAGS.checkpoint_interval_episodes
+                if not is_chief:
+                        checkpoint_interval_episodes = 0
+                checkpointer = CheckpointWriter(saver, model_path, lambda: training_state(all_learners), FLAGS.checkpoints_kept,
+                                                checkpoint_interval_episodes, FLAGS.checkpoint_interval_seconds if is_chief else 0,
+                                                FLAGS.checkpoint_interval_steps if is_chief else 0)
+                session_target = ''
+                if cluster is not None:
+                        session_target = server.target
+                        #Only the parameter servers and this task are needed, so tasks can start and stop independently
+                        session_config.device_filters.extend(['/job:ps', '/job:worker/task:{}'.format(FLAGS.task_index)])
+                        shared_variables = [variable for variable in tf.global_variables() if variable.device.startswith('/job:ps')]
+                        uninitialized_shared_variables = tf.report_uninitialized_variables(shared_variables)
+                        local_initializer = tf.variables_initializer([variable for variable in tf.global_variables() if not variable.device.startswith('/job:ps')])
+                        task_monitor = TaskMonitor(FLAGS.task_index, workers, FLAGS.task_report_interval)
+                if placement is not None:
+                        #Creating the worker environments left this thread on the env cores
+                        SC2Placement.pin_current_thread(placement.compute_cpus)
 
-        with tf.Session() as sess:
+        with tf.Session(session_target, config=session_config) as sess:
+                if placement is not None:
+                        #The session's thread pools keep the compute cores; the threads started from here on get the actor cores
+                        SC2Placement.pin_current_thread(placement.actor_cpus)
                 coord = tf.train.Coordinator()
-                if load_model == True:
-                        print ('Loading Model...')
-                        ckpt = tf.train.get_checkpoint_state(model_path)
-                        saver.restore(sess,ckpt.model_checkpoint_path)
+                if not is_chief:
+                        print('Waiting for the chief to initialize the shared variables...')
+                        while len(sess.run(uninitialized_shared_variables)) > 0:
+                                sleep(1.0)
+                        sess.run(local_initializer)
+                elif FLAGS.resume:
+                        checkpoint_path = CheckpointWriter.latest(model_path)
+                        if checkpoint_path is None:
+                                raise ValueError("No checkpoint to resume from in {0}.".format(model_path))
+                        print ('Resuming from {}...'.format(checkpoint_path))
+                        check_model_config(os.path.join(checkpoint_path, 'model.cptk'), agent_model)
+                        saver.restore(sess,os.path.join(checkpoint_path, 'model.cptk'))
+                        with open(os.path.join(checkpoint_path, 'training_state.json')) as state_file:
+                                restore_training_state(json.load(state_file), all_learners)
                 else:
                         print('Initializing all variables...')
                         sess.run(tf.global_variables_initializer())
+                        if FLAGS.warm_start:
+                                warm_start_path = FLAGS.warm_start
+                                if os.path.isdir(warm_start_path):
+                                        warm_start_path = os.path.join(warm_start_path, 'model.cptk')
+                                print ('Warm starting the global network from {}...'.format(warm_start_path))
+                                check_model_config(warm_start_path, agent_model)
+                                warm_start_saver.restore(sess, warm_start_path)
+                if predictor is not None:
+                        predictor.start(sess, coord)
+                checkpoint_thread = checkpointer.start(sess, coord, sess.run(global_episodes), int(np.sum(_steps)))
+                start_time = time.time()
+                if FLAGS.max_seconds > 0:
+                        stop_timer = threading.Timer(FLAGS.max_seconds, coord.request_stop)
+                        stop_timer.daemon = True
+                        stop_timer.start()
+                if learner is not None:
+                        try:
+                                learner.work(gamma,sess,coord,checkpointer)
+                        finally:
+                                coord.request_stop()
+                                checkpoint_thread.join()
+                        if is_chief:
+                                checkpointer.save_final(sess, int(np.sum(_steps)))
+                        if FLAGS.results_file:
+                                with open(FLAGS.results_file, 'w') as results_file:
+                                        json.dump(training_results(all_learners, time.time() - start_time), results_file, indent=2)
+                        return
                 #This is where the asynchronous magic happens
 		# Start the "work" process for each worker in a separate thread
                 worker_threads = []
                 for worker in workers:
-                        worker_work = lambda: worker.work(max_episode_length,gamma,sess,coord,saver)
+                        worker_work = lambda: worker.work(gamma,sess,coord,checkpointer)
                         t = threading.Thread(target=(worker_work))
                         t.start()
                         sleep(0.125)
                         worker_threads.append(t)
+                for queue_learner in learners:
+                        learner_work = lambda queue_learner=queue_learner: queue_learner.work(gamma,sess,coord)
+                        t = threading.Thread(target=(learner_work))
+                        t.start()
+                        worker_threads.append(t)
+                worker_threads.append(checkpoint_thread)
+                if cluster is not None:
+                        worker_threads.append(task_monitor.start(coord))
                 coord.join(worker_threads)
+                if is_chief:
+                        checkpointer.save_final(sess, int(np.sum(_steps)))
+                if FLAGS.results_file:
+                        with open(FLAGS.results_file, 'w') as results_file:
+                                json.dump(training_results(all_learners, time.time() - start_time), results_file, indent=2)
 
 if __name__ == '__main__':
         flags.DEFINE_string("map_name", "DefeatRoaches", "Name of the map/minigame")
+        flags.DEFINE_integer("num_workers", 1, "Number of worker threads")
+        flags.DEFINE_integer("actor_processes", 0, "If positive, run this many actor processes feeding a single learner instead of worker threads")
+        flags.DEFINE_integer("a2c_envs", 0, "If positive, train with synchronous A2C on this many environments stepped in lockstep")
+        flags.DEFINE_integer("rollout_length", 16, "Steps per environment in each synchronous A2C update")
+        flags.DEFINE_integer("seed", None, "Random seed for the network initialization, action sampling and environments")
+        flags.DEFINE_boolean("fake_env", False, "Use the deterministic FakeSC2Env instead of StarCraft II, eg. for throughput testing")
+        flags.DEFINE_float("fake_env_latency_ms", 0., "Simulated duration of a FakeSC2Env step")
+        flags.DEFINE_integer("fake_env_episode_length", 300, "Steps per FakeSC2Env episode")
+        flags.DEFINE_integer("learner_threads", 0, "If positive, workers only act and this many learner threads train on their rollouts")
+        flags.DEFINE_integer("learner_batch_size", 4, "Maximum number of rollouts per learner thread update")
+        flags.DEFINE_integer("trajectory_queue_size", 16, "Maximum number of rollouts waiting for the learner threads")
+        flags.DEFINE_boolean("vtrace", False, "Correct learner thread updates for policy lag with V-trace")
+        flags.DEFINE_float("vtrace_rho_bar", 1.0, "V-trace truncation level of the importance weights in the value targets and advantages")
+        flags.DEFINE_float("vtrace_c_bar", 1.0, "V-trace truncation level of the trace coefficients")
+        flags.DEFINE_enum("sync_strategy", "full", _SYNC_STRATEGIES, "How local networks follow the global one: copy on every sync, copy only when the global step has moved, or read the global variables directly")
+        flags.DEFINE_string("record_trajectories", "", "If set, worker threads stream every encoded step to trajectory shards in this directory")
+        flags.DEFINE_integer("trajectory_chunk_steps", 32, "Steps per compressed chunk of a trajectory shard")
+        flags.DEFINE_integer("trajectory_shard_steps", 2048, "Steps per trajectory shard file")
+        flags.DEFINE_integer("trajectory_compression", 1, "zlib level of the trajectory chunks (0 stores them uncompressed, for zero-copy reads)")
+        flags.DEFINE_string("ps_hosts", "", "Comma-separated host:port of the parameter server tasks, for distributed training")
+        flags.DEFINE_string("worker_hosts", "", "Comma-separated host:port of the worker tasks, for distributed training")
+        flags.DEFINE_enum("job_name", "", ["", "ps", "worker"], "Job of this task in the cluster; unset to train in a single process")
+        flags.DEFINE_integer("task_index", 0, "Index of this task within its job; worker task 0 is the chief")
+        flags.DEFINE_string("local_cluster", "", "Launch a cluster of <ps tasks>,<worker tasks> processes on localhost with the other flags, eg. 2,3")
+        flags.DEFINE_float("task_report_interval", 30., "Seconds between the throughput and parameter fetch reports of a worker task")
+        flags.DEFINE_float("gamma", .99, "Discount rate for advantage estimation and reward discounting")
+        flags.DEFINE_float("learning_rate", 1e-4, "Learning rate of the Adam optimizer of the global network")
+        flags.DEFINE_float("entropy_beta", 0.01, "Weight of the entropy bonus in the loss")
+        flags.DEFINE_float("gradient_clip", 40.0, "Global norm the gradients of an update are clipped to")
+        flags.DEFINE_integer("max_episodes_kept", 5, "Episodes averaged in the Perf summaries, and steps per rollout update")
+        flags.DEFINE_float("max_seconds", 0, "If positive, stop training after this many seconds")
+        flags.DEFINE_string("results_file", "", "If set, write the episode and step counts, throughput and rewards of the run to this JSON file when training stops")
+        flags.DEFINE_enum("placement", "none", ["none", "probe"] + SC2Placement.PLANS, "Cores of the environments, actor threads and TF thread pools (see SC2Placement.py); probe times each plan first and uses the fastest")
+        flags.DEFINE_float("probe_seconds", 60., "Training time of each run of --placement=probe")
+        flags.DEFINE_integer("intra_op_threads", 0, "Threads of the session's intra-op pool; 0 uses the placement's, or TensorFlow's default")
+        flags.DEFINE_integer("inter_op_threads", 0, "Threads of the session's inter-op pool; 0 uses the placement's, or TensorFlow's default")
+        flags.DEFINE_boolean("resume", False, "Resume training from the latest checkpoint, including its episode counters and statistics")
+        flags.DEFINE_string("warm_start", "", "Checkpoint (directory or prefix) to initialize the global network from, eg. one written by SC2Pretrain.py; ignored with --resume")
+        flags.DEFINE_integer("checkpoint_interval_episodes", None, "Episodes between checkpoints (0 to disable); defaults to the agent model's save_increment")
+        flags.DEFINE_float("checkpoint_interval_seconds", 0, "Seconds between checkpoints (0 to disable)")
+        flags.DEFINE_integer("checkpoint_interval_steps", 0, "Environment steps between checkpoints, checked at the end of episodes (0 to disable)")
+        flags.DEFINE_integer("checkpoints_kept", 5, "Number of most recent checkpoints kept on disk")
+        flags.DEFINE_boolean("predictor", False, "Evaluate actions for all workers with batched inference on the global network")
+        flags.DEFINE_integer("predictor_batch_size", 16, "Maximum number of requests in a predictor batch")
+        flags.DEFINE_float("predictor_max_wait_ms", 5., "Longest time a request waits for its batch to fill")
+        flags.DEFINE_integer("predictor_threads", 1, "Number of predictor inference threads")
+        flags.DEFINE_enum("select_encoding", "padded", ["padded", "summary"], "Encoding of the cargo and multi_select observations")
+        flags.DEFINE_integer("max_selected", 500, "Maximum number of selected/cargo units encoded")
+        flags.DEFINE_boolean("compact_spatial", False, "Keep screen/minimap observations in compact integer dtypes and decode them in the graph")
+        flags.DEFINE_boolean("normalize_spatial", False, "Divide every screen/minimap layer by its feature scale in the graph")
+        flags.DEFINE_enum("loss_mode", "dense", _LOSS_MODES, "Policy loss over every argument head with one-hot masks, or gathered over the arguments each action uses only")
+        flags.DEFINE_enum("rollout_mode", "overlap", _ROLLOUT_MODES, "After an update on a full rollout, keep its last half for the next one, or train on every step exactly once")
+        flags.DEFINE_integer("action_repeat", 1, "Environment steps per decision: each sampled action is repeated (or followed by no-ops) and the rewards summed")
+        flags.DEFINE_boolean("in_graph_sampling", True, "Sample actions inside the graph; if false, sample in Python (reference mode)")
         FLAGS(sys.argv)
+        if FLAGS.local_cluster:
+                num_ps, num_worker_tasks = [int(count) for count in FLAGS.local_cluster.split(',')]
+                sys.exit(launch_local_cluster(num_ps, num_worker_tasks))
         main()
@@ -0,0 +1,307 @@
+"""
+SC2Benchmarks.py
+Parity checks and microbenchmarks for the CPU hot paths of PySC2_A3C_Agent.py.
+Observations are synthesized from the PySC2 observation spec, so no StarCraft II install is needed.
+Results can be written to a JSON file and compared against a stored baseline, failing on regressions.
+
+Example:
+python SC2Benchmarks.py --screen_size=128 --minimap_size=64 --steps=200 --output=results.json
+python SC2Benchmarks.py --screen_size=128 --minimap_size=64 --steps=200 --baseline=results.json --regression_threshold=0.15
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import json
+import itertools
+import collections
+import numpy as np
+import tensorflow as tf
+from absl import flags
+from absl.flags import FLAGS
+
+from pysc2.env import environment
+from pysc2.lib import actions
+from pysc2.lib import features
+
+import FakeSC2Env
+from PySC2_A3C_Agent import AgentModel, AC_Network, Learner, RolloutBuffer, build_function_call, discount, sample_dist
+
+
+def synthetic_observation(agent_model, rng, step_type=environment.StepType.MID):
+    """Build a TimeStep shaped like the ones SC2Env returns for agent_model's screen and minimap sizes."""
+    spec = features.Features(
+        screen_size_px=(agent_model.screen_size, agent_model.screen_size),
+        minimap_size_px=(agent_model.minimap_size, agent_model.minimap_size)).observation_spec()
+    observation = FakeSC2Env.synthetic_observation(spec, rng, agent_model.variable_features)
+    return environment.TimeStep(step_type=step_type, reward=rng.randint(0, 10), discount=1.0, observation=observation)
+
+
+def synthetic_observations(agent_model, count, seed=0):
+    rng = np.random.RandomState(seed)
+    return [synthetic_observation(agent_model, rng) for _ in range(count)]
+
+
+def check_encoder_parity(agent_model, observations):
+    """Run the vectorized and reference encoders side by side and return the number of outputs that differ."""
+    vectorized = AgentModel(agent_model=agent_model)
+    vectorized.vectorized_encoder = True
+    reference = AgentModel(agent_model=agent_model)
+    reference.vectorized_encoder = False
+    mismatches = 0
+    for step, observation in enumerate(observations):
+        expected = reference.process_observation(observation)
+        actual = vectorized.process_observation(observation)
+        for label, a, b in zip(['reward', 'nonspatial', 'minimap', 'screen', 'episode_end'], actual, expected):
+            if not np.array_equal(a, b) or np.asarray(a).dtype != np.asarray(b).dtype:
+                print('Step {0}: {1} differs between encoders'.format(step, label))
+                mismatches += 1
+        # Feed back the same action into both models so the action counters keep evolving
+        action = step % agent_model.action_count
+        vectorized.act(action, [])
+        reference.act(action, [])
+    return mismatches
+
+
+def benchmark_encoder(agent_model, observations, vectorized_encoder=True, repeats=1):
+    """Return steps/sec of AgentModel.process_observation over observations."""
+    model = AgentModel(agent_model=agent_model)
+    model.vectorized_encoder = vectorized_encoder
+    start = time.time()
+    for _ in range(repeats):
+        for observation in observations:
+            model.process_observation(observation)
+    return repeats * len(observations) / (time.time() - start)
+
+
+def check_spatial_dtype_parity(agent_model, observations, tolerance=1e-6):
+    """Compare network outputs for float32 and compact-dtype spatial inputs, using the same weights.
+
+    Returns the largest absolute difference over the value and every policy output."""
+    weights = None
+    outputs = []
+    for compact_spatial in [False, True]:
+        model = AgentModel(race=agent_model.race, screen_size=agent_model.screen_size, minimap_size=agent_model.minimap_size,
+                           select_encoding=agent_model.select_encoding, max_selected=agent_model.max_selected,
+                           compact_spatial=compact_spatial, normalize_spatial=agent_model.normalize_spatial)
+        graph = tf.Graph()
+        with graph.as_default():
+            network = AC_Network('global', None, model)
+            variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global')
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                if weights is None:
+                    weights = sess.run(variables)
+                else:
+                    for variable, value in zip(variables, weights):
+                        variable.load(value, sess)
+                results = []
+                for observation in observations:
+                    _, nonspatial_stack, minimap_stack, screen_stack, _ = model.process_observation(observation)
+                    results.append(sess.run([network.value, network.policy_base_actions, network.policy_arg],
+                                            feed_dict={network.inputs_spatial_screen: screen_stack,
+                                                       network.inputs_spatial_minimap: minimap_stack,
+                                                       network.inputs_nonspatial: nonspatial_stack}))
+                outputs.append(results)
+    max_difference = 0.
+    for float_result, compact_result in zip(*outputs):
+        value, policy_base, policy_arg = float_result
+        compact_value, compact_policy_base, compact_policy_arg = compact_result
+        max_difference = max(max_difference, np.max(np.abs(value - compact_value)), np.max(np.abs(policy_base - compact_policy_base)))
+        for arg in policy_arg:
+            for dim in policy_arg[arg]:
+                max_difference = max(max_difference, np.max(np.abs(policy_arg[arg][dim] - compact_policy_arg[arg][dim])))
+    if max_difference > tolerance:
+        print('Compact spatial inputs change network outputs by up to {0}'.format(max_difference))
+    return max_difference
+
+
+def loss_mode_model(agent_model, loss_mode):
+    return AgentModel(race=agent_model.race, is_training=True, screen_size=agent_model.screen_size, minimap_size=agent_model.minimap_size,
+                      select_encoding=agent_model.select_encoding, max_selected=agent_model.max_selected,
+                      compact_spatial=agent_model.compact_spatial, normalize_spatial=agent_model.normalize_spatial, loss_mode=loss_mode)
+
+
+def check_loss_parity(agent_model, observations, seed=0):
+    """Compare the policy loss gradients of the dense and sparse loss modes, using the same weights and rollout.
+
+    Returns the largest absolute difference over the gradients of every global network variable."""
+    rollout = synthetic_rollout(agent_model, observations, np.random.RandomState(seed))
+    segments = [(rollout, 0, len(rollout), 0.)]
+    weights = None
+    gradients = []
+    for loss_mode in ['dense', 'sparse']:
+        graph = tf.Graph()
+        with graph.as_default():
+            AC_Network('global', None, loss_mode_model(agent_model, loss_mode))
+            learner = Learner('parity', tf.train.AdamOptimizer(learning_rate=1e-4), loss_mode_model(agent_model, loss_mode))
+            network = learner.local_AC
+            variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'parity')
+            policy_gradients = tf.gradients(network.policy_loss, variables)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                if weights is None:
+                    weights = sess.run(variables)
+                else:
+                    for variable, value in zip(variables, weights):
+                        variable.load(value, sess)
+                feed_dict, _ = learner.build_feed_dict(segments, 0.99)
+                gradients.append(sess.run([gradient for gradient in policy_gradients if gradient is not None], feed_dict=feed_dict))
+    return max(np.max(np.abs(dense - sparse)) for dense, sparse in zip(*gradients))
+
+
+def time_call(fn, number, rounds=3):
+    """Return the best time per call of fn, in seconds, over rounds of number calls."""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.time()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.time() - start) / number)
+    return best
+
+
+def synthetic_rollout(agent_model, observations, rng):
+    """Fill a rollout buffer of agent_model.max_episodes_kept steps from observations, with random actions and rewards.
+
+    Arguments the random action does not take are set to -1, as by the workers."""
+    model = AgentModel(agent_model=agent_model)
+    rollout = RolloutBuffer(agent_model, agent_model.max_episodes_kept)
+    for observation in itertools.islice(itertools.cycle(observations), rollout.capacity):
+        _, nonspatial_stack, minimap_stack, screen_stack, _ = model.process_observation(observation)
+        arg_sample = dict()
+        for arg in actions.TYPES:
+            arg_sample[arg.name] = dict()
+            for dim, size in enumerate(arg.sizes):
+                if size == 0:
+                    size = agent_model.minimap_size if arg.name == 'minimap' else agent_model.screen_size
+                arg_sample[arg.name][dim] = rng.randint(size)
+        base_action = rng.randint(agent_model.action_count)
+        build_function_call(model, base_action, arg_sample)
+        rollout.append(screen_stack, minimap_stack, nonspatial_stack, base_action, arg_sample, rng.rand())
+        rollout.add_reward(rng.randint(0, 10))
+    return rollout
+
+
+def benchmark_hot_paths(agent_model, observations, benchmark_network=True, seed=0):
+    """Time each hot path in isolation and return an OrderedDict of seconds per call."""
+    rng = np.random.RandomState(seed)
+    results = collections.OrderedDict()
+    model = AgentModel(agent_model=agent_model)
+    cycle = itertools.cycle(observations)
+    results['process_observation'] = time_call(lambda: model.process_observation(next(cycle)), len(observations))
+    results['calculate_nonspatial_size'] = time_call(model.calculate_nonspatial_size, 100)
+    base_action_dist = rng.dirichlet(np.ones(model.action_count))[np.newaxis]
+    screen_dist = rng.dirichlet(np.ones(model.screen_size))[np.newaxis]
+    results['sample_dist_base_action'] = time_call(lambda: sample_dist(base_action_dist), 1000)
+    results['sample_dist_screen'] = time_call(lambda: sample_dist(screen_dist), 1000)
+    rewards = rng.rand(model.max_episodes_kept + 1)
+    results['discount'] = time_call(lambda: discount(rewards, 0.99), 1000)
+    if not benchmark_network:
+        return results
+    rollout = synthetic_rollout(agent_model, observations, rng)
+    segments = [(rollout, 0, len(rollout), 0.)]
+    for loss_mode in ['dense', 'sparse']:
+        suffix = '' if loss_mode == 'dense' else '_' + loss_mode
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.set_random_seed(seed)
+            AC_Network('global', None, loss_mode_model(agent_model, loss_mode))
+            learner = Learner('benchmark', tf.train.AdamOptimizer(learning_rate=1e-4), loss_mode_model(agent_model, loss_mode))
+            network = learner.local_AC
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                feed_dict, _ = learner.build_feed_dict(segments, 0.99)
+                # The first runs include graph optimization and allocation, so warm up before timing
+                for _ in range(2):
+                    sess.run(network.apply_grads, feed_dict=feed_dict)
+                if loss_mode == 'dense':
+                    results['build_feed_dict'] = time_call(lambda: learner.build_feed_dict(segments, 0.99), 20)
+                    forward_feed_dict = {network.inputs_spatial_screen: rollout.screen[:1],
+                                         network.inputs_spatial_minimap: rollout.minimap[:1],
+                                         network.inputs_nonspatial: rollout.nonspatial[:1]}
+                    for _ in range(2):
+                        sess.run([network.policy_base_actions, network.policy_arg, network.value], feed_dict=forward_feed_dict)
+                    results['network_forward'] = time_call(
+                        lambda: sess.run([network.policy_base_actions, network.policy_arg, network.value], feed_dict=forward_feed_dict), 20)
+                results['network_backward' + suffix] = time_call(lambda: sess.run(network.apply_grads, feed_dict=feed_dict), 5)
+    return results
+
+
+def benchmark_config(agent_model):
+    return collections.OrderedDict([('race', agent_model.race), ('screen_size', agent_model.screen_size),
+                                    ('minimap_size', agent_model.minimap_size), ('rollout_length', agent_model.max_episodes_kept),
+                                    ('encoding', agent_model.encoding_config())])
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """Return (name, baseline seconds, seconds) for every result slower than its baseline by more than threshold."""
+    regressions = []
+    for name, seconds in results.items():
+        if name in baseline and seconds > baseline[name] * (1. + threshold):
+            regressions.append((name, baseline[name], seconds))
+    return regressions
+
+
+def main():
+    agent_model = AgentModel(race=FLAGS.race, is_training=True, screen_size=FLAGS.screen_size, minimap_size=FLAGS.minimap_size)
+    observations = synthetic_observations(agent_model, FLAGS.steps, FLAGS.seed)
+    print('Checking encoder parity over {0} synthetic observations...'.format(len(observations)))
+    mismatches = check_encoder_parity(agent_model, observations)
+    print('Encoder parity: {0}'.format('OK' if mismatches == 0 else '{0} mismatches'.format(mismatches)))
+    if FLAGS.check_spatial_parity:
+        max_difference = check_spatial_dtype_parity(agent_model, observations[:FLAGS.reference_steps])
+        print('Compact spatial dtype parity: max output difference {0}'.format(max_difference))
+        if max_difference > 1e-6:
+            mismatches += 1
+    if FLAGS.check_loss_parity:
+        max_difference = check_loss_parity(agent_model, observations, FLAGS.seed)
+        print('Sparse loss parity: max policy gradient difference {0}'.format(max_difference))
+        if max_difference > 1e-5:
+            mismatches += 1
+    reference_rate = benchmark_encoder(agent_model, observations[:FLAGS.reference_steps], vectorized_encoder=False)
+    vectorized_rate = benchmark_encoder(agent_model, observations, vectorized_encoder=True, repeats=FLAGS.repeats)
+    print('process_observation reference:  {0:10.1f} steps/sec'.format(reference_rate))
+    print('process_observation vectorized: {0:10.1f} steps/sec ({1:.1f}x)'.format(vectorized_rate, vectorized_rate / reference_rate))
+    results = benchmark_hot_paths(agent_model, observations, FLAGS.benchmark_network, FLAGS.seed)
+    for name, seconds in results.items():
+        print('{0:30s} {1:12.3f} ms/call'.format(name, seconds * 1000.))
+    config = benchmark_config(agent_model)
+    if FLAGS.output:
+        with open(FLAGS.output, 'w') as output_file:
+            json.dump({'config': config, 'results': results}, output_file, indent=2)
+        print('Wrote results to {0}'.format(FLAGS.output))
+    regressions = []
+    if FLAGS.baseline:
+        with open(FLAGS.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['config'] != config:
+            print('Baseline {0} was recorded with {1}, not comparing'.format(FLAGS.baseline, dict(baseline['config'])))
+        else:
+            regressions = compare_to_baseline(results, baseline['results'], FLAGS.regression_threshold)
+            for name, baseline_seconds, seconds in regressions:
+                print('Regression in {0}: {1:.3f} ms/call vs {2:.3f} ms/call in the baseline (+{3:.0%})'.format(
+                    name, seconds * 1000., baseline_seconds * 1000., seconds / baseline_seconds - 1.))
+            print('Baseline comparison: {0}'.format('OK' if len(regressions) == 0 else '{0} regressions'.format(len(regressions))))
+    return mismatches + len(regressions)
+
+
+if __name__ == '__main__':
+    flags.DEFINE_string("race", "T", "Race of the agent model")
+    flags.DEFINE_integer("screen_size", 128, "Screen resolution of the synthetic observations")
+    flags.DEFINE_integer("minimap_size", 64, "Minimap resolution of the synthetic observations")
+    flags.DEFINE_integer("steps", 200, "Number of synthetic observations")
+    flags.DEFINE_integer("reference_steps", 20, "Number of observations timed with the (slow) reference encoder")
+    flags.DEFINE_integer("repeats", 5, "Passes over the observations when timing the vectorized encoder")
+    flags.DEFINE_integer("seed", 0, "Seed for the synthetic observations")
+    flags.DEFINE_boolean("check_spatial_parity", True, "Check that compact spatial dtypes give the same network outputs as float32")
+    flags.DEFINE_boolean("check_loss_parity", True, "Check that the sparse loss mode gives the same policy gradients as the dense one")
+    flags.DEFINE_boolean("benchmark_network", True, "Also time the feed_dict construction and the forward and backward passes of AC_Network")
+    flags.DEFINE_string("output", "", "If set, write the benchmark results to this JSON file")
+    flags.DEFINE_string("baseline", "", "If set, compare the results against this JSON file written with --output")
+    flags.DEFINE_float("regression_threshold", 0.1, "Fractional slowdown over the baseline reported as a regression")
+    FLAGS(sys.argv)
+    sys.exit(1 if main() else 0)
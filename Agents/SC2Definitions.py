@@ -2,6 +2,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import sys
+import json
+import time
+import hashlib
+import collections
+
 from pysc2.lib import actions
 from pysc2.lib import features
 
@@ -232,6 +239,14 @@ UNIT_TYPES = max(max(UNITS["N"].values()), max(UNITS["T"].values()), max(UNITS["
 
 ACTIONS={"N":[], "T":[], "Z":[], "P":[]}
 
+# Action classification and observation specs are cached on disk, keyed by the PySC2 version and the definitions above.
+# Bump CACHE_VERSION when classify_actions or the cache layout change.
+CACHE_VERSION = 1
+CACHE_PATH = os.environ.get('SC2_DEFINITIONS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pysc2-rlagents', 'definitions.json'))
+
+_observation_specs = {}
+_cache_key = []
+
 
 def classify_actions():
   """Provide a rough estimate of actions based on race."""
@@ -241,10 +256,13 @@ def classify_actions():
   for race in UNITS.keys():
     if race not in race_keywords:
         race_keywords[race]=[]
+    # Keywords stay in insertion order, since ties between keywords of the same length go to the first one
+    known_keywords = set(race_keywords[race])
     for unit in UNITS[race].keys():
         keys = unit.lower().split('_')
         for key in keys:
-            if key not in race_keywords[race]:
+            if key not in known_keywords:
+                known_keywords.add(key)
                 race_keywords[race].append(key)
   feats = features.Features(
     screen_size_px=(84,84),
@@ -264,6 +282,113 @@ def classify_actions():
             choice = race
     ACTIONS[choice].append(func.id)
     
+def pysc2_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('pysc2').version
+    except Exception:
+        return 'unknown'
+
+
+def cache_key():
+    """Identifies the PySC2 version and unit definitions a cache was computed from."""
+    if _cache_key:
+        return _cache_key[0]
+    definitions = hashlib.sha1(json.dumps(UNITS, sort_keys=True).encode()).hexdigest()
+    _cache_key.append('{0}-{1}-{2}-{3}'.format(CACHE_VERSION, pysc2_version(), len(actions.FUNCTIONS), definitions))
+    return _cache_key[0]
+
+
+def read_cache(path=None):
+    path = path or CACHE_PATH
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if cache.get('key') != cache_key():
+        return None
+    return cache
+
+
+def write_cache(cache, path=None):
+    """Writes the cache atomically; failures are reported but not fatal, eg. on a read-only home directory."""
+    path = path or CACHE_PATH
+    cache['key'] = cache_key()
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(temp_path, path)
+    except (IOError, OSError) as error:
+        print('Could not write definitions cache {0}: {1}'.format(path, error))
+
+
+def load_actions(path=None):
+    """Fills ACTIONS from the cache if it is valid, otherwise classifies the actions and caches the result."""
+    if all(len(ACTIONS[race]) > 0 for race in ACTIONS):
+        return
+    cache = read_cache(path)
+    if cache is not None and 'actions' in cache:
+        for race in ACTIONS:
+            ACTIONS[race] = list(cache['actions'][race])
+        return
+    print('Classifying actions based on race...')
+    classify_actions()
+    cache = cache or {}
+    cache['actions'] = ACTIONS
+    write_cache(cache, path)
+
+
+def observation_spec(screen_size, minimap_size, path=None):
+    """Observation spec of features.Features for the given resolutions, from memory, the cache, or computed and cached."""
+    spec_key = '{0}x{1}'.format(screen_size, minimap_size)
+    if spec_key not in _observation_specs:
+        cache = read_cache(path) or {}
+        specs = cache.setdefault('observation_specs', {})
+        if spec_key in specs:
+            spec = collections.OrderedDict((label, tuple(shape)) for label, shape in specs[spec_key])
+        else:
+            spec = features.Features(screen_size_px=(screen_size, screen_size), minimap_size_px=(minimap_size, minimap_size)).observation_spec()
+            specs[spec_key] = [(label, list(shape)) for label, shape in spec.items()]
+            write_cache(cache, path)
+        _observation_specs[spec_key] = spec
+    return collections.OrderedDict(_observation_specs[spec_key])
+
+
+def report_startup(screen_size=84, minimap_size=64, repeats=10):
+    """Prints the time spent on action classification and observation specs without and with the caches."""
+    def timed(fn):
+        start = time.time()
+        for _ in range(repeats):
+            fn()
+        return (time.time() - start) / repeats
+    def uncached_actions():
+        for race in ACTIONS:
+            ACTIONS[race] = []
+        classify_actions()
+    def disk_cached_actions():
+        for race in ACTIONS:
+            ACTIONS[race] = []
+        load_actions()
+    def disk_cached_spec():
+        _observation_specs.clear()
+        observation_spec(screen_size, minimap_size)
+    load_actions()
+    observation_spec(screen_size, minimap_size)
+    timings = [('classify_actions', timed(uncached_actions), timed(disk_cached_actions), timed(load_actions)),
+               ('observation_spec', timed(lambda: features.Features(screen_size_px=(screen_size, screen_size), minimap_size_px=(minimap_size, minimap_size)).observation_spec()),
+                timed(disk_cached_spec), timed(lambda: observation_spec(screen_size, minimap_size)))]
+    print('Definitions cache: {0} (key {1})'.format(CACHE_PATH, cache_key()))
+    print('{0:20s} {1:>12s} {2:>12s} {3:>12s}'.format('', 'uncached', 'disk cache', 'in memory'))
+    for name, uncached, disk, memory in timings:
+        print('{0:20s} {1:10.3f}ms {2:10.3f}ms {3:10.3f}ms'.format(name, uncached * 1000., disk * 1000., memory * 1000.))
+    print('Saved per process startup: {0:.1f}ms; per AgentModel after the first: {1:.1f}ms'.format(
+        sum(t[1] - t[2] for t in timings) * 1000., sum(t[1] - t[3] for t in timings) * 1000.))
+
+
 def print_race_actions(race):
     print('Actions for {0}:{1}'.format(race, len(ACTIONS[race])))
     for func in ACTIONS[race]:
@@ -271,8 +396,11 @@ def print_race_actions(race):
     print('\n')
     
 if __name__ == "__main__":
-    classify_actions()
-    for race in ACTIONS:
-      print_race_actions(race)
+    if '--report_startup' in sys.argv:
+      report_startup()
+    else:
+      classify_actions()
+      for race in ACTIONS:
+        print_race_actions(race)
 
 
@@ -0,0 +1,221 @@
+"""
+SC2Evaluate.py
+Scores a checkpoint written by PySC2_A3C_Agent.py without building any of the training graph.
+Only the global network's forward pass and sampling ops are built; its variables are restored from the checkpoint and,
+by default, folded into constants so the evaluation graph holds no variables, optimizer slots, losses or summaries.
+Episodes run on several environments stepped in lockstep, with one batched forward pass per step for all of them.
+
+Example:
+python SC2Evaluate.py --model_path=./modelT --episodes=100 --eval_envs=8
+python SC2Evaluate.py --fake_env --episodes=20 --eval_envs=4 --output=eval.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import collections
+import numpy as np
+import tensorflow as tf
+from absl import flags
+from absl.flags import FLAGS
+
+from pysc2.env import environment
+
+from PySC2_A3C_Agent import (AgentModel, AC_Network, CheckpointWriter, VecEnv, check_model_config, make_env_fn,
+                             sample_actions, build_function_call)
+
+
+def inference_outputs(network):
+    """The tensors evaluation fetches from an AC_Network: the sampled base action and arguments, and the value."""
+    outputs = [network.sample_base_action, network.value]
+    for arg in network.sample_arg.values():
+        outputs.extend(arg.values())
+    return outputs
+
+
+class FrozenNetwork(object):
+    """The inputs and sampling outputs of an AC_Network, looked up by name in a graph its GraphDef was imported into.
+
+    Has the attributes sample_actions uses, so it can stand in for the network."""
+
+    def __init__(self, network, graph):
+        tensor = lambda t: graph.get_tensor_by_name(t.name)
+        self.model = network.model
+        self.inputs_spatial_screen = tensor(network.inputs_spatial_screen)
+        self.inputs_spatial_minimap = tensor(network.inputs_spatial_minimap)
+        self.inputs_nonspatial = tensor(network.inputs_nonspatial)
+        self.available_actions = tensor(network.available_actions)
+        self.sample_base_action = tensor(network.sample_base_action)
+        self.value = tensor(network.value)
+        self.sample_arg = dict((arg_name, dict((dim, tensor(sample)) for dim, sample in arg.items()))
+                               for arg_name, arg in network.sample_arg.items())
+
+
+def find_checkpoint(model_path, checkpoint=''):
+    """Path prefix of the checkpoint to evaluate: the given one, else the latest in model_path.
+
+    checkpoint may be a checkpoint directory written by CheckpointWriter or a checkpoint prefix."""
+    if not checkpoint:
+        checkpoint = CheckpointWriter.latest(model_path)
+        if checkpoint is None:
+            # Checkpoints saved before the background writer was added
+            checkpoint = tf.train.latest_checkpoint(model_path)
+        if checkpoint is None:
+            raise ValueError("No checkpoint to evaluate in {0}.".format(model_path))
+    if os.path.isdir(checkpoint):
+        checkpoint = os.path.join(checkpoint, 'model.cptk')
+    return checkpoint
+
+
+def load_inference_network(agent_model, checkpoint_path, freeze=True):
+    """Build the forward graph of the global network, restore it from checkpoint_path and return (session, network).
+
+    With freeze, the restored variables are converted to constants and only the subgraph feeding inference_outputs is
+    kept, which lets the graph optimizer fold the constant parts of the network."""
+    check_model_config(checkpoint_path, agent_model)
+    graph = tf.Graph()
+    with graph.as_default(), tf.device("/cpu:0"):
+        network = AC_Network('global', None, AgentModel(agent_model=agent_model))
+        saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, 'global'))
+    sess = tf.Session(graph=graph)
+    saver.restore(sess, checkpoint_path)
+    graph.finalize()
+    if not freeze:
+        return sess, network
+    output_names = [output.op.name for output in inference_outputs(network)]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_names)
+    sess.close()
+    frozen_graph = tf.Graph()
+    with frozen_graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    frozen_graph.finalize()
+    return tf.Session(graph=frozen_graph), FrozenNetwork(network, frozen_graph)
+
+
+def evaluate(sess, network, agent_model, env_fns, episodes):
+    """Run episodes evaluation episodes split evenly over the environments of env_fns.
+
+    Returns (episode rewards, episode lengths, decision latencies in seconds), where a decision is the encoding of the
+    observations of every environment, the batched forward pass and the construction of their function calls.
+    Each environment runs a fixed share of the episodes, so short episodes are not over-represented; episodes an
+    environment finishes beyond its share are discarded."""
+    num_envs = len(env_fns)
+    quotas = [episodes // num_envs + (1 if k < episodes % num_envs else 0) for k in range(num_envs)]
+    models = [AgentModel(agent_model=agent_model) for _ in env_fns]
+    envs = VecEnv(env_fns)
+    episode_rewards = []
+    episode_lengths = []
+    latencies = []
+    try:
+        observations = envs.reset()
+        for model in models:
+            model.reset()
+        rewards = np.zeros(num_envs)
+        lengths = np.zeros(num_envs, dtype=np.int64)
+        while sum(quotas) > 0:
+            start = time.time()
+            states = [model.process_observation(observation) for model, observation in zip(models, observations)]
+            base_actions, arg_samples, _ = sample_actions(sess, network,
+                                                          np.concatenate([state[3] for state in states]),
+                                                          np.concatenate([state[2] for state in states]),
+                                                          np.concatenate([state[1] for state in states]),
+                                                          [model.available_actions_mask for model in models])
+            function_calls = []
+            arguments = []
+            for k, model in enumerate(models):
+                arg_sample = dict((arg_name, dict((dim, values[k]) for dim, values in arg.items())) for arg_name, arg in arg_samples.items())
+                function_call, args = build_function_call(model, base_actions[k], arg_sample)
+                function_calls.append(function_call)
+                arguments.append(args)
+            latencies.append(time.time() - start)
+            observations = envs.step(function_calls)
+            ended = []
+            for k, (model, observation) in enumerate(zip(models, observations)):
+                model.act(base_actions[k], arguments[k])
+                rewards[k] += observation.reward
+                lengths[k] += 1
+                if observation.step_type == environment.StepType.LAST:
+                    ended.append(k)
+            for k in ended:
+                if quotas[k] > 0:
+                    quotas[k] -= 1
+                    episode_rewards.append(rewards[k])
+                    episode_lengths.append(lengths[k])
+                    print('Episode {0}/{1} Reward: {2} Length: {3}'.format(len(episode_rewards), episodes, rewards[k], lengths[k]))
+                rewards[k] = 0
+                lengths[k] = 0
+                models[k].reset()
+            if len(ended) != 0:
+                for k, observation in zip(ended, envs.reset(ended)):
+                    observations[k] = observation
+    finally:
+        envs.close()
+    return np.array(episode_rewards), np.array(episode_lengths), np.array(latencies)
+
+
+def summarize(episode_rewards, episode_lengths, latencies, num_envs):
+    summary = collections.OrderedDict()
+    summary['episodes'] = len(episode_rewards)
+    for name, values in [('reward', episode_rewards), ('length', episode_lengths)]:
+        summary[name] = collections.OrderedDict([('mean', float(np.mean(values))), ('std', float(np.std(values))),
+                                                 ('min', float(np.min(values))), ('max', float(np.max(values)))])
+    # The first decisions include graph optimization and allocation
+    latencies = latencies[1:] if len(latencies) > 1 else latencies
+    summary['decision_latency_ms'] = collections.OrderedDict(
+        ('p{0}'.format(q), float(np.percentile(latencies, q) * 1000.)) for q in (50, 90, 95, 99))
+    summary['decisions_per_second'] = float(num_envs / np.mean(latencies))
+    return summary
+
+
+def main():
+    agent_model = AgentModel(race=FLAGS.race, is_training=False, screen_size=FLAGS.screen_size, minimap_size=FLAGS.minimap_size,
+                             select_encoding=FLAGS.select_encoding, max_selected=FLAGS.max_selected,
+                             compact_spatial=FLAGS.compact_spatial, normalize_spatial=FLAGS.normalize_spatial)
+    if FLAGS.seed is not None:
+        np.random.seed(FLAGS.seed)
+    checkpoint_path = find_checkpoint(FLAGS.model_path, FLAGS.checkpoint)
+    print('Evaluating {0}...'.format(checkpoint_path))
+    sess, network = load_inference_network(agent_model, checkpoint_path, FLAGS.freeze)
+    env_fns = [make_env_fn(FLAGS.map_name, agent_model, None if FLAGS.seed is None else FLAGS.seed + i,
+                           FLAGS.fake_env, FLAGS.fake_env_latency_ms / 1000., FLAGS.fake_env_episode_length) for i in range(FLAGS.eval_envs)]
+    with sess:
+        episode_rewards, episode_lengths, latencies = evaluate(sess, network, agent_model, env_fns, FLAGS.episodes)
+    summary = summarize(episode_rewards, episode_lengths, latencies, len(env_fns))
+    print('Episodes: {0}'.format(summary['episodes']))
+    for name in ['reward', 'length']:
+        print('{0:8s} mean {mean:10.2f}  std {std:10.2f}  min {min:10.2f}  max {max:10.2f}'.format(name.capitalize(), **summary[name]))
+    print('Decision latency ({0} envs): {1}'.format(len(env_fns), '  '.join('{0} {1:.2f}ms'.format(q, ms) for q, ms in summary['decision_latency_ms'].items())))
+    print('Decisions/sec: {0:.1f}'.format(summary['decisions_per_second']))
+    if FLAGS.output:
+        with open(FLAGS.output, 'w') as output_file:
+            json.dump({'checkpoint': checkpoint_path, 'summary': summary,
+                       'episode_rewards': episode_rewards.tolist(), 'episode_lengths': episode_lengths.tolist()}, output_file, indent=2)
+        print('Wrote results to {0}'.format(FLAGS.output))
+
+
+if __name__ == '__main__':
+    flags.DEFINE_string("model_path", "./modelT", "Directory of the training run to evaluate")
+    flags.DEFINE_string("checkpoint", "", "Checkpoint directory or prefix to evaluate; defaults to the latest in model_path")
+    flags.DEFINE_string("map_name", "DefeatRoaches", "Name of the map/minigame")
+    flags.DEFINE_integer("episodes", 100, "Number of evaluation episodes")
+    flags.DEFINE_integer("eval_envs", 4, "Number of environments stepped in lockstep, with batched inference")
+    flags.DEFINE_boolean("freeze", True, "Fold the restored variables into constants before evaluating")
+    flags.DEFINE_integer("seed", None, "Random seed for the environments")
+    flags.DEFINE_string("race", "T", "Race of the agent model")
+    flags.DEFINE_integer("screen_size", 128, "Screen resolution the checkpoint was trained with")
+    flags.DEFINE_integer("minimap_size", 128, "Minimap resolution the checkpoint was trained with")
+    flags.DEFINE_enum("select_encoding", "padded", ["padded", "summary"], "Encoding of the cargo and multi_select observations")
+    flags.DEFINE_integer("max_selected", 500, "Maximum number of selected/cargo units encoded")
+    flags.DEFINE_boolean("compact_spatial", False, "Keep screen/minimap observations in compact integer dtypes and decode them in the graph")
+    flags.DEFINE_boolean("normalize_spatial", False, "Divide every screen/minimap layer by its feature scale in the graph")
+    flags.DEFINE_boolean("fake_env", False, "Use the deterministic FakeSC2Env instead of StarCraft II")
+    flags.DEFINE_float("fake_env_latency_ms", 0., "Simulated duration of a FakeSC2Env step")
+    flags.DEFINE_integer("fake_env_episode_length", 300, "Steps per FakeSC2Env episode")
+    flags.DEFINE_string("output", "", "If set, write the per-episode results and statistics to this JSON file")
+    FLAGS(sys.argv)
+    main()
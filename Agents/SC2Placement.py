@@ -0,0 +1,181 @@
+"""
+SC2Placement.py
+Plans which cores the environments, the actor threads and TensorFlow's compute thread pools of PySC2_A3C_Agent.py run
+on, so that they don't compete with each other for the same cores.
+
+The cores this process may run on are grouped by physical core (hyperthreads of a core stay together) and by socket,
+and split into three disjoint sets by the shares of a plan:
+- env: the StarCraft II game processes, and the environment processes of --a2c_envs
+- actor: the Worker, learner, predictor and checkpoint threads and the actor processes of --actor_processes, which
+  encode observations and drive the sessions
+- compute: the intra-op and inter-op thread pools of the TensorFlow session, sized to the compute set
+The 'shared' plan keeps everything on every core, and only sizes the thread pools.
+
+Placement relies on affinity being inherited. The environment factories pin the thread that creates an environment to
+the env set, so the game process inherits it; an environment process stays on the env set, and an actor process moves
+to the actor set once its environment is created, before it starts its session. The agent pins its main thread to the
+compute set while the session creates its thread pools, then to the actor set before it starts its threads.
+
+probe runs the agent for a short time with each plan and returns the one with the highest env steps/sec.
+
+Example:
+python SC2Placement.py
+python SC2Placement.py --probe --probe_seconds=60 -- --fake_env --num_workers=4
+python PySC2_A3C_Agent.py --placement=probe --num_workers=4
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import collections
+import psutil
+from absl import flags
+from absl.flags import FLAGS
+
+AGENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PySC2_A3C_Agent.py')
+
+# Shares of the physical cores given to the (env, actor, compute) sets by each plan
+PLAN_SHARES = collections.OrderedDict([('balanced', (1, 1, 1)),
+                                       ('env_heavy', (2, 1, 1)),
+                                       ('compute_heavy', (1, 1, 2))])
+PLANS = ['shared'] + list(PLAN_SHARES)
+
+# Threads of the inter-op pool: the screen and minimap towers of AC_Network are the widest independent branches
+INTER_OP_THREADS = 2
+
+# Agent flags that a probe run sets itself
+_PROBE_FLAGS = ['--placement', '--max_seconds', '--results_file', '--resume', '--local_cluster', '--noresume']
+
+Placement = collections.namedtuple('Placement', ['name', 'env_cpus', 'actor_cpus', 'compute_cpus', 'intra_op_threads', 'inter_op_threads'])
+
+
+def _read_topology(cpu, name):
+    try:
+        with open('/sys/devices/system/cpu/cpu{0}/topology/{1}'.format(cpu, name)) as topology_file:
+            return int(topology_file.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    return sorted(psutil.Process().cpu_affinity())
+
+
+def core_groups(cpus):
+    """The logical cpus grouped by physical core, ordered by socket and core, where the topology is known."""
+    groups = collections.OrderedDict()
+    for cpu in sorted(cpus):
+        package, core = _read_topology(cpu, 'physical_package_id'), _read_topology(cpu, 'core_id')
+        key = (package, core) if package is not None and core is not None else (0, cpu)
+        groups.setdefault(key, []).append(cpu)
+    return [groups[key] for key in sorted(groups)]
+
+
+def split_cores(groups, shares):
+    """Contiguous runs of groups, one per share and at least one group each, sized in proportion to the shares."""
+    sizes = [max(1, int(round(len(groups) * share / sum(shares)))) for share in shares]
+    # Rounding may hand out more groups than there are; take them back from the largest sets
+    while sum(sizes) > len(groups):
+        sizes[sizes.index(max(sizes))] -= 1
+    sizes[-1] += len(groups) - sum(sizes)
+    sets = []
+    start = 0
+    for size in sizes:
+        sets.append([cpu for group in groups[start:start + size] for cpu in group])
+        start += size
+    return sets
+
+
+def placement_plan(name, cpus=None):
+    """The Placement of plan name over cpus, by default those this process may run on."""
+    if name not in PLANS:
+        raise ValueError("Invalid placement: {0}.\n Placement must be one of {1}.".format(name, PLANS))
+    cpus = available_cpus() if cpus is None else sorted(cpus)
+    if name == 'shared':
+        return Placement(name, cpus, cpus, cpus, len(cpus), INTER_OP_THREADS)
+    groups = core_groups(cpus)
+    if len(groups) < len(PLAN_SHARES[name]):
+        raise ValueError("The {0} placement needs at least {1} cores, {2} are available.".format(name, len(PLAN_SHARES[name]), len(groups)))
+    env_cpus, actor_cpus, compute_cpus = split_cores(groups, PLAN_SHARES[name])
+    return Placement(name, env_cpus, actor_cpus, compute_cpus, len(compute_cpus), min(INTER_OP_THREADS, len(compute_cpus)))
+
+
+def feasible_plans(cpus=None):
+    """Names of the plans that fit the cores of cpus."""
+    cores = len(core_groups(available_cpus() if cpus is None else cpus))
+    return [name for name in PLANS if name == 'shared' or cores >= len(PLAN_SHARES[name])]
+
+
+def pin_current_thread(cpus):
+    """Restrict the calling thread to cpus; threads and processes it starts afterwards inherit the affinity."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    else:
+        # Process wide where threads can't be pinned on their own
+        psutil.Process().cpu_affinity(cpus)
+
+
+def describe(placement):
+    return '{0}: env {1}, actor {2}, compute {3} ({4} intra-op, {5} inter-op threads)'.format(
+        placement.name, placement.env_cpus, placement.actor_cpus, placement.compute_cpus,
+        placement.intra_op_threads, placement.inter_op_threads)
+
+
+def agent_arguments(argv):
+    """The agent flags of argv without those a probe run sets."""
+    return [arg for arg in argv if not any(arg == flag or arg.startswith(flag + '=') for flag in _PROBE_FLAGS)]
+
+
+def probe(arguments, seconds=60., plans=None):
+    """Train with arguments for seconds under each plan (by default every feasible one) and return the fastest.
+
+    Each run is a separate agent process in a temporary directory, so it starts from scratch and leaves no checkpoints
+    or summaries behind. Returns (name of the plan with the most env steps/sec, {plan name: env steps/sec or None})."""
+    plans = feasible_plans() if plans is None else plans
+    rates = collections.OrderedDict()
+    for name in plans:
+        directory = tempfile.mkdtemp(prefix='placement-probe-')
+        try:
+            results_path = os.path.join(directory, 'results.json')
+            with open(os.path.join(directory, 'log.txt'), 'w') as log_file:
+                returncode = subprocess.call([sys.executable, AGENT_SCRIPT] + list(arguments) +
+                                             ['--placement=' + name, '--max_seconds={0}'.format(seconds), '--results_file=' + results_path],
+                                             cwd=directory, stdout=log_file, stderr=subprocess.STDOUT)
+            rates[name] = None
+            if returncode == 0 and os.path.exists(results_path):
+                with open(results_path) as results_file:
+                    rates[name] = json.load(results_file)['steps_per_second']
+            print('Placement {0}: {1}'.format(name, 'failed' if rates[name] is None else '{0:.1f} env steps/sec'.format(rates[name])))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    measured = [name for name in rates if rates[name] is not None]
+    if len(measured) == 0:
+        raise RuntimeError("Every placement probe run failed.")
+    return max(measured, key=lambda name: rates[name]), rates
+
+
+def main(argv):
+    cpus = available_cpus()
+    print('{0} cpus in {1} cores'.format(len(cpus), len(core_groups(cpus))))
+    for name in feasible_plans(cpus):
+        print(describe(placement_plan(name, cpus)))
+    if FLAGS.probe:
+        best, _ = probe(agent_arguments(argv), FLAGS.probe_seconds)
+        print('Fastest placement: {0}'.format(best))
+
+
+if __name__ == '__main__':
+    flags.DEFINE_boolean("probe", False, "Time the agent under every feasible plan, with the flags after --")
+    flags.DEFINE_float("probe_seconds", 60., "Training time of each probe run")
+    argv = FLAGS(sys.argv)
+    if '--' in sys.argv:
+        main(sys.argv[sys.argv.index('--') + 1:])
+    else:
+        main(argv[1:])
@@ -0,0 +1,330 @@
+"""
+SC2Pretrain.py
+Behavior-cloning pretraining of AC_Network's policy heads on trajectories recorded with TrajectoryStore.
+The base action head and every argument head are trained with cross-entropy on the recorded actions; arguments the
+recorded action does not use (-1) are left out, as in the A3C loss.
+
+Samples are streamed from the shards by an input pipeline: chunks are read in a shuffled order by several decode
+threads, mixed in a shuffle buffer, and assembled into batches ahead of the training loop, so the training step does
+not wait on decompression or copying. Checkpoints hold the global network under the names main() uses; start A3C
+from one with `python PySC2_A3C_Agent.py --warm_start=<model_path>/checkpoint-<step>`.
+
+Example:
+python SC2Pretrain.py --data=./trajectories --model_path=./pretrainT --epochs=5
+python SC2Pretrain.py --synthetic --screen_size=64 --minimap_size=64 --steps=200
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import numpy as np
+import tensorflow as tf
+from absl import flags
+from absl.flags import FLAGS
+
+from pysc2.lib import actions
+
+import FakeSC2Env
+import TrajectoryStore
+from PySC2_A3C_Agent import AgentModel, AC_Network, CheckpointWriter, build_function_call
+
+
+def put(target_queue, item, coord):
+    # Blocks until there is room in target_queue, unless the coordinator stops. Returns whether item was queued.
+    while not coord.should_stop():
+        try:
+            target_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get(source_queue, coord):
+    # Blocks until source_queue has an item, unless the coordinator stops, in which case it returns None
+    while not coord.should_stop():
+        try:
+            return source_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+class ShardInputPipeline(object):
+    """Shuffled, prefetched batches of records from the trajectory shards in directory.
+
+    A scheduler thread queues the chunk numbers of every epoch in a random order, decode_threads threads read and
+    decompress the chunks (zlib releases the GIL, so they run in parallel), and a batching thread mixes the records in
+    a shuffle buffer of shuffle_buffer records and assembles feedable batches into a queue of prefetch batches.
+    next_batch returns None once epochs epochs (None for no limit) have been consumed."""
+
+    def __init__(self, directory, batch_size, epochs=1, decode_threads=4, shuffle_buffer=256, prefetch=4, seed=0):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.decode_threads = decode_threads
+        self.rng = np.random.RandomState(seed)
+        reader = TrajectoryStore.TrajectoryReader(directory)
+        if len(reader) == 0:
+            raise ValueError("No trajectories in {0}.".format(directory))
+        self.num_chunks = reader.num_chunks()
+        self.dtype = reader.dtype
+        self.encoding = reader.encoding
+        self.pool = np.zeros(max(shuffle_buffer, batch_size), dtype=self.dtype)
+        self.chunk_numbers = queue.Queue(maxsize=2 * decode_threads)
+        self.decoded = queue.Queue(maxsize=2 * decode_threads)
+        self.batches = queue.Queue(maxsize=prefetch)
+        self.threads = []
+
+    def start(self, coord):
+        self.threads = [threading.Thread(target=self.schedule, args=(coord,)), threading.Thread(target=self.batch, args=(coord,))]
+        self.threads += [threading.Thread(target=self.decode, args=(coord,)) for _ in range(self.decode_threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        return self.threads
+
+    def next_batch(self, coord):
+        return get(self.batches, coord)
+
+    def schedule(self, coord):
+        epoch = 0
+        while self.epochs is None or epoch < self.epochs:
+            for chunk_number in self.rng.permutation(self.num_chunks):
+                if not put(self.chunk_numbers, chunk_number, coord):
+                    return
+            epoch += 1
+        for _ in range(self.decode_threads):
+            put(self.chunk_numbers, None, coord)
+
+    def decode(self, coord):
+        # Readers are not shared between threads: each has its own maps and chunk cache
+        reader = TrajectoryStore.TrajectoryReader(self.directory, cache_chunks=1)
+        while True:
+            chunk_number = get(self.chunk_numbers, coord)
+            if chunk_number is None:
+                put(self.decoded, None, coord)
+                return
+            if not put(self.decoded, reader.chunk(chunk_number), coord):
+                return
+
+    def batch(self, coord):
+        finished_decoders = 0
+        pending = []
+        size = 0
+
+        def take(count):
+            # Up to count records from the decoded chunks, in the order they were decoded
+            nonlocal finished_decoders
+            rows = []
+            while count > 0:
+                if len(pending) == 0:
+                    if finished_decoders == self.decode_threads:
+                        break
+                    records = get(self.decoded, coord)
+                    if records is None:
+                        if coord.should_stop():
+                            break
+                        finished_decoders += 1
+                        continue
+                    pending.append(records)
+                taken = pending[0][:count]
+                pending[0] = pending[0][count:]
+                if len(pending[0]) == 0:
+                    pending.pop(0)
+                rows.append(taken)
+                count -= len(taken)
+            return np.concatenate(rows) if rows else self.pool[:0]
+
+        while not coord.should_stop():
+            rows = take(len(self.pool) - size)
+            self.pool[size:size + len(rows)] = rows
+            size += len(rows)
+            if size == 0:
+                put(self.batches, None, coord)
+                return
+            slots = self.rng.choice(size, min(self.batch_size, size), replace=False)
+            records = self.pool[slots]
+            # Refill the slots with new records; if the stream has ended, fill them with records from the end of the pool
+            rows = take(len(slots))
+            self.pool[slots[:len(rows)]] = rows
+            holes = slots[len(rows):]
+            if len(holes) > 0:
+                new_size = size - len(holes)
+                hole_set = set(holes)
+                targets = sorted(hole for hole in holes if hole < new_size)
+                sources = [i for i in range(new_size, size) if i not in hole_set]
+                self.pool[targets] = self.pool[sources]
+                size = new_size
+            batch = dict((name, np.ascontiguousarray(records[name])) for name in ['screen', 'minimap', 'nonspatial', 'action', 'arguments'])
+            if not put(self.batches, batch, coord):
+                return
+
+
+class BehaviorCloning(object):
+    """Cross-entropy loss of the global network's policy heads on recorded actions, and the op minimizing it."""
+
+    def __init__(self, agent_model, learning_rate):
+        self.network = AC_Network('global', None, AgentModel(agent_model=agent_model))
+        network = self.network
+        self.actions_base = tf.placeholder(shape=[None], dtype=tf.int32)
+        self.actions_arg = tf.placeholder(shape=[None, len(TrajectoryStore.ARGUMENTS)], dtype=tf.int32)
+        batch_size = tf.cast(tf.shape(self.actions_base)[0], tf.float32)
+        self.loss_base = - tf.reduce_sum(tf.one_hot(self.actions_base, agent_model.action_count) *
+                                         tf.log(tf.clip_by_value(network.policy_base_actions, 1e-20, 1.0))) / batch_size
+        self.loss = self.loss_base
+        for column, (arg_name, dim) in enumerate(TrajectoryStore.ARGUMENTS):
+            policy = network.policy_arg[arg_name][dim]
+            # One-hot of an unused (-1) argument is all zeros, so it adds nothing to the loss
+            self.loss += - tf.reduce_sum(tf.one_hot(self.actions_arg[:, column], policy.get_shape().as_list()[1]) *
+                                         tf.log(tf.clip_by_value(policy, 1e-20, 1.0))) / batch_size
+        self.accuracy_base = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(network.policy_base_actions, 1, output_type=tf.int32), self.actions_base), tf.float32))
+        global_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global')
+        self.train_op = tf.train.AdamOptimizer(learning_rate=learning_rate).minimize(self.loss, var_list=global_vars)
+
+    def feed_dict(self, batch):
+        return {self.network.inputs_spatial_screen: batch['screen'],
+                self.network.inputs_spatial_minimap: batch['minimap'],
+                self.network.inputs_nonspatial: batch['nonspatial'],
+                self.actions_base: batch['action'],
+                self.actions_arg: batch['arguments']}
+
+
+def record_synthetic_trajectories(directory, agent_model, steps, episode_length=100, seed=0):
+    """Record steps FakeSC2Env steps with uniformly random available actions and arguments, for testing the pipeline."""
+    env = FakeSC2Env.FakeSC2Env(screen_size_px=(agent_model.screen_size, agent_model.screen_size),
+                                minimap_size_px=(agent_model.minimap_size, agent_model.minimap_size),
+                                random_seed=seed, episode_length=episode_length)
+    model = AgentModel(agent_model=agent_model)
+    recorder = TrajectoryStore.TrajectoryRecorder(directory, 'synthetic', agent_model)
+    rng = np.random.RandomState(seed)
+    arg_sizes = {'screen': agent_model.screen_size, 'screen2': agent_model.screen_size, 'minimap': agent_model.minimap_size}
+    obs = env.reset()
+    model.reset()
+    _, nonspatial_stack, minimap_stack, screen_stack, _ = model.process_observation(obs[0])
+    for _ in range(steps):
+        base_action = rng.choice(np.flatnonzero(model.available_actions_mask))
+        arg_sample = dict((arg.name, dict((dim, rng.randint(size if size > 0 else arg_sizes[arg.name])) for dim, size in enumerate(arg.sizes)))
+                          for arg in actions.TYPES)
+        function_call, arguments = build_function_call(model, base_action, arg_sample)
+        recorder.append(screen_stack, minimap_stack, nonspatial_stack, base_action, arg_sample, 0.)
+        obs = env.step(actions=[function_call])
+        model.act(base_action, arguments)
+        reward, nonspatial_stack, minimap_stack, screen_stack, episode_end = model.process_observation(obs[0])
+        recorder.add_reward(reward, episode_end)
+        if episode_end:
+            obs = env.reset()
+            model.reset()
+            _, nonspatial_stack, minimap_stack, screen_stack, _ = model.process_observation(obs[0])
+    recorder.close()
+    env.close()
+
+
+def main():
+    agent_model = AgentModel(race=FLAGS.race, screen_size=FLAGS.screen_size, minimap_size=FLAGS.minimap_size,
+                             select_encoding=FLAGS.select_encoding, max_selected=FLAGS.max_selected,
+                             compact_spatial=FLAGS.compact_spatial, normalize_spatial=FLAGS.normalize_spatial)
+    data = FLAGS.data
+    if FLAGS.synthetic:
+        data = tempfile.mkdtemp(prefix='synthetic_trajectories_')
+        print('Recording {0} synthetic steps to {1}...'.format(FLAGS.synthetic_steps, data))
+        record_synthetic_trajectories(data, agent_model, FLAGS.synthetic_steps, seed=FLAGS.seed)
+    if not data:
+        raise ValueError("Set --data to a directory of recorded trajectories, or use --synthetic.")
+    try:
+        pipeline = ShardInputPipeline(data, FLAGS.batch_size, FLAGS.epochs if FLAGS.epochs > 0 else None, FLAGS.decode_threads,
+                                      FLAGS.shuffle_buffer, FLAGS.prefetch, FLAGS.seed)
+        if pipeline.encoding != agent_model.encoding_config() or pipeline.dtype != TrajectoryStore.record_dtype(agent_model):
+            raise ValueError("Trajectories in {0} were recorded with encoding '{1}' but the agent model uses '{2}'.".format(
+                data, pipeline.encoding, agent_model.encoding_config()))
+        train(agent_model, pipeline)
+    finally:
+        if FLAGS.synthetic:
+            shutil.rmtree(data)
+
+
+def train(agent_model, pipeline):
+    if not os.path.exists(FLAGS.model_path):
+        os.makedirs(FLAGS.model_path)
+    tf.reset_default_graph()
+    tf.set_random_seed(FLAGS.seed)
+    with tf.device("/cpu:0"):
+        config_variable = tf.Variable(agent_model.encoding_config(), name='agent_model_config', trainable=False)
+        behavior_cloning = BehaviorCloning(agent_model, FLAGS.learning_rate)
+        # Only the global network and the encoding are saved, under the names main() gives them
+        saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'global') + [config_variable])
+    step = 0
+    checkpointer = CheckpointWriter(saver, FLAGS.model_path, lambda: {'pretrain_steps': step}, FLAGS.checkpoints_kept)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        coord = tf.train.Coordinator()
+        pipeline.start(coord)
+        samples = 0
+        wait_time = 0.
+        losses = []
+        accuracies = []
+        interval_start = time.time()
+        try:
+            while FLAGS.steps <= 0 or step < FLAGS.steps:
+                start_time = time.time()
+                batch = pipeline.next_batch(coord)
+                wait_time += time.time() - start_time
+                if batch is None:
+                    break
+                _, loss, accuracy = sess.run([behavior_cloning.train_op, behavior_cloning.loss, behavior_cloning.accuracy_base],
+                                             feed_dict=behavior_cloning.feed_dict(batch))
+                step += 1
+                samples += len(batch['action'])
+                losses.append(loss)
+                accuracies.append(accuracy)
+                if step % FLAGS.log_interval == 0:
+                    elapsed = time.time() - interval_start
+                    print('Step {0} Loss: {1:.4f} Base action accuracy: {2:.3f} Samples/sec: {3:.1f} Input wait: {4:.0%}'.format(
+                        step, np.mean(losses), np.mean(accuracies), samples / elapsed, wait_time / elapsed))
+                    samples = 0
+                    wait_time = 0.
+                    losses = []
+                    accuracies = []
+                    interval_start = time.time()
+                if FLAGS.checkpoint_interval > 0 and step % FLAGS.checkpoint_interval == 0:
+                    checkpointer.write(sess, step, checkpointer.state_fn())
+        finally:
+            coord.request_stop()
+        if step > 0 and (FLAGS.checkpoint_interval <= 0 or step % FLAGS.checkpoint_interval != 0):
+            checkpointer.write(sess, step, checkpointer.state_fn())
+        coord.join(pipeline.threads, stop_grace_period_secs=5)
+
+
+if __name__ == '__main__':
+    flags.DEFINE_string("data", "", "Directory of trajectory shards recorded with --record_trajectories")
+    flags.DEFINE_boolean("synthetic", False, "Pretrain on FakeSC2Env steps with random actions instead, for testing")
+    flags.DEFINE_integer("synthetic_steps", 512, "Number of synthetic steps recorded")
+    flags.DEFINE_string("model_path", "./pretrainT", "Directory the pretrained checkpoints are written to")
+    flags.DEFINE_integer("batch_size", 32, "Samples per update")
+    flags.DEFINE_integer("epochs", 1, "Passes over the trajectories (0 for no limit)")
+    flags.DEFINE_integer("steps", 0, "If positive, stop after this many updates")
+    flags.DEFINE_float("learning_rate", 1e-4, "Adam learning rate")
+    flags.DEFINE_integer("decode_threads", 4, "Threads reading and decompressing trajectory chunks")
+    flags.DEFINE_integer("shuffle_buffer", 256, "Records mixed in the shuffle buffer")
+    flags.DEFINE_integer("prefetch", 4, "Batches assembled ahead of the training loop")
+    flags.DEFINE_integer("checkpoint_interval", 1000, "Updates between checkpoints (0 to only save at the end)")
+    flags.DEFINE_integer("checkpoints_kept", 5, "Number of most recent checkpoints kept on disk")
+    flags.DEFINE_integer("log_interval", 100, "Updates between progress reports")
+    flags.DEFINE_integer("seed", 0, "Seed for the network initialization, shuffling and synthetic data")
+    flags.DEFINE_string("race", "T", "Race of the agent model")
+    flags.DEFINE_integer("screen_size", 128, "Screen resolution of the trajectories")
+    flags.DEFINE_integer("minimap_size", 128, "Minimap resolution of the trajectories")
+    flags.DEFINE_enum("select_encoding", "padded", ["padded", "summary"], "Encoding of the cargo and multi_select observations")
+    flags.DEFINE_integer("max_selected", 500, "Maximum number of selected/cargo units encoded")
+    flags.DEFINE_boolean("compact_spatial", False, "Keep screen/minimap observations in compact integer dtypes and decode them in the graph")
+    flags.DEFINE_boolean("normalize_spatial", False, "Divide every screen/minimap layer by its feature scale in the graph")
+    FLAGS(sys.argv)
+    main()
@@ -0,0 +1,242 @@
+"""
+SC2Sweep.py
+Runs a hyperparameter sweep of PySC2_A3C_Agent.py as a pool of independent training processes.
+
+The search space is a JSON object mapping agent flags to their values. For a grid search every value is a list and
+every combination is run; for a random search, --trials configs are drawn, where a list is sampled uniformly and
+{"uniform": [low, high]}, {"loguniform": [low, high]} or {"randint": [low, high]} (inclusive) sample a range.
+
+Each run gets a directory <sweep_dir>/run-<n> which is its working directory, so its modelT checkpoints and train_N
+summaries stay apart from the other runs, and its output goes to log.txt there. Runs are pinned to disjoint sets of
+--cpus_per_run CPUs, and at most as many runs as there are such sets run at once. Every run trains for --max_seconds
+and writes its results (see --results_file of the agent); the sweep then prints a table of reward and throughput per
+config and writes it to <sweep_dir>/results.csv and results.json.
+
+Flags after -- are passed to every run.
+
+Example:
+python SC2Sweep.py --space='{"learning_rate": [1e-4, 3e-4], "entropy_beta": [0.01, 0.03]}' --cpus_per_run=2 -- --fake_env --num_workers=2
+python SC2Sweep.py --search=random --trials=8 --space=space.json --max_seconds=1800
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import csv
+import time
+import json
+import itertools
+import subprocess
+import collections
+import numpy as np
+import psutil
+from absl import flags
+from absl.flags import FLAGS
+
+_SEARCHES = ['grid', 'random']
+_DISTRIBUTIONS = ['uniform', 'loguniform', 'randint']
+
+AGENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PySC2_A3C_Agent.py')
+
+# Columns of the results table taken from the results file of a run
+RESULT_COLUMNS = ['mean_reward', 'max_score', 'episodes', 'steps', 'steps_per_second']
+
+
+def load_space(space):
+    """The search space from a JSON string or the path of a JSON file."""
+    if os.path.isfile(space):
+        with open(space) as space_file:
+            space = space_file.read()
+    space = json.loads(space, object_pairs_hook=collections.OrderedDict)
+    for name, values in space.items():
+        if isinstance(values, dict):
+            if len(values) != 1 or list(values)[0] not in _DISTRIBUTIONS:
+                raise ValueError("Invalid distribution of {0}: {1}.\n Distribution must be one of {2}.".format(name, values, _DISTRIBUTIONS))
+        elif not isinstance(values, list) or len(values) == 0:
+            raise ValueError("Values of {0} must be a non-empty list or a distribution, not {1}.".format(name, values))
+    return space
+
+
+def grid_configs(space):
+    """Every combination of the values of the space, in order."""
+    for name, values in space.items():
+        if not isinstance(values, list):
+            raise ValueError("A grid search needs a list of values for {0}, not {1}.".format(name, values))
+    return [collections.OrderedDict(zip(space.keys(), values)) for values in itertools.product(*space.values())]
+
+
+def sample_value(values, rng):
+    if isinstance(values, list):
+        return values[rng.randint(len(values))]
+    distribution, (low, high) = list(values.items())[0]
+    if distribution == 'uniform':
+        return float(rng.uniform(low, high))
+    if distribution == 'loguniform':
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    return int(rng.randint(low, high + 1))
+
+
+def random_configs(space, trials, seed=None):
+    """trials configs with every value drawn independently from the space."""
+    rng = np.random.RandomState(seed)
+    return [collections.OrderedDict((name, sample_value(values, rng)) for name, values in space.items()) for _ in range(trials)]
+
+
+def cpu_sets(cpus_per_run, max_parallel=0):
+    """Disjoint sets of cpus_per_run CPUs out of those this process may run on, at most max_parallel of them if positive."""
+    cpus = sorted(psutil.Process().cpu_affinity())
+    count = len(cpus) // cpus_per_run
+    if count == 0:
+        raise ValueError("Runs need {0} CPUs each but only {1} are available.".format(cpus_per_run, len(cpus)))
+    if max_parallel > 0:
+        count = min(count, max_parallel)
+    return [cpus[k * cpus_per_run:(k + 1) * cpus_per_run] for k in range(count)]
+
+
+def flag_arguments(config):
+    arguments = []
+    for name, value in config.items():
+        if isinstance(value, bool):
+            arguments.append('--{0}'.format(name) if value else '--no{0}'.format(name))
+        else:
+            arguments.append('--{0}={1}'.format(name, value))
+    return arguments
+
+
+class Run(object):
+    """One training process of the sweep, in its own directory and pinned to cpus."""
+
+    def __init__(self, number, config, sweep_dir, extra_arguments, max_seconds):
+        self.number = number
+        self.config = config
+        self.directory = os.path.abspath(os.path.join(sweep_dir, 'run-{0}'.format(number)))
+        self.results_path = os.path.join(self.directory, 'results.json')
+        self.arguments = ([sys.executable, AGENT_SCRIPT] + flag_arguments(config) + list(extra_arguments) +
+                          ['--max_seconds={0}'.format(max_seconds), '--results_file={0}'.format(self.results_path)])
+        self.max_seconds = max_seconds
+        self.process = None
+        self.cpus = None
+        self.start_time = None
+        self.status = 'pending'
+
+    def start(self, cpus):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, 'config.json'), 'w') as config_file:
+            json.dump({'config': self.config, 'arguments': self.arguments, 'cpus': cpus}, config_file, indent=2)
+        self.cpus = cpus
+        # Set in the child before the agent starts, so every thread it creates inherits the affinity
+        pin = lambda: psutil.Process().cpu_affinity(cpus)
+        with open(os.path.join(self.directory, 'log.txt'), 'w') as log_file:
+            self.process = subprocess.Popen(self.arguments, cwd=self.directory, stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=pin)
+        self.start_time = time.time()
+        self.status = 'running'
+        print('Run {0} on CPUs {1}: {2}'.format(self.number, cpus, ' '.join(flag_arguments(self.config))))
+
+    def poll(self, timeout_seconds):
+        """Whether the run has ended, killing it once it has run timeout_seconds past its training time."""
+        if self.process.poll() is None:
+            if time.time() - self.start_time < self.max_seconds + timeout_seconds:
+                return False
+            self.process.kill()
+            self.process.wait()
+            self.status = 'timeout'
+        elif self.process.returncode != 0:
+            self.status = 'failed ({0})'.format(self.process.returncode)
+        else:
+            self.status = 'done'
+        if self.status == 'done' and not os.path.exists(self.results_path):
+            self.status = 'no results'
+        return True
+
+    def row(self):
+        row = collections.OrderedDict([('run', self.number), ('status', self.status)])
+        row.update(self.config)
+        results = {}
+        if os.path.exists(self.results_path):
+            with open(self.results_path) as results_file:
+                results = json.load(results_file)
+        for column in RESULT_COLUMNS:
+            row[column] = results.get(column)
+        return row
+
+
+def run_sweep(configs, sweep_dir, extra_arguments, cpus_per_run, max_parallel, max_seconds, timeout_seconds, poll_seconds=1.):
+    """Run every config, as many at once as there are CPU sets, and return the results table rows in config order."""
+    free_cpu_sets = cpu_sets(cpus_per_run, max_parallel)
+    print('Running {0} configs, {1} at a time'.format(len(configs), len(free_cpu_sets)))
+    pending = collections.deque(Run(number, config, sweep_dir, extra_arguments, max_seconds) for number, config in enumerate(configs))
+    runs = list(pending)
+    running = []
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(free_cpu_sets) > 0:
+                run = pending.popleft()
+                run.start(free_cpu_sets.pop(0))
+                running.append(run)
+            time.sleep(poll_seconds)
+            for run in [run for run in running if run.poll(timeout_seconds)]:
+                running.remove(run)
+                free_cpu_sets.append(run.cpus)
+                print('Run {0} {1} after {2:.0f}s'.format(run.number, run.status, time.time() - run.start_time))
+    finally:
+        for run in running:
+            if run.process.poll() is None:
+                run.process.kill()
+    return [run.row() for run in runs]
+
+
+def format_table(rows):
+    columns = list(rows[0].keys())
+    cell = lambda value: '-' if value is None else ('{0:.4g}'.format(value) if isinstance(value, float) else str(value))
+    cells = [[cell(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(column), *[len(line[k]) for line in cells]) for k, column in enumerate(columns)]
+    lines = ['  '.join(column.ljust(width) for column, width in zip(columns, widths))]
+    lines += ['  '.join(value.ljust(width) for value, width in zip(line, widths)) for line in cells]
+    return '\n'.join(lines)
+
+
+def write_results(rows, sweep_dir):
+    columns = []
+    for row in rows:
+        columns.extend(column for column in row if column not in columns)
+    with open(os.path.join(sweep_dir, 'results.csv'), 'w') as csv_file:
+        writer = csv.DictWriter(csv_file, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(os.path.join(sweep_dir, 'results.json'), 'w') as json_file:
+        json.dump(rows, json_file, indent=2)
+
+
+def main(argv):
+    space = load_space(FLAGS.space)
+    configs = grid_configs(space) if FLAGS.search == 'grid' else random_configs(space, FLAGS.trials, FLAGS.seed)
+    if not os.path.exists(FLAGS.sweep_dir):
+        os.makedirs(FLAGS.sweep_dir)
+    rows = run_sweep(configs, FLAGS.sweep_dir, argv, FLAGS.cpus_per_run, FLAGS.max_parallel, FLAGS.max_seconds, FLAGS.timeout_seconds)
+    # Best configs first; runs without a reward last
+    rows.sort(key=lambda row: -np.inf if row['mean_reward'] is None else row['mean_reward'], reverse=True)
+    print(format_table(rows))
+    write_results(rows, FLAGS.sweep_dir)
+    print('Wrote results to {0}'.format(os.path.join(FLAGS.sweep_dir, 'results.csv')))
+
+
+if __name__ == '__main__':
+    flags.DEFINE_string("space", "", "Search space as a JSON object of flag name to values, or the path of a JSON file holding it")
+    flags.DEFINE_enum("search", "grid", _SEARCHES, "Run every combination of the values, or --trials random draws")
+    flags.DEFINE_integer("trials", 8, "Number of configs of a random search")
+    flags.DEFINE_integer("seed", None, "Random seed of a random search")
+    flags.DEFINE_string("sweep_dir", "./sweep", "Directory of the run directories and the results table")
+    flags.DEFINE_integer("cpus_per_run", 1, "CPUs each run is pinned to; the sets of different runs don't overlap")
+    flags.DEFINE_integer("max_parallel", 0, "If positive, at most this many runs at once; otherwise as many as there are CPU sets")
+    flags.DEFINE_float("max_seconds", 600., "Training time of each run")
+    flags.DEFINE_float("timeout_seconds", 300., "Time a run gets past its training time to stop and write its results before it is killed")
+    argv = FLAGS(sys.argv)
+    if '--' in sys.argv:
+        extra_arguments = sys.argv[sys.argv.index('--') + 1:]
+    else:
+        extra_arguments = argv[1:]
+    main(extra_arguments)
@@ -0,0 +1,248 @@
+"""
+TrajectoryStore.py
+Streams the encoded steps of training episodes to disk and reads them back for offline analysis.
+
+A store is a directory of shards. A shard file holds fixed-schema records, one per step, with the encoded
+screen, minimap and nonspatial observations, the base action, the arguments (-1 where the action does not use them),
+the reward, the value estimate and the episode and step numbers. Records are grouped into chunks that are written,
+optionally zlib-compressed, back to back. Next to each shard, <shard>.json records the schema and the offset, size and
+row count of every chunk written so far, and is replaced atomically after each chunk, so a shard can be read while it
+is being written.
+
+The reader memory-maps the shards. A random access decompresses only the chunk holding the record; uncompressed
+shards are read without copying.
+
+Example:
+python PySC2_A3C_Agent.py --record_trajectories=./trajectories
+reader = TrajectoryReader('./trajectories'); reader[1234]['reward']
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import zlib
+import json
+import queue
+import threading
+import collections
+import numpy as np
+
+from pysc2.lib import actions
+
+SCHEMA_VERSION = 1
+
+# Order of the (argument name, dimension) columns of the 'arguments' field
+ARGUMENTS = [(arg.name, dim) for arg in actions.TYPES for dim in range(len(arg.sizes))]
+
+# Location of a chunk inside a shard file
+Chunk = collections.namedtuple('Chunk', ['offset', 'size', 'rows'])
+
+
+def record_dtype(agent_model):
+    """Structured dtype of one step encoded by agent_model."""
+    return np.dtype([('screen', agent_model.screen_dtype, (agent_model.screen_size, agent_model.screen_size, agent_model.screen_channels)),
+                     ('minimap', agent_model.minimap_dtype, (agent_model.minimap_size, agent_model.minimap_size, agent_model.minimap_channels)),
+                     ('nonspatial', np.float32, (agent_model.nonspatial_size,)),
+                     ('action', np.int32),
+                     ('arguments', np.int32, (len(ARGUMENTS),)),
+                     ('reward', np.float32),
+                     ('value', np.float32),
+                     ('episode', np.int64),
+                     ('step', np.int32),
+                     ('last', np.bool_)])
+
+
+def arguments_dict(arguments):
+    """Convert an 'arguments' field (of one record or of many) to the {arg name: {dim: value}} layout of arg_sample."""
+    arg_sample = collections.defaultdict(dict)
+    for column, (arg_name, dim) in enumerate(ARGUMENTS):
+        arg_sample[arg_name][dim] = arguments[..., column]
+    return dict(arg_sample)
+
+
+class TrajectoryRecorder(object):
+    """Records the steps of one actor to shards named <name>-<shard number>.
+
+    append and add_reward mirror RolloutBuffer: a step is appended when the action is chosen and its reward is added
+    once the environment has stepped. Full chunks go to a background thread that compresses and writes them; the
+    queue between the two is bounded by max_pending chunks, after which append blocks rather than growing memory."""
+
+    def __init__(self, directory, name, agent_model, chunk_steps=32, shard_steps=2048, compression=1, max_pending=4):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.name = name
+        self.dtype = record_dtype(agent_model)
+        self.encoding = agent_model.encoding_config()
+        self.chunk_steps = chunk_steps
+        self.shard_steps = shard_steps
+        self.compression = compression
+        self.chunk = np.zeros(chunk_steps, dtype=self.dtype)
+        self.length = 0
+        # Continue the numbering of a previous run recording to the same directory
+        self.shard_number = len([entry for entry in os.listdir(directory) if entry.startswith(name + '-') and entry.endswith('.json')])
+        self.episode = 0
+        self.episode_step = 0
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, screen, minimap, nonspatial, base_action, arg_sample, value):
+        if self.error is not None:
+            raise self.error
+        if self.length == self.chunk_steps:
+            self.flush()
+        record = self.chunk[self.length]
+        record['screen'] = screen.reshape(self.dtype['screen'].shape)
+        record['minimap'] = minimap.reshape(self.dtype['minimap'].shape)
+        record['nonspatial'] = nonspatial.reshape(self.dtype['nonspatial'].shape)
+        record['action'] = base_action
+        record['arguments'] = [arg_sample[arg_name][dim] for arg_name, dim in ARGUMENTS]
+        record['reward'] = 0
+        record['value'] = value
+        record['episode'] = self.episode
+        record['step'] = self.episode_step
+        record['last'] = False
+        self.length += 1
+        self.episode_step += 1
+
+    def add_reward(self, reward, episode_end=False):
+        self.chunk[self.length - 1]['reward'] += reward
+        if episode_end:
+            self.chunk[self.length - 1]['last'] = True
+            self.episode += 1
+            self.episode_step = 0
+
+    def flush(self):
+        """Hand the buffered steps to the writer thread."""
+        if self.length == 0:
+            return
+        self.pending.put(self.chunk[:self.length])
+        self.chunk = np.zeros(self.chunk_steps, dtype=self.dtype)
+        self.length = 0
+
+    def close(self):
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def serve(self):
+        shard_file = None
+        try:
+            while True:
+                records = self.pending.get()
+                if records is None:
+                    break
+                if shard_file is None:
+                    shard_path = os.path.join(self.directory, '{0}-{1:05d}'.format(self.name, self.shard_number))
+                    shard_file = open(shard_path, 'wb')
+                    chunks = []
+                    rows = 0
+                data = records.tobytes()
+                if self.compression > 0:
+                    data = zlib.compress(data, self.compression)
+                chunks.append(Chunk(shard_file.tell(), len(data), len(records)))
+                shard_file.write(data)
+                shard_file.flush()
+                rows += len(records)
+                self.write_index(shard_path, chunks)
+                if rows >= self.shard_steps:
+                    shard_file.close()
+                    shard_file = None
+                    self.shard_number += 1
+        except Exception as error:
+            self.error = error
+            # Keep consuming so that append and close don't block on a dead writer
+            while self.pending.get() is not None:
+                pass
+        finally:
+            if shard_file is not None:
+                shard_file.close()
+
+    def write_index(self, shard_path, chunks):
+        index = {'schema_version': SCHEMA_VERSION, 'dtype': np.lib.format.dtype_to_descr(self.dtype),
+                 'arguments': ['{0}/{1}'.format(arg_name, dim) for arg_name, dim in ARGUMENTS],
+                 'encoding': self.encoding, 'compression': self.compression,
+                 'chunks': [list(chunk) for chunk in chunks]}
+        with open(shard_path + '.json.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(shard_path + '.json.tmp', shard_path + '.json')
+
+
+class TrajectoryReader(object):
+    """Random access to the records of every shard in a directory, in shard name order.
+
+    Records are numpy structured values with the fields of record_dtype; reader[i] returns one, reader.chunk(k) all
+    records of the k-th chunk. The last cache_chunks decompressed chunks are kept in memory."""
+
+    def __init__(self, directory, cache_chunks=8):
+        self.directory = directory
+        self.shards = []
+        self.chunks = []
+        self.dtype = None
+        self.encoding = None
+        for entry in sorted(os.listdir(directory)):
+            if not entry.endswith('.json') or entry.startswith('.'):
+                continue
+            with open(os.path.join(directory, entry)) as index_file:
+                index = json.load(index_file)
+            if index['schema_version'] != SCHEMA_VERSION:
+                raise ValueError("Shard {0} has schema version {1}, expected {2}.".format(entry, index['schema_version'], SCHEMA_VERSION))
+            dtype = np.lib.format.descr_to_dtype(index['dtype'])
+            if self.dtype is None:
+                self.dtype = dtype
+                self.encoding = index['encoding']
+            elif dtype != self.dtype or index['encoding'] != self.encoding:
+                raise ValueError("Shard {0} was recorded with a different observation encoding.".format(entry))
+            shard = (os.path.join(directory, entry[:-len('.json')]), index['compression'])
+            self.shards.append(shard)
+            for chunk in index['chunks']:
+                self.chunks.append((len(self.shards) - 1, Chunk(*chunk)))
+        self.chunk_starts = np.cumsum([0] + [chunk.rows for _, chunk in self.chunks])
+        self.maps = {}
+        self.cache = collections.OrderedDict()
+        self.cache_chunks = cache_chunks
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("Record {0} out of range ({1} records).".format(i, len(self)))
+        chunk_number = int(np.searchsorted(self.chunk_starts, i, side='right')) - 1
+        return self.chunk(chunk_number)[i - self.chunk_starts[chunk_number]]
+
+    def num_chunks(self):
+        return len(self.chunks)
+
+    def chunk(self, chunk_number):
+        if chunk_number in self.cache:
+            self.cache.move_to_end(chunk_number)
+            return self.cache[chunk_number]
+        shard_number, chunk = self.chunks[chunk_number]
+        shard_path, compression = self.shards[shard_number]
+        if shard_number not in self.maps:
+            self.maps[shard_number] = np.memmap(shard_path, dtype=np.uint8, mode='r')
+        data = self.maps[shard_number][chunk.offset:chunk.offset + chunk.size]
+        if compression > 0:
+            records = np.frombuffer(zlib.decompress(data), dtype=self.dtype)
+        else:
+            # A view of the mapped file, without copying
+            records = data.view(self.dtype)
+        self.cache[chunk_number] = records
+        if len(self.cache) > self.cache_chunks:
+            self.cache.popitem(last=False)
+        return records
+
+    def iter_chunks(self, order=None):
+        """Yield the chunks in order (a sequence of chunk numbers), by default in the order they were written."""
+        for chunk_number in (range(len(self.chunks)) if order is None else order):
+            yield self.chunk(chunk_number)